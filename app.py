@@ -1,21 +1,35 @@
-from quart import Quart, render_template, request, jsonify, redirect, url_for, flash, session
-from quart_auth import QuartAuth, AuthUser, login_required, current_user
-from werkzeug.security import check_password_hash, generate_password_hash
+from quart import Quart, Response, render_template, request, jsonify, redirect, url_for, flash, session, g, websocket, has_request_context, send_file
+from quart_auth import QuartAuth, AuthUser, Unauthorized, login_required, current_user
+from werkzeug.security import check_password_hash, generate_password_hash, safe_join
 from datetime import datetime, timedelta, date
 from decimal import Decimal
-from functools import wraps
+from functools import wraps, partial
+from typing import NamedTuple
+from contextlib import asynccontextmanager
+from jinja2 import FileSystemBytecodeCache
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import csv
+import mimetypes
+import random
+import sys
+import threading
+import time
+from collections import Counter, OrderedDict
 from dateutil.relativedelta import relativedelta
 import os
-from dotenv import load_dotenv
-from sqlalchemy import cast, String, or_, extract, select, func, distinct, create_engine
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy.exc import DBAPIError, IntegrityError
-from models import Base, Client, Loan, UnclaimedItem, Sale, InterestRate, Employee, async_session_maker, engine
+import orjson
+from sqlalchemy import cast, case, literal, tuple_, String, Integer, Date, Numeric, and_, or_, extract, select, insert, update, delete, func, distinct, exists, literal_column, text, event
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, raiseload, with_loader_criteria
+from sqlalchemy.exc import DataError, DBAPIError, IntegrityError
+from models import (Base, Branch, BranchScoped, BranchSummary, Client, Loan, UnclaimedItem, Sale, InterestRate, Employee,
+                    AuditLog, LoanStatusHistory, ReportJob, SlowQuery, ItemCategory, Product, SALE_CODE_SEQUENCE, async_session_maker, init_engine, warm_up_pool, dispose_engine)
 from config import config
+import static_assets
 import re
 
-load_dotenv()
-
 # Вспомогательная функция для извлечения понятного сообщения об ошибке из исключений БД
 def extract_db_error_message(exception: Exception) -> str:
     """
@@ -95,6 +109,130 @@ app = Quart(__name__)
 config_name = os.getenv('FLASK_ENV', 'development')
 config_obj = config[config_name]()
 app.config['SECRET_KEY'] = config_obj.SECRET_KEY
+# В продакшене шаблоны не проверяются на изменение при каждом обращении; скомпилированный
+# байт-код хранится на диске, и новые воркеры не компилируют шаблоны из исходников.
+# Каталог кеша создается не при импорте, а командой compile-templates и при запуске сервера
+app.config['TEMPLATES_AUTO_RELOAD'] = config_obj.TEMPLATES_AUTO_RELOAD
+
+class TemplateBytecodeCache(FileSystemBytecodeCache):
+    """Пока каталога нет (импорт приложения скриптами, каталог не удалось создать), шаблоны
+    компилируются без записи в кеш, а не завершаются ошибкой"""
+    def dump_bytecode(self, bucket):
+        if os.path.isdir(self.directory):
+            super().dump_bytecode(bucket)
+
+if config_obj.TEMPLATE_CACHE_DIR:
+    app.jinja_options = {**app.jinja_options, 'bytecode_cache': TemplateBytecodeCache(config_obj.TEMPLATE_CACHE_DIR)}
+
+def create_template_cache_dir():
+    if config_obj.TEMPLATE_CACHE_DIR:
+        os.makedirs(config_obj.TEMPLATE_CACHE_DIR, exist_ok=True)
+
+def precompile_templates() -> int:
+    """Компилирует все шаблоны, заполняя кеш байт-кода; возвращает число шаблонов"""
+    names = app.jinja_env.list_templates()
+    for name in names:
+        app.jinja_env.get_template(name)
+    return len(names)
+
+@app.cli.command('compile-templates')
+def compile_templates_command():
+    """Заполняет кеш байт-кода шаблонов при развертывании"""
+    create_template_cache_dir()
+    count = precompile_templates()
+    print(f"[OK] Скомпилировано шаблонов: {count} ({config_obj.TEMPLATE_CACHE_DIR or 'кеш байт-кода отключен'})")
+
+# ========== СТАТИЧЕСКИЕ ФАЙЛЫ ==========
+# Bootstrap, Bootstrap Icons и Chart.js отдаются приложением из static/dist под именами с хешем
+# содержимого (см. static_assets.py). Такие файлы кешируются браузером бессрочно; сжатые варианты
+# .br и .gz подготовлены при сборке. До сборки файлы отдаются из static/ без хеша с обычным
+# кешированием; CDN используется, только если файла нет и в static/.
+ASSET_MANIFEST = static_assets.load_manifest()
+STATIC_SOURCES = set(static_assets.source_files())
+ASSET_MAX_AGE = 365 * 24 * 3600
+ASSET_CACHE_CONTROL = f'public, max-age={ASSET_MAX_AGE}, immutable'
+# Сжатые варианты в порядке предпочтения
+ASSET_ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+@app.template_global()
+def asset_url(name: str) -> str:
+    """Глобальная функция для шаблонов - адрес статического файла с хешем в имени"""
+    if name in ASSET_MANIFEST:
+        return url_for('static_asset', filename=ASSET_MANIFEST[name])
+    if name in STATIC_SOURCES:
+        return url_for('static', filename=name)
+    return static_assets.VENDOR_ASSETS[name]
+
+@app.route('/assets/<path:filename>')
+async def static_asset(filename):
+    path = safe_join(static_assets.DIST_DIR, filename)
+    if path is None or filename.endswith(('.br', '.gz')) or not os.path.isfile(path):
+        return Response('Not Found', status=404)
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    encoding = None
+    for name, suffix in ASSET_ENCODINGS:
+        if name in request.accept_encodings and os.path.isfile(path + suffix):
+            encoding, path = name, path + suffix
+            break
+    response = await send_file(path, mimetype=mimetype, cache_timeout=ASSET_MAX_AGE, conditional=True)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Cache-Control'] = ASSET_CACHE_CONTROL
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
+@app.cli.command('build-static')
+def build_static_command():
+    """Скачивает сторонние файлы и собирает static/dist при развертывании"""
+    for name in static_assets.download_vendor_assets():
+        print(f"[OK] Скачан {name}")
+    manifest = static_assets.build_assets()
+    compression = 'gzip и brotli' if static_assets.brotli is not None else 'gzip (brotli не установлен)'
+    print(f"[OK] Собрано файлов: {len(manifest)}, сжатие: {compression}")
+
+@app.before_serving
+async def startup():
+    """Создает каталог кеша шаблонов и движок БД, заранее открывает DB_POOL_WARMUP соединений"""
+    try:
+        create_template_cache_dir()
+    except OSError:
+        app.logger.exception('Не удалось создать каталог кеша шаблонов %s, шаблоны компилируются без кеша',
+                             config_obj.TEMPLATE_CACHE_DIR)
+    engine = init_engine(config_obj.DATABASE_URI, pool_size=config_obj.DB_POOL_SIZE, max_overflow=config_obj.DB_MAX_OVERFLOW)
+    await warm_up_pool(min(config_obj.DB_POOL_WARMUP, config_obj.DB_POOL_SIZE))
+    start_audit_writer()
+    start_dashboard_tasks(engine)
+    start_report_workers()
+    start_slow_query_log(engine)
+
+@app.after_serving
+async def shutdown():
+    """Записывает оставшиеся события журнала и закрывает соединения с БД при остановке"""
+    await stop_slow_query_log()
+    await stop_report_workers()
+    await stop_dashboard_tasks()
+    await stop_audit_writer()
+    await dispose_engine()
+
+# Хеширование паролей (PBKDF2/scrypt) намеренно нагружает CPU, поэтому выполняется
+# в ограниченном пуле потоков, а не в цикле событий
+_password_executor = ThreadPoolExecutor(
+    max_workers=config_obj.PASSWORD_HASH_WORKERS,
+    thread_name_prefix='password-hash'
+)
+
+async def hash_password(password: str) -> str:
+    """Хеширует пароль в пуле потоков с настроенным алгоритмом PASSWORD_HASH_METHOD"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        _password_executor,
+        partial(generate_password_hash, password, method=config_obj.PASSWORD_HASH_METHOD)
+    )
+
+async def verify_password(password_hash: str, password: str) -> bool:
+    """Проверяет пароль по хешу в пуле потоков"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_password_executor, check_password_hash, password_hash, password)
 
 # Создаем класс пользователя для quart-auth
 class User(AuthUser):
@@ -123,35 +261,6 @@ class User(AuthUser):
 # Кеш для пользователей (временное решение для resolve_user)
 _user_cache = {}
 
-# Создаем синхронный движок для resolve_user (если psycopg2 установлен)
-_sync_engine = None
-_SyncSession = None
-
-try:
-    # Пытаемся создать синхронный движок для загрузки пользователя
-    config_name = os.getenv('FLASK_ENV', 'development')
-    config_obj = config[config_name]()
-    db_uri = config_obj.DATABASE_URI
-    # Заменяем asyncpg на psycopg2 для синхронного доступа
-    if db_uri.startswith('postgresql+asyncpg://'):
-        db_uri = db_uri.replace('postgresql+asyncpg://', 'postgresql://', 1)
-    elif db_uri.startswith('postgresql://'):
-        pass  # Уже правильный формат
-    else:
-        # Формируем из параметров
-        db_host = os.getenv('DB_HOST', 'localhost')
-        db_port = os.getenv('DB_PORT', '5432')
-        db_user = os.getenv('DB_USER', 'postgres')
-        db_password = os.getenv('DB_PASSWORD', 'Meow')
-        db_name = os.getenv('DB_NAME', 'VorobievUD')
-        db_uri = f"postgresql://{db_user}:{db_password}@{db_host}:{db_port}/{db_name}"
-    
-    _sync_engine = create_engine(db_uri, pool_pre_ping=True)
-    _SyncSession = sessionmaker(bind=_sync_engine)
-except Exception:
-    # Если не удалось создать синхронный движок (psycopg2 не установлен), используем только кеш
-    pass
-
 class CustomQuartAuth(QuartAuth):
     def save_cookie(self, token: str) -> None:
         """Сохраняет токен в cookie"""
@@ -176,7 +285,8 @@ class CustomQuartAuth(QuartAuth):
         
         return None
     
-    def resolve_user(self) -> AuthUser:
+    def resolve_auth_id(self) -> str | None:
+        """Извлекает auth_id из cookie или bearer-токена текущего запроса"""
         try:
             if self.mode == "cookie":
                 token = self.load_cookie()
@@ -184,7 +294,7 @@ class CustomQuartAuth(QuartAuth):
                 token = self.load_bearer()
             
             if not token:
-                return User(None)
+                return self.resolve_bearer_auth_id()
             
             auth_id = self.load_token(token)
             
@@ -193,35 +303,27 @@ class CustomQuartAuth(QuartAuth):
                     token_str = str(token)
                     if token_str.isdigit():
                         auth_id = token_str
-                    else:
-                        return User(None)
-                else:
-                    return User(None)
             
-            if auth_id:
-                auth_id_str = str(auth_id)
-                
-                if auth_id_str in _user_cache:
-                    cached_data = _user_cache[auth_id_str]
-                    if cached_data:
-                        return User(auth_id_str, cached_data)
-                
-                if _SyncSession is not None:
-                    try:
-                        with _SyncSession() as sync_session:
-                            employee = sync_session.get(Employee, int(auth_id_str))
-                            if employee and employee.is_active():
-                                _user_cache[auth_id_str] = employee
-                                return User(auth_id_str, employee)
-                    except (ValueError, TypeError):
-                        pass
-                    except Exception:
-                        pass
-                
-                return User(None)
+            return str(auth_id) if auth_id else self.resolve_bearer_auth_id()
         except Exception:
-            pass
-        
+            return None
+    
+    def resolve_bearer_auth_id(self) -> str | None:
+        """Извлекает auth_id из заголовка Authorization: Bearer (интеграции через API).
+        Принимаются только подписанные токены, выданные /api/v1/token"""
+        headers = request.headers if has_request_context() else websocket.headers
+        raw = headers.get('Authorization', '')
+        if raw[:6].lower() != 'bearer':
+            return None
+        auth_id = QuartAuth.load_token(self, raw[6:].strip())
+        return str(auth_id) if auth_id else None
+    
+    def resolve_user(self) -> AuthUser:
+        # Сотрудник загружается заранее в load_current_employee (before_request),
+        # здесь используется только кеш
+        auth_id = self.resolve_auth_id()
+        if auth_id and _user_cache.get(auth_id):
+            return User(auth_id, _user_cache[auth_id])
         return User(None)
 
 auth = CustomQuartAuth(app)
@@ -232,6 +334,458 @@ auth.user_class = User
 auth.mode = "cookie"
 
 
+# ========== ФИЛИАЛЫ ==========
+# Сессия сотрудника привязана к его филиалу: все ORM-выборки данных филиала (BranchScoped)
+# получают условие по Филиал, новые записи по умолчанию относятся к его филиалу.
+# Администратор видит все филиалы.
+def branch_scope(employee: Employee | None) -> dict:
+    """Параметры сессии (Session.info) для сотрудника"""
+    if employee is None:
+        return {}
+    return {
+        'home_branch_id': employee.Филиал,
+        'branch_id': None if employee.Должность == 'Администратор' else employee.Филиал
+    }
+
+def current_employee() -> Employee | None:
+    auth_id = auth.resolve_auth_id()
+    return _user_cache.get(auth_id) if auth_id else None
+
+def current_branch_id() -> int | None:
+    """Филиал, которым ограничены данные текущего пользователя; None - все филиалы"""
+    return branch_scope(current_employee()).get('branch_id')
+
+@event.listens_for(Session, 'do_orm_execute')
+def scope_to_branch(orm_execute_state):
+    """Добавляет условие по филиалу сессии во все ORM-выборки, включая подзапросы и соединения,
+    и в массовые UPDATE и DELETE. Запросы с execution_options(all_branches=True) не ограничиваются."""
+    branch_id = orm_execute_state.session.info.get('branch_id')
+    is_scoped_statement = orm_execute_state.is_select or orm_execute_state.is_update or orm_execute_state.is_delete
+    if (branch_id is None or not is_scoped_statement
+            or orm_execute_state.is_column_load or orm_execute_state.is_relationship_load
+            or orm_execute_state.execution_options.get('all_branches')):
+        return
+    orm_execute_state.statement = orm_execute_state.statement.options(
+        with_loader_criteria(BranchScoped, lambda cls: cls.Филиал == branch_id, include_aliases=True)
+    )
+
+@event.listens_for(Session, 'before_flush')
+def assign_home_branch(session, flush_context, instances):
+    """Новые записи без явно указанного филиала относятся к филиалу сотрудника"""
+    home_branch_id = session.info.get('home_branch_id')
+    if home_branch_id is None:
+        return
+    for obj in session.new:
+        if isinstance(obj, BranchScoped) and obj.Филиал is None:
+            obj.Филиал = home_branch_id
+
+# ========== СЕССИЯ БД ЗАПРОСА ==========
+def get_db_session() -> AsyncSession:
+    """Возвращает сессию БД текущего запроса, создавая ее при первом обращении.
+    Соединение из пула берется только при первом обращении к БД."""
+    if 'db_session' not in g:
+        g.db_session = async_session_maker(info=branch_scope(current_employee()))
+    return g.db_session
+
+@asynccontextmanager
+async def request_session():
+    """Сессия текущего запроса в виде контекстного менеджера; закрывается в конце запроса"""
+    yield get_db_session()
+
+@app.after_request
+async def commit_db_session(response):
+    """Единица работы: фиксирует транзакцию сессии запроса, если запрос завершился успешно"""
+    db_session = g.get('db_session')
+    if db_session is not None and db_session.in_transaction() and response.status_code < 400:
+        await db_session.commit()
+    return response
+
+@app.teardown_request
+async def close_db_session(exc):
+    """Откатывает незафиксированные изменения и возвращает соединение в пул"""
+    db_session = g.pop('db_session', None)
+    if db_session is not None:
+        await db_session.close()
+
+async def gather_queries(*statements):
+    """Выполняет независимые запросы на чтение параллельно, каждый на своем соединении из пула.
+    Число одновременных запросов в рамках одного HTTP-запроса ограничено QUERY_FANOUT_LIMIT.
+    Результаты возвращаются в порядке запросов и доступны после закрытия сессий."""
+    if 'query_semaphore' not in g:
+        g.query_semaphore = asyncio.Semaphore(config_obj.QUERY_FANOUT_LIMIT)
+    semaphore = g.query_semaphore
+    scope = branch_scope(current_employee())
+    
+    async def run(stmt):
+        async with semaphore:
+            async with async_session_maker(info=scope) as session:
+                return await session.execute(stmt)
+    
+    return await asyncio.gather(*(run(stmt) for stmt in statements))
+
+async def load_employee_for_cache(session, **criteria):
+    """Загружает сотрудника без связанных займов и продаж и отсоединяет его от сессии,
+    чтобы объект можно было хранить в кеше пользователей между запросами"""
+    stmt = select(Employee).options(raiseload('*')).filter_by(**criteria).execution_options(all_branches=True)
+    employee = (await session.execute(stmt)).scalar_one_or_none()
+    if employee is not None:
+        session.expunge(employee)
+    return employee
+
+@app.before_request
+async def load_current_employee():
+    """Загружает сотрудника текущего пользователя через сессию запроса, если его нет в кеше"""
+    auth_id = auth.resolve_auth_id()
+    if not auth_id or _user_cache.get(auth_id):
+        return
+    try:
+        employee = await load_employee_for_cache(get_db_session(), ID_Сотрудника=int(auth_id))
+    except (ValueError, TypeError):
+        return
+    if employee and employee.is_active():
+        _user_cache[auth_id] = employee
+        get_db_session().info.update(branch_scope(employee))
+
+@app.before_websocket
+async def load_websocket_employee():
+    """Для WebSocket сотрудник загружается так же, но соединение с БД сразу возвращается в пул,
+    а не удерживается все время подключения"""
+    await load_current_employee()
+    await close_db_session(None)
+
+# ========== ЖУРНАЛ ИЗМЕНЕНИЙ ==========
+# Обработчики не пишут в журнал сами: события копятся в сессии и после успешного коммита
+# попадают в очередь, откуда фоновая задача записывает их пакетами одним INSERT
+_audit_queue: asyncio.Queue = asyncio.Queue()
+_audit_writer_task: asyncio.Task | None = None
+# Маркер остановки фоновой записи
+_AUDIT_STOP = object()
+# Число попыток записи события и наибольшая пауза между попытками в секундах (пауза удваивается,
+# при AUDIT_FLUSH_INTERVAL=1 попытки идут около 4 минут); ключ события со счетчиком попыток
+# (в таблицу не записывается)
+AUDIT_MAX_ATTEMPTS = 10
+AUDIT_MAX_RETRY_DELAY = 60
+_AUDIT_ATTEMPTS = '_попытки'
+
+def audit(session, action: str, table: str, record_id: int, old_value=None, new_value=None, automatic: bool = False):
+    """Добавляет событие журнала к текущей транзакции сессии.
+    Событие попадет в очередь только после коммита; при откате оно отбрасывается."""
+    employee_id = None
+    if not automatic and current_user.auth_id:
+        employee_id = int(current_user.auth_id)
+    session.info.setdefault('audit_events', []).append({
+        'Дата_изменения': datetime.now(),
+        'Сотрудник': employee_id,
+        'Действие': action,
+        'Таблица': table,
+        'Код_записи': record_id,
+        'Старое_значение': None if old_value is None else str(old_value)[:255],
+        'Новое_значение': None if new_value is None else str(new_value)[:255],
+    })
+
+@event.listens_for(Session, 'after_commit')
+def enqueue_audit_events(session):
+    """Передает события зафиксированной транзакции фоновой записи"""
+    for audit_event in session.info.pop('audit_events', ()):
+        _audit_queue.put_nowait(audit_event)
+
+@event.listens_for(Session, 'after_rollback')
+def discard_audit_events(session):
+    """События откатанной транзакции в журнал не попадают"""
+    session.info.pop('audit_events', None)
+
+async def write_audit_batch(batch: list):
+    """Записывает пакет событий одним многострочным INSERT"""
+    async with async_session_maker() as session:
+        await session.execute(insert(AuditLog).values([
+            {key: value for key, value in audit_event.items() if key != _AUDIT_ATTEMPTS} for audit_event in batch
+        ]))
+        await session.commit()
+
+def log_lost_audit_event(message: str, audit_event: dict, *args):
+    """Событие, которое не попадет в журнал, сохраняется хотя бы в логе приложения"""
+    app.logger.error(message, *args, {key: value for key, value in audit_event.items() if key != _AUDIT_ATTEMPTS})
+
+async def write_audit_events(batch: list) -> list:
+    """Записывает пакет событий; возвращает события для повторной попытки.
+    Если БД отклонила пакет из-за данных, события записываются по одному: отклоненное
+    событие повторять бесполезно, оно уходит в лог, остальные записываются"""
+    try:
+        await write_audit_batch(batch)
+        return []
+    except (IntegrityError, DataError):
+        app.logger.exception('БД отклонила пакет из %d событий журнала, запись по одному', len(batch))
+    except Exception:
+        app.logger.exception('Не удалось записать %d событий журнала, повтор позже', len(batch))
+        return batch
+    failed = []
+    for audit_event in batch:
+        try:
+            await write_audit_batch([audit_event])
+        except (IntegrityError, DataError):
+            log_lost_audit_event('Событие журнала отклонено БД: %s', audit_event)
+        except Exception:
+            failed.append(audit_event)
+    return failed
+
+def requeue_audit_events(events: list):
+    """Возвращает события в очередь для повторной записи; после AUDIT_MAX_ATTEMPTS попыток
+    событие сохраняется только в логе приложения"""
+    for audit_event in events:
+        attempts = audit_event.get(_AUDIT_ATTEMPTS, 0) + 1
+        if attempts >= AUDIT_MAX_ATTEMPTS:
+            log_lost_audit_event('Событие журнала не записано после %d попыток: %s', audit_event, attempts)
+        else:
+            audit_event[_AUDIT_ATTEMPTS] = attempts
+            _audit_queue.put_nowait(audit_event)
+
+def drain_audit_queue(batch: list):
+    """Добирает в пакет уже накопившиеся события, не дожидаясь новых"""
+    while len(batch) < config_obj.AUDIT_BATCH_SIZE and not _audit_queue.empty():
+        batch.append(_audit_queue.get_nowait())
+
+async def collect_audit_batch(loop) -> list:
+    """Ждет первое событие и добирает пакет до AUDIT_BATCH_SIZE в пределах AUDIT_FLUSH_INTERVAL"""
+    batch = [await _audit_queue.get()]
+    deadline = loop.time() + config_obj.AUDIT_FLUSH_INTERVAL
+    while len(batch) < config_obj.AUDIT_BATCH_SIZE and batch[-1] is not _AUDIT_STOP:
+        timeout = deadline - loop.time()
+        if timeout <= 0:
+            break
+        try:
+            batch.append(await asyncio.wait_for(_audit_queue.get(), timeout))
+        except asyncio.TimeoutError:
+            break
+    return batch
+
+async def audit_writer():
+    """Фоновая запись журнала: пакет отправляется по заполнении или по истечении AUDIT_FLUSH_INTERVAL.
+    Завершается, получив из очереди маркер остановки"""
+    loop = asyncio.get_running_loop()
+    retry_delay = config_obj.AUDIT_FLUSH_INTERVAL
+    while True:
+        batch = await collect_audit_batch(loop)
+        stopping = batch[-1] is _AUDIT_STOP
+        if stopping:
+            batch.pop()
+        if batch:
+            failed = await write_audit_events(batch)
+            if failed:
+                requeue_audit_events(failed)
+                if not stopping:
+                    await asyncio.sleep(retry_delay)
+                    retry_delay = min(retry_delay * 2, AUDIT_MAX_RETRY_DELAY)
+            else:
+                retry_delay = config_obj.AUDIT_FLUSH_INTERVAL
+        if stopping:
+            return
+
+def start_audit_writer():
+    """Запускает фоновую запись журнала"""
+    global _audit_writer_task
+    if _audit_writer_task is None:
+        _audit_writer_task = asyncio.create_task(audit_writer())
+
+async def stop_audit_writer():
+    """Дожидается записи всех событий, поставленных в очередь до остановки"""
+    global _audit_writer_task
+    if _audit_writer_task is not None:
+        _audit_queue.put_nowait(_AUDIT_STOP)
+        await _audit_writer_task
+        _audit_writer_task = None
+    # События, которые не удалось записать фоновой задаче, - последняя попытка
+    while not _audit_queue.empty():
+        batch = []
+        drain_audit_queue(batch)
+        try:
+            await write_audit_batch(batch)
+        except Exception:
+            # БД недоступна при остановке - события сохраняются хотя бы в логе приложения
+            for audit_event in batch:
+                log_lost_audit_event('Событие журнала не записано: %s', audit_event)
+
+# ========== ИСТОРИЯ СТАТУСОВ ЗАЙМОВ ==========
+# Статус_займа хранит только текущее значение; каждая смена статуса дополнительно записывается
+# в История_статусов_займа в той же транзакции, что и само изменение
+def record_loan_status(session, loan_code: int, status: str, valid_from: date):
+    """Добавляет запись истории статусов займа в транзакцию сессии"""
+    session.add(LoanStatusHistory(Займ=loan_code, Статус=status, Действует_с=valid_from))
+
+def loan_status_as_of(as_of: date):
+    """Подзапрос (Займ, Статус) - статус на дату as_of каждого займа, выданного не позже нее.
+    Последняя запись каждого займа выбирается DISTINCT ON по индексу (Займ, Действует_с)"""
+    return select(LoanStatusHistory.Займ, LoanStatusHistory.Статус).where(
+        LoanStatusHistory.Действует_с <= as_of
+    ).distinct(LoanStatusHistory.Займ).order_by(
+        LoanStatusHistory.Займ, LoanStatusHistory.Действует_с.desc(), LoanStatusHistory.ID_записи.desc()
+    ).subquery()
+
+# ========== ОБНОВЛЕНИЕ ПАНЕЛИ УПРАВЛЕНИЯ ==========
+# Счетчики пересчитываются один раз на изменение данных (а не на каждого зрителя)
+# и рассылаются всем открытым панелям через WebSocket
+DASHBOARD_MODELS = (Client, Loan, Sale, Employee)
+DASHBOARD_CHANNEL = 'dashboard_changed'
+
+# Очередь подключенной панели -> филиал, счетчики которого она показывает (None - все филиалы)
+_dashboard_clients: dict[asyncio.Queue, int | None] = {}
+_dashboard_changed = asyncio.Event()
+# Последние счетчики по филиалам
+_dashboard_stats: dict[int | None, dict] = {}
+_dashboard_tasks: list[asyncio.Task] = []
+
+def dashboard_stats_statements() -> dict:
+    """Запросы счетчиков панели управления"""
+    return {
+        'total_clients': select(func.count(Client.ID_Клиента)),
+        'active_loans': select(func.count(Loan.Код_займа)).where(Loan.Статус_займа != 'Выплачен'),
+        'overdue_loans': select(func.count(Loan.Код_займа)).where(Loan.Статус_займа == 'Просрочен'),
+        'total_sales': select(func.count(Sale.Код_продажи)),
+        'total_employees': select(func.count(Employee.ID_Сотрудника)).where(Employee.Дата_Увольнения == None)
+    }
+
+async def load_dashboard_stats(branch_id: int | None = None) -> dict:
+    """Все счетчики панели филиала одним запросом"""
+    stmt = select(*(query.scalar_subquery().label(key) for key, query in dashboard_stats_statements().items()))
+    async with async_session_maker(info={'branch_id': branch_id}) as session:
+        return (await session.execute(stmt)).one()._asdict()
+
+@event.listens_for(Session, 'after_flush')
+def track_dashboard_flush(session, flush_context):
+    """Отмечает транзакцию, изменившую данные счетчиков через ORM-объекты"""
+    changed = (session.new, session.dirty, session.deleted)
+    if any(isinstance(obj, DASHBOARD_MODELS) for objects in changed for obj in objects):
+        session.info['dashboard_changed'] = True
+
+def mark_dashboard_changed(session):
+    """Отмечает транзакцию, изменившую данные счетчиков массовым UPDATE/DELETE (минуя ORM-объекты)"""
+    session.info['dashboard_changed'] = True
+
+@event.listens_for(Session, 'before_commit')
+def notify_dashboard_workers(session):
+    """При нескольких воркерах изменение рассылается через NOTIFY - оно доставляется только после коммита"""
+    if not config_obj.DASHBOARD_PG_NOTIFY:
+        return
+    session.flush()
+    if session.info.get('dashboard_changed'):
+        session.execute(text(f'NOTIFY {DASHBOARD_CHANNEL}'))
+
+@event.listens_for(Session, 'after_commit')
+def signal_dashboard_change(session):
+    """В одном процессе изменение передается фоновому пересчету напрямую"""
+    if session.info.pop('dashboard_changed', False) and not config_obj.DASHBOARD_PG_NOTIFY:
+        _dashboard_changed.set()
+
+@event.listens_for(Session, 'after_rollback')
+def discard_dashboard_change(session):
+    session.info.pop('dashboard_changed', None)
+
+def broadcast_dashboard(branch_id: int | None, message: dict):
+    """Отправляет сообщение всем подключенным панелям филиала.
+    Медленная панель пропускает промежуточные сообщения и получает последнее состояние."""
+    for queue, queue_branch_id in _dashboard_clients.items():
+        if queue_branch_id != branch_id:
+            continue
+        if queue.full():
+            queue.get_nowait()
+        queue.put_nowait(message)
+
+async def dashboard_refresher():
+    """Пересчитывает счетчики после изменений и рассылает панелям изменившиеся значения.
+    Пересчитываются только филиалы, панели которых сейчас открыты."""
+    while True:
+        await _dashboard_changed.wait()
+        # Изменения за DASHBOARD_DEBOUNCE объединяются в один пересчет
+        await asyncio.sleep(config_obj.DASHBOARD_DEBOUNCE)
+        _dashboard_changed.clear()
+        watched = set(_dashboard_clients.values())
+        # Филиалы без зрителей - счетчики загрузятся при следующем подключении
+        for branch_id in [branch_id for branch_id in _dashboard_stats if branch_id not in watched]:
+            del _dashboard_stats[branch_id]
+        for branch_id in watched:
+            try:
+                stats = await load_dashboard_stats(branch_id)
+            except Exception:
+                app.logger.exception('Не удалось обновить счетчики панели управления')
+                continue
+            previous = _dashboard_stats.get(branch_id) or {}
+            delta = {key: value - previous[key] for key, value in stats.items()
+                     if key in previous and value != previous[key]}
+            _dashboard_stats[branch_id] = stats
+            if delta:
+                broadcast_dashboard(branch_id, {'stats': stats, 'delta': delta})
+
+async def dashboard_listener(engine):
+    """Держит одно соединение с LISTEN и получает изменения, зафиксированные любым воркером"""
+    while True:
+        try:
+            async with engine.connect() as connection:
+                raw_connection = await connection.get_raw_connection()
+                
+                def listener(*args):
+                    _dashboard_changed.set()
+                
+                await raw_connection.driver_connection.add_listener(DASHBOARD_CHANNEL, listener)
+                try:
+                    await asyncio.Future()
+                finally:
+                    await raw_connection.driver_connection.remove_listener(DASHBOARD_CHANNEL, listener)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            app.logger.exception('Соединение LISTEN для панели управления потеряно, переподключение')
+            await asyncio.sleep(5)
+
+def start_dashboard_tasks(engine):
+    """Запускает фоновый пересчет счетчиков и, при нескольких воркерах, прослушивание NOTIFY"""
+    _dashboard_tasks.append(asyncio.create_task(dashboard_refresher()))
+    if config_obj.DASHBOARD_PG_NOTIFY:
+        _dashboard_tasks.append(asyncio.create_task(dashboard_listener(engine)))
+
+async def stop_dashboard_tasks():
+    for task in _dashboard_tasks:
+        task.cancel()
+    await asyncio.gather(*_dashboard_tasks, return_exceptions=True)
+    _dashboard_tasks.clear()
+
+# ========== СВОДКА ПО ФИЛИАЛАМ ==========
+# Новые займы и продажи добавляют приращения к дневной сводке своего филиала в той же транзакции;
+# сводный отчет по всем филиалам читает только сводку
+@event.listens_for(Session, 'after_flush')
+def collect_branch_summary(session, flush_context):
+    """Накопление приращений сводки по новым займам и продажам транзакции"""
+    deltas = session.info.setdefault('branch_summary', {})
+    for obj in session.new:
+        if isinstance(obj, Loan):
+            delta = deltas.setdefault((obj.Филиал, obj.Дата_займа), [0, Decimal('0'), 0])
+            delta[0] += 1
+            delta[1] += obj.Размер_займа
+        elif isinstance(obj, Sale):
+            deltas.setdefault((obj.Филиал, obj.Дата_продажи), [0, Decimal('0'), 0])[2] += 1
+
+@event.listens_for(Session, 'before_commit')
+def write_branch_summary(session):
+    """Запись приращений сводки одним INSERT ... ON CONFLICT DO UPDATE перед коммитом"""
+    session.flush()
+    deltas = session.info.pop('branch_summary', None)
+    if not deltas:
+        return
+    stmt = pg_insert(BranchSummary).values([
+        {'Филиал': branch_id, 'Дата': day, 'Выдано_займов': loans, 'Сумма_займов': amount, 'Продано_товаров': sales}
+        for (branch_id, day), (loans, amount, sales) in deltas.items()
+    ])
+    session.execute(stmt.on_conflict_do_update(
+        index_elements=[BranchSummary.Филиал, BranchSummary.Дата],
+        set_={
+            'Выдано_займов': BranchSummary.Выдано_займов + stmt.excluded.Выдано_займов,
+            'Сумма_займов': BranchSummary.Сумма_займов + stmt.excluded.Сумма_займов,
+            'Продано_товаров': BranchSummary.Продано_товаров + stmt.excluded.Продано_товаров
+        }
+    ))
+
+@event.listens_for(Session, 'after_rollback')
+def discard_branch_summary(session):
+    session.info.pop('branch_summary', None)
+
 # Определение прав доступа для должностей
 ROLE_PERMISSIONS = {
     'Администратор': {
@@ -251,7 +805,9 @@ ROLE_PERMISSIONS = {
         'add_employees': True,
         'edit_employees': True,
         'dismiss_employees': True,
-        'view_reports': True
+        'view_reports': True,
+        'profile_requests': True,
+        'view_slow_queries': True
     },
     'Менеджер-товаровед': {
         'view_clients': True,
@@ -270,7 +826,9 @@ ROLE_PERMISSIONS = {
         'add_employees': False,
         'edit_employees': False,
         'dismiss_employees': False,
-        'view_reports': True
+        'view_reports': True,
+        'profile_requests': False,
+        'view_slow_queries': False
     },
     'Оценщик-товаровед': {
         'view_clients': True,
@@ -289,7 +847,9 @@ ROLE_PERMISSIONS = {
         'add_employees': False,
         'edit_employees': False,
         'dismiss_employees': False,
-        'view_reports': False
+        'view_reports': False,
+        'profile_requests': False,
+        'view_slow_queries': False
     },
     'Менеджер по продажам': {
         'view_clients': True,
@@ -308,7 +868,9 @@ ROLE_PERMISSIONS = {
         'add_employees': False,
         'edit_employees': False,
         'dismiss_employees': False,
-        'view_reports': True
+        'view_reports': True,
+        'profile_requests': False,
+        'view_slow_queries': False
     }
 }
 
@@ -316,28 +878,168 @@ async def check_and_update_overdue_loans():
     """Проверяет и автоматически переводит просроченные займы в статус 'Просрочен'"""
     today = date.today()
     
-    async with async_session_maker() as session:
-        # Получаем все активные займы
-        stmt = select(Loan).where(Loan.Статус_займа == 'Активен')
-        result = await session.execute(stmt)
-        active_loans = result.scalars().all()
-        
-        updated_count = 0
-        for loan in active_loans:
-            # Вычисляем дату окончания займа
-            months = float(loan.Срок_займа)
-            end_date = loan.Дата_займа + relativedelta(months=int(months))
-            
-            # Если сегодняшняя дата больше даты окончания, займ просрочен
-            if today > end_date:
-                loan.Статус_займа = 'Просрочен'
-                updated_count += 1
+    async with request_session() as session:
+        # Одним UPDATE переводим активные займы с истекшим сроком (дата окончания считается в SQL),
+        # не загружая сами займы
+        # Проверка общая для всех филиалов, кто бы из сотрудников ее ни запустил
+        overdue_stmt = update(Loan).where(
+            Loan.Статус_займа == 'Активен',
+            loan_end_date_expr() < today
+        ).values(Статус_займа='Просрочен').returning(
+            Loan.Код_займа, loan_end_date_expr()
+        ).execution_options(all_branches=True)
+        overdue_loans = (await session.execute(overdue_stmt)).all()
+        for loan_code, _ in overdue_loans:
+            audit(session, 'Просрочка', 'Займ', loan_code, 'Активен', 'Просрочен', automatic=True)
+        updated_count = len(overdue_loans)
+        if updated_count:
+            # Займ просрочен со дня после даты окончания, даже если проверка выполнена позже
+            await session.execute(insert(LoanStatusHistory).values([
+                {'Займ': loan_code, 'Статус': 'Просрочен', 'Действует_с': end_date + timedelta(days=1)}
+                for loan_code, end_date in overdue_loans
+            ]))
+            mark_dashboard_changed(session)
         
-        if updated_count > 0:
-            await session.commit()
+        # Товары из просроченных займов сразу переводим в невостребованные
+        await create_unclaimed_items_from_overdue(session)
         
+        # Изменения фиксируются вместе с остальной работой запроса
         return updated_count
 
+# Максимальное значение для денежных полей DECIMAL(10,4)
+MAX_MONEY_VALUE = Decimal('999999.9999')
+
+def overdue_loans_without_item():
+    """Условие анти-соединения: просроченный займ, для которого еще нет невостребованного товара"""
+    return (Loan.Статус_займа == 'Просрочен') & ~exists().where(UnclaimedItem.Займ == Loan.Код_займа)
+
+async def create_unclaimed_items_from_overdue(session) -> int:
+    """Создает невостребованные товары для всех просроченных займов одним запросом INSERT ... SELECT.
+    Артикул равен коду займа, оценочная стоимость = размер займа / UNCLAIMED_LOAN_TO_VALUE.
+    Коммит выполняет вызывающий код."""
+    estimated_value = func.least(
+        func.round(Loan.Размер_займа / config_obj.UNCLAIMED_LOAN_TO_VALUE, 4),
+        MAX_MONEY_VALUE
+    )
+    source_stmt = select(
+        Loan.Код_займа.label('Артикул'),
+        Loan.Код_займа.label('Займ'),
+        estimated_value,
+        Loan.Филиал
+    ).where(overdue_loans_without_item())
+    
+    stmt = pg_insert(UnclaimedItem).from_select(
+        ['Артикул', 'Займ', 'Оценочная_стоимость', 'Филиал'], source_stmt
+    ).on_conflict_do_nothing()
+    result = await session.execute(stmt)
+    return result.rowcount or 0
+
+def loan_end_date_expr():
+    """SQL-выражение даты окончания займа: дата займа + целое число месяцев срока"""
+    months = cast(func.trunc(Loan.Срок_займа), Integer)
+    return cast(Loan.Дата_займа + func.make_interval(0, months), Date)
+
+def loan_accrual_columns(as_of: date):
+    """SQL-выражения начисленных процентов и суммы к возврату на дату as_of.
+    Процент по займу (Процент_по_займу.Процент) начисляется за весь срок займа равномерно по дням
+    и продолжает начисляться с той же дневной ставкой после окончания срока.
+    Расчет идет в NUMERIC на стороне БД, результат округляется до копеек.
+    Запрос должен содержать соединение с InterestRate."""
+    term_days = loan_end_date_expr() - Loan.Дата_займа
+    elapsed_days = func.greatest(literal(as_of, Date) - Loan.Дата_займа, 0)
+    interest = func.round(
+        Loan.Размер_займа * InterestRate.Процент / 100 * elapsed_days / func.nullif(term_days, 0), 2
+    )
+    is_paid = Loan.Статус_займа == 'Выплачен'
+    accrued_interest = case((is_paid, 0), else_=func.coalesce(interest, 0))
+    total_due = case((is_paid, 0), else_=Loan.Размер_займа + func.coalesce(interest, 0))
+    return accrued_interest.label('accrued_interest'), total_due.label('total_due')
+
+def product_search_condition(search: str):
+    """Условие поиска займов по наименованию и категории товара: строки ищутся в небольших
+    справочниках, а займы отбираются по целочисленному ключу товара"""
+    matching_products = select(Product.ID_товара).join(
+        ItemCategory, Product.Категория == ItemCategory.ID_категории
+    ).where(or_(
+        Product.Наименование.ilike(f'%{search}%'),
+        ItemCategory.Название.ilike(f'%{search}%')
+    ))
+    return Loan.Товар.in_(matching_products)
+
+async def get_or_create_product(session, name: str, category: str) -> int:
+    """Возвращает ключ товара из справочника; новые категория и товар добавляются при первом использовании"""
+    product_stmt = select(Product.ID_товара).join(
+        ItemCategory, Product.Категория == ItemCategory.ID_категории
+    ).where(Product.Наименование == name, ItemCategory.Название == category)
+    product_id = (await session.execute(product_stmt)).scalar_one_or_none()
+    if product_id is not None:
+        return product_id
+    
+    await session.execute(pg_insert(ItemCategory).values(Название=category).on_conflict_do_nothing())
+    category_id = (await session.execute(
+        select(ItemCategory.ID_категории).where(ItemCategory.Название == category)
+    )).scalar_one()
+    await session.execute(pg_insert(Product).values(Наименование=name, Категория=category_id).on_conflict_do_nothing())
+    return (await session.execute(product_stmt)).scalar_one()
+
+# Строки списков: только отображаемые столбцы, без ORM-объектов и их связей.
+# Кортеж занимает меньше памяти, чем объект ORM с состоянием сессии, и создается без identity map
+class LoanRow(NamedTuple):
+    Код_займа: int
+    Дата_займа: date
+    ФИО: str
+    Размер_займа: Decimal
+    Срок_займа: Decimal
+    Статус_займа: str
+    Наименование_товара: str
+    end_date: date
+    days_left: int | None
+    accrued_interest: Decimal
+    total_due: Decimal
+
+class SaleRow(NamedTuple):
+    Код_продажи: int
+    Дата_продажи: date
+    Артикул_проданного_товара: int
+    Займ: int
+    Наименование_товара: str
+    Оценочная_стоимость: Decimal
+    ФИО_Сотрудника: str
+
+class UnclaimedItemRow(NamedTuple):
+    Артикул: int
+    Займ: int
+    ФИО: str
+    Наименование_товара: str
+    Оценочная_стоимость: Decimal
+    Продан: bool
+    sale_codes: list | None
+
+def loan_row_columns(today: date) -> list:
+    """Столбцы LoanRow; дата окончания и остаток дней (только для активных займов) считаются в SQL.
+    Запрос должен содержать соединения с Client, Product и InterestRate."""
+    end_date = loan_end_date_expr()
+    days_left = case((Loan.Статус_займа == 'Активен', end_date - literal(today, Date)), else_=None)
+    return [
+        Loan.Код_займа, Loan.Дата_займа, Client.ФИО, Loan.Размер_займа, Loan.Срок_займа,
+        Loan.Статус_займа, Product.Наименование.label('Наименование_товара'), end_date.label('end_date'),
+        days_left.label('days_left'),
+        *loan_accrual_columns(today)
+    ]
+
+def get_pagination_args():
+    """Возвращает номер страницы и количество строк на странице из параметров запроса"""
+    page = request.args.get('page', 1, type=int) or 1
+    per_page = request.args.get('per_page', config_obj.ITEMS_PER_PAGE, type=int) or config_obj.ITEMS_PER_PAGE
+    return max(page, 1), min(max(per_page, 1), 500)
+
+@app.template_global()
+def page_url(page: int) -> str:
+    """Глобальная функция для шаблонов - ссылка на страницу списка с сохранением фильтров"""
+    args = request.args.to_dict()
+    args['page'] = page
+    return url_for(request.endpoint, **(request.view_args or {}), **args)
+
 def permission_required(permission):
     """Декоратор для проверки прав доступа"""
     def decorator(f):
@@ -388,6 +1090,191 @@ def has_permission_global(permission: str) -> bool:
     """Глобальная функция для шаблонов - проверка прав доступа"""
     return has_permission(permission)
 
+# ========== ПРОФИЛИРОВАНИЕ ЗАПРОСОВ ==========
+# Администратор может профилировать отдельный запрос заголовком X-Profile или параметром ?_profile=1.
+# Профиль сохраняется в PROFILE_DIR в формате folded stacks (flamegraph.pl, speedscope, inferno);
+# имя файла возвращается в заголовке X-Profile-File. Обычные запросы проверяют только наличие флага.
+class RequestSampler:
+    """Сэмплирующий профилировщик: фоновый поток каждые interval секунд снимает стек потока
+    цикла событий и считает одинаковые стеки. Цикл событий общий, поэтому в профиль попадают
+    и конкурентные запросы; ожидание БД видно как время в селекторе цикла событий"""
+    def __init__(self, thread_id: int, interval: float):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.elapsed = 0.0
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._sample, name='request-profiler', daemon=True)
+    
+    def start(self):
+        self._started = time.perf_counter()
+        self._thread.start()
+    
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+        self.elapsed = time.perf_counter() - self._started
+    
+    def _sample(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+    
+    def folded(self) -> str:
+        return ''.join(f'{stack} {count}\n' for stack, count in self.stacks.most_common())
+
+def write_profile(path: str, data: str):
+    with open(path, 'w', encoding='utf-8') as file:
+        file.write(data)
+
+@app.before_request
+async def start_request_profile():
+    if 'X-Profile' not in request.headers and '_profile' not in request.args:
+        return
+    if not has_permission('profile_requests'):
+        return
+    g.profiler = RequestSampler(threading.get_ident(), config_obj.PROFILE_SAMPLE_INTERVAL)
+    g.profiler.start()
+
+@app.after_request
+async def finish_request_profile(response):
+    profiler = g.pop('profiler', None)
+    if profiler is None:
+        return response
+    profiler.stop()
+    filename = f'{datetime.now():%Y%m%d_%H%M%S}_{request.endpoint}_{int(profiler.elapsed * 1000)}ms.folded'
+    await asyncio.to_thread(os.makedirs, config_obj.PROFILE_DIR, exist_ok=True)
+    await asyncio.to_thread(write_profile, os.path.join(config_obj.PROFILE_DIR, filename), profiler.folded())
+    response.headers['X-Profile-File'] = filename
+    return response
+
+# ========== ЖУРНАЛ МЕДЛЕННЫХ ЗАПРОСОВ ==========
+# Запросы дольше SLOW_QUERY_MS попадают в очередь из обработчиков событий движка, фоновая задача
+# записывает их в таблицу Медленный_запрос. Для доли SLOW_QUERY_EXPLAIN_SAMPLE запросов на чтение
+# фоновая задача снимает план EXPLAIN (ANALYZE, BUFFERS) на отдельном соединении в откатываемой транзакции.
+# Собственные запросы журнала выполняются с execution_options(slow_query_log=False).
+_slow_query_queue: asyncio.Queue = asyncio.Queue(maxsize=1000)
+_slow_query_tasks: list[asyncio.Task] = []
+# EXPLAIN ANALYZE выполняет запрос повторно, поэтому планы снимаются только для SELECT
+EXPLAINABLE_STATEMENT = re.compile(r'^\s*SELECT\b', re.IGNORECASE)
+
+def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context.slow_query_started = time.perf_counter()
+
+def log_slow_query(conn, cursor, statement, parameters, context, executemany):
+    """Ставит в очередь запрос, выполнявшийся дольше SLOW_QUERY_MS, с маршрутом и параметрами"""
+    started = getattr(context, 'slow_query_started', None)
+    if started is None:
+        return
+    duration_ms = int((time.perf_counter() - started) * 1000)
+    if duration_ms < config_obj.SLOW_QUERY_MS or context.execution_options.get('slow_query_log') is False:
+        return
+    explain = (not executemany and EXPLAINABLE_STATEMENT.match(statement) is not None
+               and random.random() < config_obj.SLOW_QUERY_EXPLAIN_SAMPLE)
+    try:
+        _slow_query_queue.put_nowait({
+            'Время': datetime.now(),
+            'Длительность_мс': duration_ms,
+            'Маршрут': f'{request.method} {request.path}' if has_request_context() else None,
+            'Запрос': statement,
+            'Параметры': repr(parameters)[:1000] if parameters else None,
+            'parameters': parameters if explain else None,
+            'explain': explain
+        })
+    except asyncio.QueueFull:
+        # Журнал не должен замедлять работу: при переполнении записи отбрасываются
+        pass
+
+async def explain_query(engine, statement: str, parameters) -> str:
+    """План запроса с фактическим временем и буферами; транзакция откатывается"""
+    async with engine.connect() as conn:
+        await conn.execution_options(slow_query_log=False)
+        transaction = await conn.begin()
+        try:
+            await conn.exec_driver_sql(f'SET LOCAL statement_timeout = {config_obj.SLOW_QUERY_EXPLAIN_TIMEOUT_MS}')
+            result = await conn.exec_driver_sql(f'EXPLAIN (ANALYZE, BUFFERS) {statement}', parameters or None)
+            return '\n'.join(row[0] for row in result)
+        finally:
+            await transaction.rollback()
+
+async def slow_query_writer(engine):
+    """Записывает медленные запросы по одному и раз в час удаляет записи старше SLOW_QUERY_KEEP_DAYS"""
+    cleaned_at = None
+    while True:
+        entry = await _slow_query_queue.get()
+        parameters = entry.pop('parameters')
+        if entry.pop('explain'):
+            try:
+                entry['План'] = await explain_query(engine, entry['Запрос'], parameters)
+            except Exception as e:
+                entry['План'] = f'Не удалось получить план: {e}'[:1000]
+        now = datetime.now()
+        try:
+            async with engine.begin() as conn:
+                await conn.execution_options(slow_query_log=False)
+                await conn.execute(insert(SlowQuery).values(**entry))
+                if cleaned_at is None or now - cleaned_at > timedelta(hours=1):
+                    await conn.execute(delete(SlowQuery).where(
+                        SlowQuery.Время < now - timedelta(days=config_obj.SLOW_QUERY_KEEP_DAYS)
+                    ))
+                    cleaned_at = now
+        except Exception:
+            app.logger.exception('Не удалось записать медленный запрос')
+
+def start_slow_query_log(engine):
+    """Подключает замер времени запросов к движку; SLOW_QUERY_MS <= 0 отключает журнал"""
+    if config_obj.SLOW_QUERY_MS <= 0:
+        return
+    if not event.contains(engine.sync_engine, 'after_cursor_execute', log_slow_query):
+        event.listen(engine.sync_engine, 'before_cursor_execute', start_query_timer)
+        event.listen(engine.sync_engine, 'after_cursor_execute', log_slow_query)
+    _slow_query_tasks.append(asyncio.create_task(slow_query_writer(engine)))
+
+async def stop_slow_query_log():
+    for task in _slow_query_tasks:
+        task.cancel()
+    await asyncio.gather(*_slow_query_tasks, return_exceptions=True)
+    _slow_query_tasks.clear()
+
+@app.route('/admin/slow-queries')
+@login_required
+@permission_required('view_slow_queries')
+async def slow_queries():
+    """Медленные запросы за период, сгруппированные по тексту запроса, - сначала с наибольшим
+    суммарным временем. Для каждого показывается последний снятый план"""
+    days = min(max(request.args.get('days', 7, type=int) or 7, 1), config_obj.SLOW_QUERY_KEEP_DAYS)
+    since = datetime.now() - timedelta(days=days)
+    total_ms = func.sum(SlowQuery.Длительность_мс)
+    groups_stmt = select(
+        SlowQuery.Запрос,
+        func.count().label('executions'),
+        total_ms.label('total_ms'),
+        func.max(SlowQuery.Длительность_мс).label('max_ms'),
+        func.max(SlowQuery.Время).label('last_seen'),
+        func.array_agg(distinct(SlowQuery.Маршрут)).label('routes')
+    ).where(SlowQuery.Время >= since).group_by(SlowQuery.Запрос).order_by(total_ms.desc()).limit(50)
+    
+    async with request_session() as session:
+        groups = (await session.execute(groups_stmt)).all()
+        # Последняя запись каждого запроса, предпочтительно с планом
+        latest_stmt = select(SlowQuery.Запрос, SlowQuery.Параметры, SlowQuery.План).distinct(
+            SlowQuery.Запрос
+        ).where(
+            SlowQuery.Время >= since,
+            SlowQuery.Запрос.in_([group.Запрос for group in groups])
+        ).order_by(SlowQuery.Запрос, SlowQuery.План.is_(None), SlowQuery.Время.desc())
+        latest = {row.Запрос: row for row in (await session.execute(latest_stmt)).all()} if groups else {}
+    
+    return await render_template('slow_queries.html', groups=groups, latest=latest, days=days,
+                                 threshold_ms=config_obj.SLOW_QUERY_MS)
+
 # ========== АВТОРИЗАЦИЯ ==========
 @app.route('/login', methods=['GET', 'POST'])
 async def login():
@@ -407,10 +1294,8 @@ async def login():
             await flash('Пожалуйста, введите логин и пароль', 'error')
             return await render_template('login.html')
         
-        async with async_session_maker() as db_session:
-            stmt = select(Employee).where(Employee.Логин == login_name)
-            result = await db_session.execute(stmt)
-            employee = result.scalar_one_or_none()
+        async with request_session() as db_session:
+            employee = await load_employee_for_cache(db_session, Логин=login_name)
             
             if not employee:
                 await flash('Неверный логин или пароль', 'error')
@@ -424,7 +1309,7 @@ async def login():
                 await flash('У этого сотрудника не установлен пароль. Обратитесь к администратору.', 'error')
                 return await render_template('login.html')
             
-            password_match = check_password_hash(employee.Пароль, password)
+            password_match = await verify_password(employee.Пароль, password)
             if not password_match:
                 await flash('Неверный логин или пароль', 'error')
                 return await render_template('login.html')
@@ -484,17 +1369,31 @@ async def index():
     
     # Автоматически проверяем и обновляем просроченные займы
     await check_and_update_overdue_loans()
+    # Фиксируем результат проверки, чтобы его видели параллельные запросы на других соединениях
+    await get_db_session().commit()
     
-    async with async_session_maker() as session:
-        stats = {
-            'total_clients': (await session.execute(select(func.count(Client.ID_Клиента)))).scalar(),
-            'active_loans': (await session.execute(select(func.count(Loan.Код_займа)).where(Loan.Статус_займа != 'Выплачен'))).scalar(),
-            'overdue_loans': (await session.execute(select(func.count(Loan.Код_займа)).where(Loan.Статус_займа == 'Просрочен'))).scalar(),
-            'total_sales': (await session.execute(select(func.count(Sale.Код_продажи)))).scalar(),
-            'total_employees': (await session.execute(select(func.count(Employee.ID_Сотрудника)).where(Employee.Дата_Увольнения == None))).scalar()
-        }
+    stats_statements = dashboard_stats_statements()
+    results = await gather_queries(*stats_statements.values())
+    stats = {key: result.scalar() for key, result in zip(stats_statements, results)}
     return await render_template('index.html', stats=stats)
 
+@app.websocket('/ws/dashboard')
+@login_required
+async def dashboard_updates():
+    """Живое обновление панели управления: сначала текущие счетчики, затем изменения.
+    Открытая панель не обращается к БД - счетчики пересчитывает одна фоновая задача."""
+    branch_id = current_branch_id()
+    if branch_id not in _dashboard_stats:
+        _dashboard_stats[branch_id] = await load_dashboard_stats(branch_id)
+    queue = asyncio.Queue(maxsize=1)
+    _dashboard_clients[queue] = branch_id
+    try:
+        await websocket.send_json({'stats': _dashboard_stats[branch_id], 'delta': {}})
+        while True:
+            await websocket.send_json(await queue.get())
+    finally:
+        _dashboard_clients.pop(queue, None)
+
 # ========== КЛИЕНТЫ ==========
 @app.route('/clients')
 @login_required
@@ -506,8 +1405,8 @@ async def clients():
     sort_by = request.args.get('sort', 'ID_Клиента')
     sort_order = request.args.get('order', 'asc')
     
-    async with async_session_maker() as session:
-        stmt = select(Client)
+    async with request_session() as session:
+        stmt = select(Client).options(raiseload(Client.loans))
         
         # Применяем поиск
         if search:
@@ -560,9 +1459,11 @@ async def add_client():
     if request.method == 'POST':
         try:
             form = await request.form
-            async with async_session_maker() as session:
-                # Получаем следующий ID клиента
-                max_id_result = await session.execute(select(func.max(Client.ID_Клиента)))
+            async with request_session() as session:
+                # Получаем следующий ID клиента (ключи сквозные для всех филиалов)
+                max_id_result = await session.execute(
+                    select(func.max(Client.ID_Клиента)).execution_options(all_branches=True)
+                )
                 max_id = max_id_result.scalar() or 0
                 next_id = max_id + 1
                 
@@ -582,12 +1483,60 @@ async def add_client():
             return redirect(url_for('add_client'))
     return await render_template('add_client.html')
 
+@app.route('/clients/<int:id>')
+@login_required
+@permission_required('view_clients')
+async def client_detail(id):
+    page, per_page = get_pagination_args()
+    
+    async with request_session() as session:
+        client_stmt = select(Client.ID_Клиента, Client.ФИО, Client.Телефон).where(Client.ID_Клиента == id)
+        client = (await session.execute(client_stmt)).one_or_none()
+        if not client:
+            await flash('Клиент не найден', 'error')
+            return redirect(url_for('clients'))
+        
+        # Сводка по всей истории клиента одним агрегирующим запросом
+        client_items = select(func.count(UnclaimedItem.Артикул)).join(
+            Loan, UnclaimedItem.Займ == Loan.Код_займа
+        ).where(Loan.Клиент == id)
+        summary_stmt = select(
+            func.count(Loan.Код_займа).label('total_loans'),
+            func.count(Loan.Код_займа).filter(Loan.Статус_займа == 'Активен').label('active_loans'),
+            func.count(Loan.Код_займа).filter(Loan.Статус_займа == 'Выплачен').label('paid_loans'),
+            func.count(Loan.Код_займа).filter(Loan.Статус_займа == 'Просрочен').label('overdue_loans'),
+            func.coalesce(func.sum(Loan.Размер_займа), 0).label('total_principal'),
+            func.max(Loan.Дата_займа).label('last_visit'),
+            client_items.scalar_subquery().label('forfeited_items'),
+            client_items.where(UnclaimedItem.Продан == True).scalar_subquery().label('sold_items')
+        ).where(Loan.Клиент == id)
+        summary = (await session.execute(summary_stmt)).one()
+        overdue_ratio = summary.overdue_loans / summary.total_loans if summary.total_loans else 0
+        
+        # История займов постранично (индекс по клиенту и дате займа)
+        history_stmt = select(
+            Loan.Код_займа,
+            Loan.Дата_займа,
+            Loan.Размер_займа,
+            Loan.Срок_займа,
+            Loan.Статус_займа,
+            Product.Наименование.label('Наименование_товара')
+        ).join(Product, Loan.Товар == Product.ID_товара).where(Loan.Клиент == id).order_by(
+            Loan.Дата_займа.desc(), Loan.Код_займа.desc()
+        ).offset((page - 1) * per_page).limit(per_page + 1)
+        loans_list = (await session.execute(history_stmt)).all()
+        has_next = len(loans_list) > per_page
+    
+    return await render_template('client_detail.html', client=client, summary=summary, overdue_ratio=overdue_ratio,
+                          loans=loans_list[:per_page], page=page, has_next=has_next)
+
 @app.route('/clients/<int:id>/edit', methods=['GET', 'POST'])
 @login_required
 @permission_required('edit_clients')
 async def edit_client(id):
-    async with async_session_maker() as session:
-        client = await session.get(Client, id)
+    async with request_session() as session:
+        # История займов для формы не нужна
+        client = await session.get(Client, id, options=[raiseload(Client.loans)])
         if not client:
             await flash('Клиент не найден', 'error')
             return redirect(url_for('clients'))
@@ -595,8 +1544,10 @@ async def edit_client(id):
         if request.method == 'POST':
             try:
                 form = await request.form
+                old_value = f'{client.ФИО}, {client.Телефон}'
                 client.ФИО = form['fio']
                 client.Телефон = form['phone']
+                audit(session, 'Изменение', 'Клиент', id, old_value, f'{client.ФИО}, {client.Телефон}')
                 await session.commit()
                 await flash('Клиент успешно обновлен', 'success')
                 return redirect(url_for('clients'))
@@ -607,10 +1558,9 @@ async def edit_client(id):
                 full_error_message = f'Ошибка при обновлении клиента: {error_message}'
                 # Используем flash для toast-уведомления в правом верхнем углу
                 await flash(full_error_message, 'error')
-                # Загружаем объект заново в новой сессии для рендеринга
-                async with async_session_maker() as new_session:
-                    client = await new_session.get(Client, id)
-                    return await render_template('edit_client.html', client=client)
+                # После отката объект устарел - загружаем его заново для рендеринга
+                client = await session.get(Client, id, options=[raiseload(Client.loans)], populate_existing=True)
+                return await render_template('edit_client.html', client=client)
         
         # GET запрос - объект уже загружен в текущей сессии
         return await render_template('edit_client.html', client=client)
@@ -619,7 +1569,7 @@ async def edit_client(id):
 @login_required
 @permission_required('delete_clients')
 async def delete_client(id):
-    async with async_session_maker() as session:
+    async with request_session() as session:
         client = await session.get(Client, id)
         if not client:
             await flash('Клиент не найден', 'error')
@@ -650,8 +1600,16 @@ async def loans():
     sort_by = request.args.get('sort', 'Код_займа')
     sort_order = request.args.get('order', 'desc')
     
-    async with async_session_maker() as session:
-        stmt = select(Loan)
+    today = date.today()
+    
+    async with request_session() as session:
+        stmt = select(*loan_row_columns(today)).join(
+            Client, Loan.Клиент == Client.ID_Клиента
+        ).join(
+            Product, Loan.Товар == Product.ID_товара
+        ).join(
+            InterestRate, Loan.Процент_по_займу == InterestRate.Индекс_процента
+        )
         
         # Применяем фильтр по статусу
         if status_filter:
@@ -682,12 +1640,11 @@ async def loans():
             search_conditions.append(cast(Loan.Размер_займа, String).ilike(f'%{search}%'))
             search_conditions.append(cast(Loan.Срок_займа, String).ilike(f'%{search}%'))
             
-            # Поиск по текстовым полям (требует join)
-            stmt = stmt.join(Client, Loan.Клиент == Client.ID_Клиента)
+            # Поиск по текстовым полям
             search_conditions.append(Client.ФИО.ilike(f'%{search}%'))
             search_conditions.append(Client.Телефон.ilike(f'%{search}%'))
-            search_conditions.append(Loan.Наименование_товара.ilike(f'%{search}%'))
-            search_conditions.append(Loan.Категория_товара.ilike(f'%{search}%'))
+            # Наименование и категория товара - по справочникам
+            search_conditions.append(product_search_condition(search))
             search_conditions.append(Loan.Физическое_состояние.ilike(f'%{search}%'))
             search_conditions.append(Loan.Статус_займа.ilike(f'%{search}%'))
             
@@ -711,26 +1668,14 @@ async def loans():
             stmt = stmt.order_by(order_col.asc())
         
         result = await session.execute(stmt)
-        loans_list = result.scalars().all()
-        
-        # Вычисляем даты окончания для всех займов
-        today = date.today()
-        loans_with_end_dates = []
-        for loan in loans_list:
-            months = float(loan.Срок_займа)
-            end_date = loan.Дата_займа + relativedelta(months=int(months))
-            loans_with_end_dates.append({
-                'loan': loan,
-                'end_date': end_date,
-                'days_left': (end_date - today).days if loan.Статус_займа == 'Активен' else None
-            })
+        loans_list = list(map(LoanRow._make, result))
         
         # Получаем уникальные статусы для фильтра
         status_stmt = select(distinct(Loan.Статус_займа))
         status_result = await session.execute(status_stmt)
         status_list = [s[0] for s in status_result.all()]
     
-    return await render_template('loans.html', loans=loans_with_end_dates, status_filter=status_filter, 
+    return await render_template('loans.html', loans=loans_list, status_filter=status_filter, 
                           search=search, sort=sort_by, order=sort_order, statuses=status_list, today=today)
 
 @app.route('/api/loan-autocomplete', methods=['GET'])
@@ -738,44 +1683,33 @@ async def loans():
 async def loan_autocomplete():
     """API endpoint для автозаполнения полей формы займа"""
     try:
-        async with async_session_maker() as session:
-            # Получаем уникальные коды займов с полными данными (артикул = код займа)
+        async with request_session() as session:
+            # Получаем коды займов с данными товара (артикул = код займа)
             stmt = select(
                 Loan.Код_займа,
-                Loan.Наименование_товара,
-                Loan.Категория_товара,
+                Product.Наименование,
+                ItemCategory.Название,
                 Loan.Физическое_состояние
-            ).distinct().order_by(Loan.Код_займа)
+            ).join(Product, Loan.Товар == Product.ID_товара).join(
+                ItemCategory, Product.Категория == ItemCategory.ID_категории
+            ).order_by(Loan.Код_займа)
             
             result = await session.execute(stmt)
-            loans_data = result.all()
             
-            # Формируем данные для автозаполнения
             # Используем код займа как ключ (так как артикул = код займа)
-            loan_codes = {}
-            names = set()
-            categories = set()
+            loan_codes = {
+                str(loan_code): {'name': name, 'category': category, 'condition': condition}
+                for loan_code, name, category, condition in result
+            }
             
-            for loan in loans_data:
-                loan_code = loan.Код_займа
-                name = loan.Наименование_товара
-                category = loan.Категория_товара
-                condition = loan.Физическое_состояние
-                
-                # Сохраняем полные данные по коду займа (берем последний найденный)
-                loan_codes[loan_code] = {
-                    'name': name,
-                    'category': category,
-                    'condition': condition
-                }
-                
-                names.add(name)
-                categories.add(category)
+            # Списки наименований и категорий - из справочников
+            names_result = await session.execute(select(distinct(Product.Наименование)).order_by(Product.Наименование))
+            categories_result = await session.execute(select(ItemCategory.Название).order_by(ItemCategory.Название))
             
             return jsonify({
-                'loan_codes': {str(k): v for k, v in loan_codes.items()},
-                'names': sorted(list(names)),
-                'categories': sorted(list(categories))
+                'loan_codes': loan_codes,
+                'names': names_result.scalars().all(),
+                'categories': categories_result.scalars().all()
             })
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -787,7 +1721,7 @@ async def add_loan():
     if request.method == 'POST':
         try:
             form = await request.form
-            async with async_session_maker() as session:
+            async with request_session() as session:
                 # Получаем процент по займу на основе состояния товара и срока
                 condition_decimal = Decimal(form['condition'])
                 term_decimal = Decimal(form['term'])
@@ -820,8 +1754,19 @@ async def add_loan():
                     session.add(interest_rate)
                     await session.flush()  # Сохраняем, чтобы получить ID
                 
-                # Получаем следующий код займа (так как Код_займа не является автоинкрементом)
-                max_code_stmt = select(func.max(Loan.Код_займа))
+                # Займ учитывается в филиале клиента; клиенты других филиалов
+                # недоступны сотруднику филиала
+                client_id = int(form['client_id'])
+                client_branch_id = (await session.execute(
+                    select(Client.Филиал).where(Client.ID_Клиента == client_id)
+                )).scalar_one_or_none()
+                if client_branch_id is None:
+                    await flash('Клиент не найден', 'error')
+                    return redirect(url_for('add_loan'))
+                
+                # Получаем следующий код займа (так как Код_займа не является автоинкрементом);
+                # коды сквозные для всех филиалов
+                max_code_stmt = select(func.max(Loan.Код_займа)).execution_options(all_branches=True)
                 max_code_result = await session.execute(max_code_stmt)
                 max_code = max_code_result.scalar() or 0
                 next_loan_code = max_code + 1
@@ -830,19 +1775,21 @@ async def add_loan():
                 loan = Loan(
                     Код_займа=next_loan_code,  # Явно указываем код займа
                     Дата_займа=datetime.strptime(form['date'], '%Y-%m-%d').date(),
-                    Клиент=int(form['client_id']),
+                    Клиент=client_id,
                     Размер_займа=Decimal(form['amount']),
                     Процент_по_займу=interest_rate.Индекс_процента,
                     Срок_займа=term_decimal,
                     Статус_займа='Активен',  # Новый займ всегда активен
                     Состояние_товара=interest_rate.Состояние_товара,  # Процент из InterestRate
                     Артикул_товара=next_loan_code,  # Артикул равен коду займа
-                    Наименование_товара=form['name'],
-                    Категория_товара=form['category'],
+                    Товар=await get_or_create_product(session, form['name'], form['category']),
                     Физическое_состояние=form['physical_condition'],
-                    Исполнитель=int(form['employee_id'])
+                    Исполнитель=int(form['employee_id']),
+                    Филиал=client_branch_id
                 )
                 session.add(loan)
+                record_loan_status(session, next_loan_code, 'Активен', loan.Дата_займа)
+                audit(session, 'Выдача', 'Займ', next_loan_code, new_value=f"{loan.Размер_займа} руб., {form['name']}")
                 await session.commit()
                 await flash('Займ успешно добавлен', 'success')
                 return redirect(url_for('loans'))
@@ -852,7 +1799,7 @@ async def add_loan():
             await flash(f'Ошибка при добавлении займа: {error_message}', 'error')
             return redirect(url_for('add_loan'))
     
-    async with async_session_maker() as session:
+    async with request_session() as session:
         clients_result = await session.execute(select(Client))
         clients_list = clients_result.scalars().all()
         
@@ -868,7 +1815,7 @@ async def add_loan():
 @login_required
 @permission_required('view_loans')
 async def loan_detail(id):
-    async with async_session_maker() as session:
+    async with request_session() as session:
         loan = await session.get(Loan, id)
         if not loan:
             await flash('Займ не найден', 'error')
@@ -878,14 +1825,20 @@ async def loan_detail(id):
         months = float(loan.Срок_займа)
         end_date = loan.Дата_займа + relativedelta(months=int(months))
         today = date.today()
+        
+        # Начисленные проценты и сумма к возврату на сегодня
+        accrual_stmt = select(*loan_accrual_columns(today)).join(
+            InterestRate, Loan.Процент_по_займу == InterestRate.Индекс_процента
+        ).where(Loan.Код_займа == id)
+        accrual = (await session.execute(accrual_stmt)).one()
     
-    return await render_template('loan_detail.html', loan=loan, end_date=end_date, today=today)
+    return await render_template('loan_detail.html', loan=loan, end_date=end_date, today=today, accrual=accrual)
 
 @app.route('/loans/<int:id>/pay', methods=['POST'])
 @login_required
 @permission_required('pay_loans')
 async def pay_loan(id):
-    async with async_session_maker() as session:
+    async with request_session() as session:
         loan = await session.get(Loan, id)
         if not loan:
             await flash('Займ не найден', 'error')
@@ -903,6 +1856,8 @@ async def pay_loan(id):
         
         try:
             loan.Статус_займа = 'Выплачен'
+            record_loan_status(session, id, 'Выплачен', date.today())
+            audit(session, 'Выплата', 'Займ', id, 'Активен', 'Выплачен')
             await session.commit()
             await flash('Займ отмечен как выплаченный', 'success')
         except Exception as e:
@@ -920,11 +1875,23 @@ async def unclaimed_items():
     search = request.args.get('search', '')
     min_price = request.args.get('min_price', '')
     max_price = request.args.get('max_price', '')
+    status_filter = request.args.get('status', '')
     # Сортировка
     sort_by = request.args.get('sort', 'Артикул')
     sort_order = request.args.get('order', 'desc')
     
-    async with async_session_maker() as session:
+    async with request_session() as session:
+        # Номера продаж товара собираются коррелированным подзапросом
+        sale_codes = select(func.array_agg(Sale.Код_продажи)).where(
+            Sale.Артикул_проданного_товара == UnclaimedItem.Артикул
+        ).scalar_subquery()
+        stmt = select(
+            UnclaimedItem.Артикул, UnclaimedItem.Займ, Client.ФИО, Product.Наименование.label('Наименование_товара'),
+            UnclaimedItem.Оценочная_стоимость, UnclaimedItem.Продан, sale_codes.label('sale_codes')
+        ).join(Loan, UnclaimedItem.Займ == Loan.Код_займа).join(Client, Loan.Клиент == Client.ID_Клиента).join(
+            Product, Loan.Товар == Product.ID_товара
+        )
+        
         # Применяем поиск
         if search:
             # Проверяем, является ли поиск числом
@@ -951,20 +1918,19 @@ async def unclaimed_items():
             # Поиск по оценочной стоимости (всегда как строка)
             search_conditions.append(cast(UnclaimedItem.Оценочная_стоимость, String).ilike(f'%{search}%'))
             
-            # Для поиска по связанным таблицам нужен join
-            # Создаем базовый запрос с join
-            stmt = select(UnclaimedItem).join(Loan, UnclaimedItem.Займ == Loan.Код_займа).join(Client, Loan.Клиент == Client.ID_Клиента)
-            
-            # Добавляем условия поиска по связанным таблицам
+            # Условия поиска по связанным таблицам
             search_conditions.append(Client.ФИО.ilike(f'%{search}%'))
-            search_conditions.append(Loan.Наименование_товара.ilike(f'%{search}%'))
-            search_conditions.append(Loan.Категория_товара.ilike(f'%{search}%'))
+            # Наименование и категория товара - по справочникам
+            search_conditions.append(product_search_condition(search))
             
             # Применяем условия поиска (показываем все товары, включая проданные)
-            stmt = stmt.where(or_(*search_conditions)).distinct()
-        else:
-            # Если поиска нет, показываем все товары
-            stmt = select(UnclaimedItem)
+            stmt = stmt.where(or_(*search_conditions))
+        
+        # Применяем фильтр по наличию
+        if status_filter == 'available':
+            stmt = stmt.where(UnclaimedItem.Продан == False)
+        elif status_filter == 'sold':
+            stmt = stmt.where(UnclaimedItem.Продан == True)
         
         # Применяем фильтр по цене
         if min_price:
@@ -992,9 +1958,9 @@ async def unclaimed_items():
             stmt = stmt.order_by(order_col.asc())
         
         result = await session.execute(stmt)
-        items = result.scalars().all()
+        items = list(map(UnclaimedItemRow._make, result))
     
-    return await render_template('unclaimed_items.html', items=items, search=search, 
+    return await render_template('unclaimed_items.html', items=items, search=search, status_filter=status_filter,
                           min_price=min_price, max_price=max_price, sort=sort_by, order=sort_order)
 
 @app.route('/unclaimed/add', methods=['GET', 'POST'])
@@ -1006,7 +1972,7 @@ async def add_unclaimed_item():
             form = await request.form
             loan_id = int(form['loan_id'])
             
-            async with async_session_maker() as session:
+            async with request_session() as session:
                 # Проверяем, что для этого займа еще нет невостребованного товара
                 stmt = select(UnclaimedItem).where(UnclaimedItem.Займ == loan_id)
                 result = await session.execute(stmt)
@@ -1028,7 +1994,8 @@ async def add_unclaimed_item():
                 item = UnclaimedItem(
                     Артикул=loan.Код_займа,  # Артикул равен коду займа
                     Займ=loan_id,
-                    Оценочная_стоимость=Decimal(form['estimated_value'])
+                    Оценочная_стоимость=Decimal(form['estimated_value']),
+                    Филиал=loan.Филиал
                 )
                 session.add(item)
                 await session.commit()
@@ -1040,21 +2007,48 @@ async def add_unclaimed_item():
             await flash(f'Ошибка при добавлении товара: {error_message}', 'error')
             return redirect(url_for('add_unclaimed_item'))
     
-    async with async_session_maker() as session:
-        # Показываем только просроченные займы, для которых еще нет невостребованных товаров
-        overdue_stmt = select(Loan).where(Loan.Статус_займа == 'Просрочен')
-        overdue_result = await session.execute(overdue_stmt)
-        overdue_loans = overdue_result.scalars().all()
-        
-        existing_stmt = select(UnclaimedItem.Займ)
-        existing_result = await session.execute(existing_stmt)
-        existing_loan_ids = {item[0] for item in existing_result.all()}
-        available_loans = [loan for loan in overdue_loans if loan.Код_займа not in existing_loan_ids]
-    
     # Получаем loan_id из URL параметра, если есть
     preselected_loan_id = request.args.get('loan_id', type=int)
+    page, per_page = get_pagination_args()
+    
+    async with request_session() as session:
+        # Показываем только просроченные займы, для которых еще нет невостребованных товаров
+        loans_stmt = select(
+            Loan.Код_займа,
+            Product.Наименование.label('Наименование_товара'),
+            Client.ФИО
+        ).join(Client, Loan.Клиент == Client.ID_Клиента).join(
+            Product, Loan.Товар == Product.ID_товара
+        ).where(overdue_loans_without_item())
+        
+        page_stmt = loans_stmt.order_by(Loan.Код_займа).offset((page - 1) * per_page).limit(per_page + 1)
+        available_loans = (await session.execute(page_stmt)).all()
+        has_next = len(available_loans) > per_page
+        available_loans = available_loans[:per_page]
+        
+        # Выбранный займ может оказаться на другой странице
+        if preselected_loan_id and all(loan.Код_займа != preselected_loan_id for loan in available_loans):
+            preselected_stmt = loans_stmt.where(Loan.Код_займа == preselected_loan_id)
+            available_loans = (await session.execute(preselected_stmt)).all() + available_loans
     
-    return await render_template('add_unclaimed_item.html', loans=available_loans, preselected_loan_id=preselected_loan_id)
+    return await render_template('add_unclaimed_item.html', loans=available_loans, preselected_loan_id=preselected_loan_id,
+                          page=page, has_next=has_next)
+
+@app.route('/unclaimed/auto', methods=['POST'])
+@login_required
+@permission_required('add_unclaimed')
+async def auto_create_unclaimed_items():
+    """Переводит товары всех просроченных займов в невостребованные"""
+    async with request_session() as session:
+        try:
+            created_count = await create_unclaimed_items_from_overdue(session)
+            await session.commit()
+            await flash(f'Создано невостребованных товаров: {created_count}', 'success')
+        except Exception as e:
+            await session.rollback()
+            error_message = extract_db_error_message(e)
+            await flash(f'Ошибка при создании товаров: {error_message}', 'error')
+    return redirect(url_for('unclaimed_items'))
 
 # ========== ПРОДАЖИ ==========
 @app.route('/sales')
@@ -1069,8 +2063,19 @@ async def sales():
     sort_by = request.args.get('sort', 'Код_продажи')
     sort_order = request.args.get('order', 'desc')
     
-    async with async_session_maker() as session:
-        stmt = select(Sale)
+    async with request_session() as session:
+        stmt = select(
+            Sale.Код_продажи, Sale.Дата_продажи, Sale.Артикул_проданного_товара, UnclaimedItem.Займ,
+            Product.Наименование.label('Наименование_товара'), UnclaimedItem.Оценочная_стоимость, Employee.ФИО_Сотрудника
+        ).join(
+            UnclaimedItem, Sale.Артикул_проданного_товара == UnclaimedItem.Артикул
+        ).join(
+            Loan, UnclaimedItem.Займ == Loan.Код_займа
+        ).join(
+            Product, Loan.Товар == Product.ID_товара
+        ).join(
+            Employee, Sale.Продавец == Employee.ID_Сотрудника
+        )
         
         # Применяем поиск
         if search:
@@ -1094,11 +2099,8 @@ async def sales():
             search_conditions.append(cast(Sale.Код_продажи, String).ilike(f'%{search}%'))
             search_conditions.append(cast(Sale.Артикул_проданного_товара, String).ilike(f'%{search}%'))
             
-            # Поиск по связанным таблицам (требует join)
-            stmt = stmt.join(UnclaimedItem, Sale.Артикул_проданного_товара == UnclaimedItem.Артикул)
-            stmt = stmt.join(Loan, UnclaimedItem.Займ == Loan.Код_займа)
+            # Поиск по клиенту требует join
             stmt = stmt.join(Client, Loan.Клиент == Client.ID_Клиента)
-            stmt = stmt.join(Employee, Sale.Продавец == Employee.ID_Сотрудника)
             
             # Поиск по числовым полям связанных таблиц
             if is_numeric:
@@ -1112,8 +2114,8 @@ async def sales():
             # Поиск по текстовым полям
             search_conditions.append(Client.ФИО.ilike(f'%{search}%'))
             search_conditions.append(Client.Телефон.ilike(f'%{search}%'))
-            search_conditions.append(Loan.Наименование_товара.ilike(f'%{search}%'))
-            search_conditions.append(Loan.Категория_товара.ilike(f'%{search}%'))
+            # Наименование и категория товара - по справочникам
+            search_conditions.append(product_search_condition(search))
             search_conditions.append(Employee.ФИО_Сотрудника.ilike(f'%{search}%'))
             search_conditions.append(Employee.Должность.ilike(f'%{search}%'))
             
@@ -1145,7 +2147,7 @@ async def sales():
             stmt = stmt.order_by(order_col.asc())
         
         result = await session.execute(stmt)
-        sales_list = result.scalars().all()
+        sales_list = list(map(SaleRow._make, result))
     
     return await render_template('sales.html', sales=sales_list, search=search, 
                           date_from=date_from, date_to=date_to, sort=sort_by, order=sort_order)
@@ -1159,27 +2161,32 @@ async def add_sale():
             form = await request.form
             article_id = int(form['article_id'])
             
-            async with async_session_maker() as session:
-                # Проверяем, не продан ли уже этот товар
-                stmt = select(Sale).where(Sale.Артикул_проданного_товара == article_id)
-                result = await session.execute(stmt)
-                existing_sale = result.scalar_one_or_none()
-                if existing_sale:
-                    await flash('Этот товар уже был продан ранее', 'error')
+            async with request_session() as session:
+                # Атомарно помечаем товар проданным: строка блокируется до конца транзакции,
+                # поэтому параллельная продажа того же товара не пройдет. Для сотрудника филиала
+                # UPDATE ограничен его филиалом (scope_to_branch)
+                mark_sold_stmt = update(UnclaimedItem).where(
+                    UnclaimedItem.Артикул == article_id,
+                    UnclaimedItem.Продан == False
+                ).values(Продан=True).returning(UnclaimedItem.Филиал)
+                item_branch_id = (await session.execute(mark_sold_stmt)).scalar_one_or_none()
+                if item_branch_id is None:
+                    await session.rollback()
+                    await flash('Товар не найден или уже был продан ранее', 'error')
                     return redirect(url_for('add_sale'))
                 
-                # Получаем следующий код продажи
-                max_code_result = await session.execute(select(func.max(Sale.Код_продажи)))
-                max_code = max_code_result.scalar() or 0
-                next_code = max_code + 1
+                # Следующий код продажи - из последовательности, общей для всех филиалов
+                next_code = (await session.execute(select(SALE_CODE_SEQUENCE.next_value()))).scalar_one()
                 
                 sale = Sale(
                     Код_продажи=next_code,
                     Дата_продажи=datetime.strptime(form['date'], '%Y-%m-%d').date(),
                     Артикул_проданного_товара=article_id,
-                    Продавец=int(form['seller_id'])
+                    Продавец=int(form['seller_id']),
+                    Филиал=item_branch_id  # Продажа учитывается в филиале, где находится товар
                 )
                 session.add(sale)
+                audit(session, 'Продажа', 'Невостребованный_товар', article_id, new_value=f'Продажа {next_code}')
                 await session.commit()
                 await flash('Продажа успешно добавлена', 'success')
                 return redirect(url_for('sales'))
@@ -1189,18 +2196,17 @@ async def add_sale():
             await flash(f'Ошибка при добавлении продажи: {error_message}', 'error')
             return redirect(url_for('add_sale'))
     
-    async with async_session_maker() as session:
-        # Показываем только непроданные товары
-        sold_stmt = select(Sale.Артикул_проданного_товара)
-        sold_result = await session.execute(sold_stmt)
-        sold_article_ids = [sale[0] for sale in sold_result.all()]
-        
-        if sold_article_ids:
-            unclaimed_stmt = select(UnclaimedItem).where(~UnclaimedItem.Артикул.in_(sold_article_ids))
-        else:
-            unclaimed_stmt = select(UnclaimedItem)
+    async with request_session() as session:
+        # Показываем только непроданные товары (частичный индекс по признаку продажи)
+        unclaimed_stmt = select(
+            UnclaimedItem.Артикул,
+            UnclaimedItem.Оценочная_стоимость,
+            Product.Наименование.label('Наименование_товара')
+        ).join(Loan, UnclaimedItem.Займ == Loan.Код_займа).join(Product, Loan.Товар == Product.ID_товара).where(
+            UnclaimedItem.Продан == False
+        ).order_by(UnclaimedItem.Артикул)
         unclaimed_result = await session.execute(unclaimed_stmt)
-        unclaimed_items = unclaimed_result.scalars().all()
+        unclaimed_items = unclaimed_result.all()
         
         employees_stmt = select(Employee).where(
             Employee.Должность == 'Менеджер по продажам',
@@ -1212,6 +2218,11 @@ async def add_sale():
     return await render_template('add_sale.html', unclaimed_items=unclaimed_items, employees=employees)
 
 # ========== СОТРУДНИКИ ==========
+async def load_branches() -> list:
+    """Филиалы для выбора в формах сотрудника"""
+    async with request_session() as session:
+        return (await session.execute(select(Branch.ID_филиала, Branch.Название).order_by(Branch.Название))).all()
+
 @app.route('/employees')
 @login_required
 @permission_required('view_employees')
@@ -1224,8 +2235,8 @@ async def employees():
     sort_by = request.args.get('sort', 'ID_Сотрудника')
     sort_order = request.args.get('order', 'asc')
     
-    async with async_session_maker() as session:
-        stmt = select(Employee)
+    async with request_session() as session:
+        stmt = select(Employee).options(raiseload(Employee.loans), raiseload(Employee.sales))
         
         # Применяем поиск
         if search:
@@ -1298,9 +2309,9 @@ async def add_employee():
     if request.method == 'POST':
         try:
             form = await request.form
-            async with async_session_maker() as session:
+            async with request_session() as session:
                 # Проверяем, что логин уникален
-                stmt = select(Employee).where(Employee.Логин == form['login'])
+                stmt = select(Employee).where(Employee.Логин == form['login']).execution_options(all_branches=True)
                 result = await session.execute(stmt)
                 existing_employee = result.scalar_one_or_none()
                 if existing_employee:
@@ -1309,20 +2320,22 @@ async def add_employee():
                 
                 # Проверяем, что не создается второй администратор
                 if form['position'] == 'Администратор':
-                    admin_stmt = select(Employee).where(Employee.Должность == 'Администратор')
+                    admin_stmt = select(Employee).where(Employee.Должность == 'Администратор').execution_options(all_branches=True)
                     admin_result = await session.execute(admin_stmt)
                     existing_admin = admin_result.scalar_one_or_none()
                     if existing_admin:
                         await flash('Администратор уже существует. Может быть только один администратор.', 'error')
                         return redirect(url_for('add_employee'))
                 
-                # Получаем следующий ID сотрудника
-                max_id_result = await session.execute(select(func.max(Employee.ID_Сотрудника)))
+                # Получаем следующий ID сотрудника (ключи сквозные для всех филиалов)
+                max_id_result = await session.execute(
+                    select(func.max(Employee.ID_Сотрудника)).execution_options(all_branches=True)
+                )
                 max_id = max_id_result.scalar() or 0
                 next_id = max_id + 1
                 
                 # Хешируем пароль
-                hashed_password = generate_password_hash(form['password'])
+                hashed_password = await hash_password(form['password'])
                 
                 employee = Employee(
                     ID_Сотрудника=next_id,
@@ -1331,7 +2344,8 @@ async def add_employee():
                     Дата_Приёма=datetime.strptime(form['hire_date'], '%Y-%m-%d').date(),
                     Телефон_Сотрудника=form['phone'],
                     Логин=form['login'],
-                    Пароль=hashed_password
+                    Пароль=hashed_password,
+                    Филиал=int(form['branch_id'])
                 )
                 session.add(employee)
                 await session.commit()
@@ -1342,13 +2356,13 @@ async def add_employee():
             error_message = extract_db_error_message(e)
             await flash(f'Ошибка при добавлении сотрудника: {error_message}', 'error')
             return redirect(url_for('add_employee'))
-    return await render_template('add_employee.html')
+    return await render_template('add_employee.html', branches=await load_branches())
 
 @app.route('/employees/<int:id>/edit', methods=['GET', 'POST'])
 @login_required
 @permission_required('edit_employees')
 async def edit_employee(id):
-    async with async_session_maker() as session:
+    async with request_session() as session:
         employee = await session.get(Employee, id)
         if not employee:
             await flash('Сотрудник не найден', 'error')
@@ -1360,7 +2374,7 @@ async def edit_employee(id):
                 
                 # Проверяем, что логин уникален (если изменился)
                 if form['login'] != employee.Логин:
-                    stmt = select(Employee).where(Employee.Логин == form['login'])
+                    stmt = select(Employee).where(Employee.Логин == form['login']).execution_options(all_branches=True)
                     result = await session.execute(stmt)
                     existing_employee = result.scalar_one_or_none()
                     if existing_employee:
@@ -1369,7 +2383,7 @@ async def edit_employee(id):
                 
                 # Проверяем, что не создается второй администратор (если меняется должность)
                 if form['position'] == 'Администратор' and employee.Должность != 'Администратор':
-                    admin_stmt = select(Employee).where(Employee.Должность == 'Администратор')
+                    admin_stmt = select(Employee).where(Employee.Должность == 'Администратор').execution_options(all_branches=True)
                     admin_result = await session.execute(admin_stmt)
                     existing_admin = admin_result.scalar_one_or_none()
                     if existing_admin:
@@ -1382,10 +2396,14 @@ async def edit_employee(id):
                 employee.Дата_Приёма = datetime.strptime(form['hire_date'], '%Y-%m-%d').date()
                 employee.Телефон_Сотрудника = form['phone']
                 employee.Логин = form['login']
+                if employee.Филиал != int(form['branch_id']):
+                    employee.Филиал = int(form['branch_id'])
+                    # Филиал определяет доступные сотруднику данные - кешированный объект устарел
+                    _user_cache.pop(str(id), None)
                 
                 # Обновляем пароль только если он указан
                 if form.get('password'):
-                    employee.Пароль = generate_password_hash(form['password'])
+                    employee.Пароль = await hash_password(form['password'])
                 
                 await session.commit()
                 await flash('Сотрудник успешно обновлен', 'success')
@@ -1397,13 +2415,13 @@ async def edit_employee(id):
                 # Перезагружаем сотрудника для отображения формы
                 await session.refresh(employee)
         
-        return await render_template('edit_employee.html', employee=employee)
+        return await render_template('edit_employee.html', employee=employee, branches=await load_branches())
 
 @app.route('/employees/<int:id>/dismiss', methods=['POST'])
 @login_required
 @permission_required('dismiss_employees')
 async def dismiss_employee(id):
-    async with async_session_maker() as session:
+    async with request_session() as session:
         employee = await session.get(Employee, id)
         if not employee:
             await flash('Сотрудник не найден', 'error')
@@ -1416,6 +2434,7 @@ async def dismiss_employee(id):
         
         try:
             employee.Дата_Увольнения = datetime.now().date()
+            audit(session, 'Увольнение', 'Сотрудник', id, new_value=employee.Дата_Увольнения)
             await session.commit()
             await flash('Сотрудник уволен', 'success')
         except Exception as e:
@@ -1429,72 +2448,284 @@ async def dismiss_employee(id):
 @login_required
 @permission_required('view_reports')
 async def reports():
-    async with async_session_maker() as session:
-        # Получаем все года, для которых есть займы или продажи
-        loan_years_stmt = select(distinct(extract('year', Loan.Дата_займа).label('year')))
-        loan_years_result = await session.execute(loan_years_stmt)
-        loan_years = loan_years_result.all()
-        
-        sale_years_stmt = select(distinct(extract('year', Sale.Дата_продажи).label('year')))
-        sale_years_result = await session.execute(sale_years_stmt)
-        sale_years = sale_years_result.all()
-        
-        # Объединяем и получаем уникальные года
-        all_years = set()
-        for year_tuple in loan_years:
-            if year_tuple[0]:
-                all_years.add(int(year_tuple[0]))
-        for year_tuple in sale_years:
-            if year_tuple[0]:
-                all_years.add(int(year_tuple[0]))
-        
-        # Сортируем года по убыванию
-        available_years = sorted(all_years, reverse=True) if all_years else [datetime.now().year]
-        
-        # Для каждого года определяем кварталы с данными
-        year_quarters = {}
-        for year in available_years:
-            quarters = set()
-            
-            # Проверяем займы
-            for quarter in range(1, 5):
-                if quarter == 1:
-                    start_date = date(year, 1, 1)
-                    end_date = date(year, 3, 31)
-                elif quarter == 2:
-                    start_date = date(year, 4, 1)
-                    end_date = date(year, 6, 30)
-                elif quarter == 3:
-                    start_date = date(year, 7, 1)
-                    end_date = date(year, 9, 30)
-                else:
-                    start_date = date(year, 10, 1)
-                    end_date = date(year, 12, 31)
-                
-                # Проверяем, есть ли займы или продажи в этом квартале
-                has_loans_stmt = select(Loan).where(
-                    Loan.Дата_займа >= start_date,
-                    Loan.Дата_займа <= end_date
-                ).limit(1)
-                has_loans_result = await session.execute(has_loans_stmt)
-                has_loans = has_loans_result.scalar_one_or_none() is not None
-                
-                has_sales_stmt = select(Sale).where(
-                    Sale.Дата_продажи >= start_date,
-                    Sale.Дата_продажи <= end_date
-                ).limit(1)
-                has_sales_result = await session.execute(has_sales_stmt)
-                has_sales = has_sales_result.scalar_one_or_none() is not None
-                
-                if has_loans or has_sales:
-                    quarters.add(quarter)
-            
-            if quarters:
-                year_quarters[year] = sorted(list(quarters))
+    # Получаем все года, для которых есть займы или продажи
+    loan_years_stmt = select(distinct(extract('year', Loan.Дата_займа).label('year')))
+    sale_years_stmt = select(distinct(extract('year', Sale.Дата_продажи).label('year')))
+    loan_years_result, sale_years_result = await gather_queries(loan_years_stmt, sale_years_stmt)
+    
+    # Объединяем и получаем уникальные года
+    all_years = set()
+    for year_tuple in loan_years_result.all() + sale_years_result.all():
+        if year_tuple[0]:
+            all_years.add(int(year_tuple[0]))
+    
+    # Сортируем года по убыванию
+    available_years = sorted(all_years, reverse=True) if all_years else [datetime.now().year]
+    
+    # Для каждого года и квартала проверяем, есть ли займы или продажи - все проверки параллельно
+    quarter_bounds = {1: ((1, 1), (3, 31)), 2: ((4, 1), (6, 30)), 3: ((7, 1), (9, 30)), 4: ((10, 1), (12, 31))}
+    probes = []
+    probe_statements = []
+    for year in available_years:
+        for quarter, ((start_month, start_day), (end_month, end_day)) in quarter_bounds.items():
+            start_date = date(year, start_month, start_day)
+            end_date = date(year, end_month, end_day)
+            probes.append((year, quarter))
+            probe_statements.append(select(
+                exists().where(Loan.Дата_займа >= start_date, Loan.Дата_займа <= end_date) |
+                exists().where(Sale.Дата_продажи >= start_date, Sale.Дата_продажи <= end_date)
+            ))
+    probe_results = await gather_queries(*probe_statements)
+    
+    year_quarters = {}
+    for (year, quarter), result in zip(probes, probe_results):
+        if result.scalar():
+            year_quarters.setdefault(year, []).append(quarter)
     
     return await render_template('reports.html', available_years=available_years, year_quarters=year_quarters)
 
+# Кеш отчетов: ключ -> (дата расчета, данные). Значения действительны до конца дня,
+# так как статусы займов меняются ежедневной проверкой просрочки. Ключи включают даты из запроса,
+# поэтому размер кеша ограничен REPORT_CACHE_SIZE: порядок записей - от давно запрошенных к недавним
+_report_cache = OrderedDict()
+
+def get_cached_report(key):
+    """Возвращает рассчитанный сегодня отчет из кеша или None"""
+    cached = _report_cache.get(key)
+    if cached and cached[0] == date.today():
+        _report_cache.move_to_end(key)
+        return cached[1]
+    return None
+
+def set_cached_report(key, value):
+    """Сохраняет отчет в кеш, удаляя записи, рассчитанные в предыдущие дни, и давно не запрошенные
+    сверх REPORT_CACHE_SIZE"""
+    today = date.today()
+    for stale_key in [k for k, (day, _) in _report_cache.items() if day != today]:
+        _report_cache.pop(stale_key, None)
+    _report_cache[key] = (today, value)
+    _report_cache.move_to_end(key)
+    while len(_report_cache) > config_obj.REPORT_CACHE_SIZE:
+        _report_cache.popitem(last=False)
+
+# Допустимые периоды группировки отчетов (значения для date_trunc)
+REPORT_PERIODS = {
+    'month': 'Месяц',
+    'quarter': 'Квартал',
+    'year': 'Год'
+}
+
+def period_start(day: date, period: str) -> date:
+    """Начало периода (дня, недели, месяца, квартала или года), в который попадает дата"""
+    if period == 'day':
+        return day
+    if period == 'week':
+        return day - timedelta(days=day.weekday())
+    if period == 'year':
+        return day.replace(month=1, day=1)
+    if period == 'quarter':
+        return day.replace(month=3 * ((day.month - 1) // 3) + 1, day=1)
+    return day.replace(day=1)
+
+def employee_performance_stmt(period: str, date_from: date, date_to: date):
+    """Показатели сотрудников по периодам: выданные займы и их просрочка по Займ.Исполнитель,
+    продажи по Продажа.Продавец. Места и доли считаются оконными функциями внутри периода."""
+    # Период подставляется литералом (только из REPORT_PERIODS), чтобы выражение
+    # в SELECT и GROUP BY совпадало
+    trunc_period = literal_column(f"'{period}'")
+    loan_period = cast(func.date_trunc(trunc_period, Loan.Дата_займа), Date)
+    loans_sq = select(
+        Loan.Исполнитель.label('employee_id'),
+        loan_period.label('period'),
+        func.count(Loan.Код_займа).label('loans_issued'),
+        func.sum(Loan.Размер_займа).label('principal_issued'),
+        func.count(Loan.Код_займа).filter(Loan.Статус_займа == 'Просрочен').label('overdue_loans')
+    ).where(
+        Loan.Дата_займа >= date_from,
+        Loan.Дата_займа <= date_to
+    ).group_by(Loan.Исполнитель, loan_period).subquery()
+    
+    sale_period = cast(func.date_trunc(trunc_period, Sale.Дата_продажи), Date)
+    sales_sq = select(
+        Sale.Продавец.label('employee_id'),
+        sale_period.label('period'),
+        func.count(Sale.Код_продажи).label('items_sold'),
+        func.sum(UnclaimedItem.Оценочная_стоимость).label('sales_value')
+    ).join(UnclaimedItem, Sale.Артикул_проданного_товара == UnclaimedItem.Артикул).where(
+        Sale.Дата_продажи >= date_from,
+        Sale.Дата_продажи <= date_to
+    ).group_by(Sale.Продавец, sale_period).subquery()
+    
+    employee_id = func.coalesce(loans_sq.c.employee_id, sales_sq.c.employee_id)
+    row_period = func.coalesce(loans_sq.c.period, sales_sq.c.period)
+    loans_issued = func.coalesce(loans_sq.c.loans_issued, 0)
+    principal_issued = func.coalesce(loans_sq.c.principal_issued, 0)
+    sales_value = func.coalesce(sales_sq.c.sales_value, 0)
+    
+    joined = loans_sq.join(
+        sales_sq,
+        and_(loans_sq.c.employee_id == sales_sq.c.employee_id, loans_sq.c.period == sales_sq.c.period),
+        full=True
+    )
+    return select(
+        row_period.label('period'),
+        Employee.ID_Сотрудника,
+        Employee.ФИО_Сотрудника,
+        Employee.Должность,
+        loans_issued.label('loans_issued'),
+        principal_issued.label('principal_issued'),
+        (cast(func.coalesce(loans_sq.c.overdue_loans, 0), Numeric) / func.nullif(loans_issued, 0)).label('overdue_rate'),
+        func.coalesce(sales_sq.c.items_sold, 0).label('items_sold'),
+        sales_value.label('sales_value'),
+        func.rank().over(partition_by=row_period, order_by=principal_issued.desc()).label('principal_rank'),
+        (principal_issued / func.nullif(func.sum(principal_issued).over(partition_by=row_period), 0)).label('principal_share'),
+        func.rank().over(partition_by=row_period, order_by=sales_value.desc()).label('sales_rank')
+    ).select_from(joined).join(
+        Employee, Employee.ID_Сотрудника == employee_id
+    ).order_by(row_period.desc(), principal_issued.desc(), Employee.ID_Сотрудника)
+
+@app.route('/reports/employees')
+@login_required
+@permission_required('view_reports')
+async def employee_report():
+    """Отчет о результативности сотрудников по периодам"""
+    period = request.args.get('period', 'month')
+    if period not in REPORT_PERIODS:
+        period = 'month'
+    today = date.today()
+    try:
+        date_from = datetime.strptime(request.args.get('date_from', ''), '%Y-%m-%d').date()
+    except ValueError:
+        date_from = today.replace(month=1, day=1)
+    try:
+        date_to = datetime.strptime(request.args.get('date_to', ''), '%Y-%m-%d').date()
+    except ValueError:
+        date_to = today
+    date_from = period_start(date_from, period)
+    
+    # Закрытые периоды (до начала текущего) берем из кеша, текущий считаем всегда
+    open_from = period_start(today, period)
+    closed_to = min(date_to, open_from - timedelta(days=1))
+    rows = []
+    async with request_session() as session:
+        if date_from <= closed_to:
+            cache_key = ('employee_performance', current_branch_id(), period, date_from, closed_to)
+            closed_rows = get_cached_report(cache_key)
+            if closed_rows is None:
+                result = await session.execute(employee_performance_stmt(period, date_from, closed_to))
+                closed_rows = result.all()
+                set_cached_report(cache_key, closed_rows)
+            rows.extend(closed_rows)
+        if date_to >= open_from:
+            result = await session.execute(employee_performance_stmt(period, max(date_from, open_from), date_to))
+            rows[:0] = result.all()
+    
+    # Группируем строки по периодам (от новых к старым)
+    periods = {}
+    for row in rows:
+        periods.setdefault(row.period, []).append(row)
+    
+    return await render_template('employee_report.html', periods=periods, period=period,
+                          report_periods=REPORT_PERIODS, date_from=date_from, date_to=date_to)
+
+# Интервалы старения портфеля: (ключ, название, минимум, максимум) по числу дней до даты окончания займа;
+# отрицательные значения - дни просрочки
+AGING_BUCKETS = [
+    ('due_0_7', 'Срок через 0–7 дн.', 0, 7),
+    ('due_8_30', 'Срок через 8–30 дн.', 8, 30),
+    ('due_31_90', 'Срок через 31–90 дн.', 31, 90),
+    ('due_later', 'Срок позже 90 дн.', 91, None),
+    ('overdue_1_30', 'Просрочка 1–30 дн.', -30, -1),
+    ('overdue_31_90', 'Просрочка 31–90 дн.', -90, -31),
+    ('overdue_90_plus', 'Просрочка более 90 дн.', None, -91)
+]
+
+async def build_aging_report(session, today: date) -> dict:
+    """Основной долг невыплаченных займов по интервалам до/после даты окончания
+    в разрезе категорий и сотрудников - один запрос с GROUPING SETS"""
+    days_to_due = (loan_end_date_expr() - literal(today, Date)).label('days_to_due')
+    loans_sq = select(
+        Product.Категория.label('category_id'),
+        Loan.Исполнитель.label('employee_id'),
+        Employee.ФИО_Сотрудника.label('employee_name'),
+        Loan.Размер_займа.label('principal'),
+        days_to_due
+    ).join(Product, Loan.Товар == Product.ID_товара).join(Employee, Loan.Исполнитель == Employee.ID_Сотрудника).where(
+        Loan.Статус_займа != 'Выплачен'
+    ).subquery()
+    
+    bucket_columns = []
+    for key, _, min_days, max_days in AGING_BUCKETS:
+        condition = []
+        if min_days is not None:
+            condition.append(loans_sq.c.days_to_due >= min_days)
+        if max_days is not None:
+            condition.append(loans_sq.c.days_to_due <= max_days)
+        bucket_columns.append(func.coalesce(func.sum(loans_sq.c.principal).filter(and_(*condition)), 0).label(key))
+    
+    # Группировка по целочисленному ключу категории; названия подставляются после агрегации
+    employee_key = tuple_(loans_sq.c.employee_id, loans_sq.c.employee_name)
+    aging_sq = select(
+        loans_sq.c.category_id,
+        loans_sq.c.employee_id,
+        loans_sq.c.employee_name,
+        func.grouping(loans_sq.c.category_id, loans_sq.c.employee_id).label('grouping'),
+        func.count().label('loans'),
+        func.sum(loans_sq.c.principal).label('principal'),
+        *bucket_columns
+    ).group_by(func.grouping_sets(
+        tuple_(loans_sq.c.category_id, loans_sq.c.employee_id, loans_sq.c.employee_name),
+        tuple_(loans_sq.c.category_id),
+        employee_key,
+        tuple_()
+    )).subquery()
+    aging_stmt = select(aging_sq, ItemCategory.Название.label('category')).outerjoin(
+        ItemCategory, aging_sq.c.category_id == ItemCategory.ID_категории
+    ).order_by(ItemCategory.Название, aging_sq.c.employee_name)
+    
+    # grouping: 0 - категория и сотрудник, 1 - итог по категории, 2 - итог по сотруднику, 3 - общий итог
+    sections = {0: 'details', 1: 'categories', 2: 'employees', 3: 'total'}
+    report = {'as_of': today.isoformat(), 'details': [], 'categories': [], 'employees': [], 'total': []}
+    for row in (await session.execute(aging_stmt)).all():
+        data = {
+            'category': row.category,
+            'employee_id': row.employee_id,
+            'employee_name': row.employee_name,
+            'loans': row.loans,
+            'principal': row.principal
+        }
+        data.update({key: getattr(row, key) for key, _, _, _ in AGING_BUCKETS})
+        report[sections[row.grouping]].append(data)
+    return report
+
+async def get_aging_report() -> dict:
+    """Отчет о старении портфеля, рассчитывается не чаще раза в день"""
+    today = date.today()
+    cache_key = ('aging', current_branch_id(), today)
+    report = get_cached_report(cache_key)
+    if report is None:
+        async with request_session() as session:
+            report = await build_aging_report(session, today)
+        set_cached_report(cache_key, report)
+    return report
+
+@app.route('/reports/aging')
+@login_required
+@permission_required('view_reports')
+async def aging_report():
+    """Старение портфеля займов по срокам погашения и просрочки"""
+    report = await get_aging_report()
+    return await render_template('aging_report.html', report=report, buckets=AGING_BUCKETS)
+
+@app.route('/api/reports/aging')
+@login_required
+@permission_required('view_reports')
+async def aging_report_api():
+    return jsonify(await get_aging_report())
+
 @app.route('/api/reports/quarterly')
+@login_required
+@permission_required('view_reports')
 async def quarterly_report():
     quarter = request.args.get('quarter', '1')
     year = request.args.get('year', datetime.now().year)
@@ -1513,7 +2744,7 @@ async def quarterly_report():
         start_date = datetime(int(year), 10, 1)
         end_date = datetime(int(year), 12, 31)
     
-    async with async_session_maker() as session:
+    async with request_session() as session:
         loans_stmt = select(Loan).where(
             Loan.Дата_займа >= start_date.date(),
             Loan.Дата_займа <= end_date.date()
@@ -1521,21 +2752,22 @@ async def quarterly_report():
         loans_result = await session.execute(loans_stmt)
         loans = loans_result.scalars().all()
         
-        sales_stmt = select(Sale).where(
+        # Количество и сумма продаж одним запросом
+        sales_stmt = select(
+            func.count(Sale.Код_продажи),
+            func.coalesce(func.sum(UnclaimedItem.Оценочная_стоимость), 0)
+        ).outerjoin(UnclaimedItem, Sale.Артикул_проданного_товара == UnclaimedItem.Артикул).where(
             Sale.Дата_продажи >= start_date.date(),
             Sale.Дата_продажи <= end_date.date()
         )
-        sales_result = await session.execute(sales_stmt)
-        sales = sales_result.scalars().all()
+        sales_count, sales_amount = (await session.execute(sales_stmt)).one()
         
-        # Расчет суммы продаж
-        sales_amount = 0.0
-        for sale in sales:
-            item_stmt = select(UnclaimedItem).where(UnclaimedItem.Артикул == sale.Артикул_проданного_товара)
-            item_result = await session.execute(item_stmt)
-            item = item_result.scalar_one_or_none()
-            if item:
-                sales_amount += float(item.Оценочная_стоимость)
+        # Портфель на конец квартала - по истории статусов, а не по текущим статусам
+        status_sq = loan_status_as_of(end_date.date())
+        end_statuses_stmt = select(status_sq.c.Статус, func.count()).join(
+            Loan, Loan.Код_займа == status_sq.c.Займ
+        ).group_by(status_sq.c.Статус)
+        end_statuses = dict((await session.execute(end_statuses_stmt)).all())
     
     report_data = {
         'quarter': quarter,
@@ -1544,20 +2776,765 @@ async def quarterly_report():
         'total_loan_amount': sum(float(loan.Размер_займа) for loan in loans),
         'paid_loans': len([l for l in loans if l.Статус_займа == 'Выплачен']),
         'overdue_loans': len([l for l in loans if l.Статус_займа == 'Просрочен']),
-        'total_sales': len(sales),
-        'sales_amount': sales_amount
+        'active_at_end': end_statuses.get('Активен', 0),
+        'overdue_at_end': end_statuses.get('Просрочен', 0),
+        'total_sales': sales_count,
+        'sales_amount': float(sales_amount)
     }
     
     return jsonify(report_data)
 
 @app.route('/api/reports/loans-status')
+@login_required
+@permission_required('view_reports')
 async def loans_status_report():
-    async with async_session_maker() as session:
-        statuses_stmt = select(Loan.Статус_займа, func.count(Loan.Код_займа)).group_by(Loan.Статус_займа)
+    """Количество займов по статусам: текущим или, с параметром as_of (ГГГГ-ММ-ДД), на указанную дату
+    по истории статусов"""
+    try:
+        as_of = datetime.strptime(request.args.get('as_of', ''), '%Y-%m-%d').date()
+    except ValueError:
+        as_of = None
+    async with request_session() as session:
+        if as_of is None:
+            statuses_stmt = select(Loan.Статус_займа, func.count(Loan.Код_займа)).group_by(Loan.Статус_займа)
+        else:
+            # Соединение с займами оставляет в отчете только займы филиала пользователя
+            status_sq = loan_status_as_of(as_of)
+            statuses_stmt = select(status_sq.c.Статус, func.count()).join(
+                Loan, Loan.Код_займа == status_sq.c.Займ
+            ).group_by(status_sq.c.Статус)
         statuses_result = await session.execute(statuses_stmt)
         statuses = statuses_result.all()
     return jsonify([{'status': s[0], 'count': s[1]} for s in statuses])
 
+@app.route('/api/reports/portfolio')
+@login_required
+@permission_required('view_reports')
+async def portfolio_report():
+    """Сумма к возврату по всем невыплаченным займам на дату (по умолчанию - сегодня).
+    Денежные суммы возвращаются строками без потери точности."""
+    try:
+        as_of = datetime.strptime(request.args.get('as_of', ''), '%Y-%m-%d').date()
+    except ValueError:
+        as_of = date.today()
+    
+    accrued_interest, total_due = loan_accrual_columns(as_of)
+    async with request_session() as session:
+        portfolio_stmt = select(
+            Loan.Статус_займа,
+            func.count(Loan.Код_займа),
+            func.sum(Loan.Размер_займа),
+            func.sum(accrued_interest),
+            func.sum(total_due)
+        ).join(
+            InterestRate, Loan.Процент_по_займу == InterestRate.Индекс_процента
+        ).where(Loan.Статус_займа != 'Выплачен').group_by(Loan.Статус_займа)
+        portfolio_result = await session.execute(portfolio_stmt)
+        statuses = portfolio_result.all()
+    
+    totals = {
+        'loans': sum(s[1] for s in statuses),
+        'principal': sum((s[2] for s in statuses), Decimal('0')),
+        'accrued_interest': sum((s[3] for s in statuses), Decimal('0')),
+        'total_due': sum((s[4] for s in statuses), Decimal('0'))
+    }
+    return jsonify({
+        'as_of': as_of.isoformat(),
+        'statuses': [{
+            'status': s[0],
+            'loans': s[1],
+            'principal': s[2],
+            'accrued_interest': s[3],
+            'total_due': s[4]
+        } for s in statuses],
+        'totals': totals
+    })
+
+@app.route('/api/reports/stock')
+@login_required
+@permission_required('view_reports')
+async def stock_report():
+    """Количество и оценочная стоимость невостребованных товаров в наличии и проданных"""
+    async with request_session() as session:
+        stock_stmt = select(
+            UnclaimedItem.Продан,
+            func.count(UnclaimedItem.Артикул),
+            func.coalesce(func.sum(UnclaimedItem.Оценочная_стоимость), 0)
+        ).group_by(UnclaimedItem.Продан)
+        stock_result = await session.execute(stock_stmt)
+        stock = {sold: (count, float(amount)) for sold, count, amount in stock_result.all()}
+    available_count, available_amount = stock.get(False, (0, 0.0))
+    sold_count, sold_amount = stock.get(True, (0, 0.0))
+    return jsonify({
+        'available_count': available_count,
+        'available_amount': available_amount,
+        'sold_count': sold_count,
+        'sold_amount': sold_amount
+    })
+
+@app.route('/api/reports/branches')
+@login_required
+@permission_required('view_reports')
+async def branches_report():
+    """Займы и продажи по филиалам за период (по умолчанию - с начала года) из дневной сводки.
+    Сотрудник филиала видит только свой филиал, администратор - все."""
+    today = date.today()
+    try:
+        date_from = datetime.strptime(request.args.get('date_from', ''), '%Y-%m-%d').date()
+    except ValueError:
+        date_from = today.replace(month=1, day=1)
+    try:
+        date_to = datetime.strptime(request.args.get('date_to', ''), '%Y-%m-%d').date()
+    except ValueError:
+        date_to = today
+    
+    summary_stmt = select(
+        Branch.ID_филиала,
+        Branch.Название,
+        func.coalesce(func.sum(BranchSummary.Выдано_займов), 0),
+        func.coalesce(func.sum(BranchSummary.Сумма_займов), 0),
+        func.coalesce(func.sum(BranchSummary.Продано_товаров), 0)
+    ).outerjoin(BranchSummary, and_(
+        BranchSummary.Филиал == Branch.ID_филиала,
+        BranchSummary.Дата >= date_from,
+        BranchSummary.Дата <= date_to
+    )).group_by(Branch.ID_филиала, Branch.Название).order_by(Branch.Название)
+    branch_id = current_branch_id()
+    if branch_id is not None:
+        summary_stmt = summary_stmt.where(Branch.ID_филиала == branch_id)
+    
+    async with request_session() as session:
+        rows = (await session.execute(summary_stmt)).all()
+    return jsonify({
+        'date_from': date_from.isoformat(),
+        'date_to': date_to.isoformat(),
+        'branches': [{
+            'id': row[0],
+            'name': row[1],
+            'loans_issued': row[2],
+            'principal_issued': float(row[3]),
+            'items_sold': row[4]
+        } for row in rows]
+    })
+
+# Временные ряды для графиков: метрика -> (название, столбец даты, агрегат).
+# Продажи оцениваются по оценочной стоимости проданного товара
+SERIES_METRICS = {
+    'loans': ('Выдано займов', Loan.Дата_займа, lambda: func.count(Loan.Код_займа)),
+    'principal': ('Сумма займов', Loan.Дата_займа, lambda: func.sum(Loan.Размер_займа)),
+    'sales': ('Продано товаров', Sale.Дата_продажи, lambda: func.count(Sale.Код_продажи)),
+    'sales_value': ('Сумма продаж', Sale.Дата_продажи, lambda: func.sum(UnclaimedItem.Оценочная_стоимость))
+}
+SERIES_BUCKETS = {
+    'day': relativedelta(days=1),
+    'week': relativedelta(weeks=1),
+    'month': relativedelta(months=1)
+}
+# Максимальное число точек ряда по умолчанию и верхняя граница параметра max_points
+SERIES_MAX_POINTS = 500
+SERIES_MAX_POINTS_LIMIT = 2000
+# Максимальное число интервалов в запрошенном периоде (около 10 лет по дням) - ряд строится
+# в обработчике запроса, поэтому длинные периоды нужно запрашивать крупными интервалами
+SERIES_MAX_BUCKETS = 3700
+
+def series_bucket_count(bucket: str, date_from: date, date_to: date) -> int:
+    """Число интервалов ряда от начала интервала date_from до date_to включительно"""
+    if bucket == 'month':
+        return (date_to.year - date_from.year) * 12 + date_to.month - date_from.month + 1
+    return (date_to - date_from).days // SERIES_BUCKETS[bucket].days + 1
+
+def series_stmt(metric: str, bucket: str, date_from: date, date_to: date):
+    """Значения метрики по интервалам одним запросом с date_trunc и GROUP BY"""
+    _, date_column, aggregate = SERIES_METRICS[metric]
+    # Интервал подставляется литералом (только из SERIES_BUCKETS), как в employee_performance_stmt
+    bucket_start = cast(func.date_trunc(literal_column(f"'{bucket}'"), date_column), Date)
+    stmt = select(bucket_start, aggregate()).where(
+        date_column >= date_from,
+        date_column <= date_to
+    ).group_by(bucket_start)
+    if metric == 'sales_value':
+        stmt = stmt.select_from(Sale).join(UnclaimedItem, Sale.Артикул_проданного_товара == UnclaimedItem.Артикул)
+    return stmt
+
+def downsample_series(points: list, max_points: int) -> tuple[list, int]:
+    """Объединяет соседние интервалы в группы, чтобы точек было не больше max_points.
+    Метрики аддитивны (количества и суммы), поэтому значения группы складываются и итог
+    за период не меняется. Возвращает точки и число интервалов в одной точке."""
+    group = -(-len(points) // max_points) if points else 1
+    if group <= 1:
+        return points, 1
+    return [
+        (points[i][0], sum((value for _, value in points[i:i + group]), 0))
+        for i in range(0, len(points), group)
+    ], group
+
+@app.route('/api/reports/series')
+@login_required
+@permission_required('view_reports')
+async def series_report():
+    """Ряд метрики (loans, principal, sales, sales_value) по дням, неделям или месяцам:
+    ?metric=...&bucket=day|week|month&date_from=ГГГГ-ММ-ДД&date_to=ГГГГ-ММ-ДД&max_points=N.
+    Интервалы без данных возвращаются с нулем; длинные ряды прореживаются до max_points точек."""
+    metric = request.args.get('metric', 'loans')
+    bucket = request.args.get('bucket', 'month')
+    if metric not in SERIES_METRICS or bucket not in SERIES_BUCKETS:
+        return api_response({'error': 'Некорректная метрика или интервал'}, 400)
+    max_points = request.args.get('max_points', SERIES_MAX_POINTS, type=int) or SERIES_MAX_POINTS
+    max_points = min(max(max_points, 2), SERIES_MAX_POINTS_LIMIT)
+    today = date.today()
+    try:
+        date_from = datetime.strptime(request.args.get('date_from', ''), '%Y-%m-%d').date()
+    except ValueError:
+        date_from = today - relativedelta(years=1)
+    try:
+        date_to = datetime.strptime(request.args.get('date_to', ''), '%Y-%m-%d').date()
+    except ValueError:
+        date_to = today
+    # Будущих данных нет: ряд заканчивается сегодняшним днем
+    date_to = min(date_to, today)
+    date_from = period_start(date_from, bucket)
+    if date_from > date_to:
+        return api_response({'error': 'Дата начала позже даты окончания'}, 400)
+    buckets = series_bucket_count(bucket, date_from, date_to)
+    if buckets > SERIES_MAX_BUCKETS:
+        return api_response({
+            'error': f'Слишком длинный период: {buckets} интервалов, максимум {SERIES_MAX_BUCKETS}. '
+                     f'Выберите интервал крупнее'
+        }, 400)
+    
+    # Закрытые интервалы (до начала текущего) берем из кеша, текущий считаем всегда
+    open_from = period_start(today, bucket)
+    closed_to = min(date_to, open_from - timedelta(days=1))
+    values = {}
+    async with request_session() as session:
+        if date_from <= closed_to:
+            cache_key = ('series', current_branch_id(), metric, bucket, date_from, closed_to)
+            closed_values = get_cached_report(cache_key)
+            if closed_values is None:
+                closed_values = dict((await session.execute(series_stmt(metric, bucket, date_from, closed_to))).all())
+                set_cached_report(cache_key, closed_values)
+            values.update(closed_values)
+        if date_to >= open_from:
+            result = await session.execute(series_stmt(metric, bucket, max(date_from, open_from), date_to))
+            values.update(result.all())
+    
+    points = []
+    start = date_from
+    while start <= date_to:
+        points.append((start, values.get(start) or 0))
+        start += SERIES_BUCKETS[bucket]
+    points, group = downsample_series(points, max_points)
+    return api_response({
+        'metric': metric,
+        'title': SERIES_METRICS[metric][0],
+        'bucket': bucket,
+        'buckets_per_point': group,
+        'date_from': date_from,
+        'date_to': date_to,
+        'points': [{'date': start, 'value': value} for start, value in points]
+    })
+
+# ========== ФОНОВЫЕ ОТЧЕТЫ ==========
+# Тяжелые отчеты (многолетние ряды, выгрузки) не строятся в обработчике запроса: интерфейс ставит
+# задание в очередь (таблица Задание_отчета) и опрашивает его статус. Фоновые воркеры каждого процесса
+# забирают задания через SELECT ... FOR UPDATE SKIP LOCKED, поэтому одно задание выполняет один воркер.
+# Результат записывается в файл в REPORT_RESULTS_DIR и хранится REPORT_RESULT_TTL_HOURS часов.
+# Задание, выполняющееся дольше этого срока, считается прерванным (процесс воркера остановлен)
+REPORT_JOB_STALE_AFTER = timedelta(hours=1)
+# Интервал удаления устаревших результатов в секундах
+REPORT_CLEANUP_INTERVAL = 600
+
+_report_job_submitted = asyncio.Event()
+_report_tasks: list[asyncio.Task] = []
+
+def report_result_path(filename: str) -> str:
+    return os.path.join(config_obj.REPORT_RESULTS_DIR, filename)
+
+def parse_date_param(data: dict, name: str) -> date | None:
+    """Дата ГГГГ-ММ-ДД из параметров задания; некорректное значение - ValueError"""
+    value = data.get(name)
+    return datetime.strptime(value, '%Y-%m-%d').date() if value else None
+
+def quarterly_series_params(data: dict) -> dict:
+    this_year = date.today().year
+    year_from = int(data.get('year_from') or this_year - 4)
+    year_to = int(data.get('year_to') or this_year)
+    if year_from > year_to or year_to - year_from > 50:
+        raise ValueError('Некорректный диапазон лет')
+    return {'year_from': year_from, 'year_to': year_to}
+
+def loans_export_params(data: dict) -> dict:
+    status = data.get('status') or None
+    if status is not None and status not in ('Активен', 'Просрочен', 'Выплачен'):
+        raise ValueError('Некорректный статус займа')
+    date_from, date_to = parse_date_param(data, 'date_from'), parse_date_param(data, 'date_to')
+    return {
+        'status': status,
+        'date_from': date_from.isoformat() if date_from else None,
+        'date_to': date_to.isoformat() if date_to else None
+    }
+
+def write_bytes(path: str, data: bytes):
+    with open(path, 'wb') as file:
+        file.write(data)
+
+async def write_csv(path: str, header: list, batches):
+    """Записывает CSV (разделитель ';', UTF-8 с BOM для Excel) из асинхронного итератора пакетов строк.
+    Запись в файл выполняется в потоке, чтобы не блокировать цикл событий"""
+    file = await asyncio.to_thread(open, path, 'w', newline='', encoding='utf-8-sig')
+    try:
+        writer = csv.writer(file, delimiter=';')
+        await asyncio.to_thread(writer.writerow, header)
+        async for rows in batches:
+            await asyncio.to_thread(writer.writerows, rows)
+    finally:
+        await asyncio.to_thread(file.close)
+
+async def run_aging_job(session, params: dict, path: str):
+    """Старение портфеля на сегодня в JSON"""
+    report = await build_aging_report(session, date.today())
+    data = orjson.dumps(report, default=orjson_default, option=orjson.OPT_INDENT_2)
+    await asyncio.to_thread(write_bytes, path, data)
+
+async def run_quarterly_series_job(session, params: dict, path: str):
+    """Займы и продажи по кварталам за несколько лет: по одному запросу с GROUP BY на таблицу"""
+    start_date = date(params['year_from'], 1, 1)
+    end_date = date(params['year_to'], 12, 31)
+    loan_quarter = func.date_trunc('quarter', Loan.Дата_займа).label('quarter')
+    loans_stmt = select(
+        loan_quarter,
+        func.count(Loan.Код_займа),
+        func.sum(Loan.Размер_займа),
+        func.count(Loan.Код_займа).filter(Loan.Статус_займа == 'Выплачен'),
+        func.count(Loan.Код_займа).filter(Loan.Статус_займа == 'Просрочен')
+    ).where(Loan.Дата_займа >= start_date, Loan.Дата_займа <= end_date).group_by(loan_quarter)
+    sale_quarter = func.date_trunc('quarter', Sale.Дата_продажи).label('quarter')
+    sales_stmt = select(
+        sale_quarter,
+        func.count(Sale.Код_продажи),
+        func.coalesce(func.sum(UnclaimedItem.Оценочная_стоимость), 0)
+    ).outerjoin(UnclaimedItem, Sale.Артикул_проданного_товара == UnclaimedItem.Артикул).where(
+        Sale.Дата_продажи >= start_date, Sale.Дата_продажи <= end_date
+    ).group_by(sale_quarter)
+    loans = {row[0].date(): row[1:] for row in (await session.execute(loans_stmt)).all()}
+    sales = {row[0].date(): row[1:] for row in (await session.execute(sales_stmt)).all()}
+    
+    rows = []
+    for year in range(params['year_from'], params['year_to'] + 1):
+        for quarter in range(1, 5):
+            start = date(year, quarter * 3 - 2, 1)
+            loan_count, loan_amount, paid, overdue = loans.get(start, (0, 0, 0, 0))
+            sale_count, sale_amount = sales.get(start, (0, 0))
+            rows.append([year, quarter, loan_count, loan_amount or 0, paid, overdue, sale_count, sale_amount])
+    
+    async def batches():
+        yield rows
+    
+    await write_csv(path, ['Год', 'Квартал', 'Займов', 'Сумма займов', 'Выплачено', 'Просрочено',
+                           'Продаж', 'Сумма продаж'], batches())
+
+async def run_loans_export_job(session, params: dict, path: str):
+    """Выгрузка займов в CSV: строки читаются с сервера пакетами и сразу пишутся в файл"""
+    today = date.today()
+    stmt = select(*loan_row_columns(today)).join(
+        Client, Loan.Клиент == Client.ID_Клиента
+    ).join(Product, Loan.Товар == Product.ID_товара).join(
+        InterestRate, Loan.Процент_по_займу == InterestRate.Индекс_процента
+    ).order_by(Loan.Код_займа)
+    if params.get('status'):
+        stmt = stmt.where(Loan.Статус_займа == params['status'])
+    if params.get('date_from'):
+        stmt = stmt.where(Loan.Дата_займа >= date.fromisoformat(params['date_from']))
+    if params.get('date_to'):
+        stmt = stmt.where(Loan.Дата_займа <= date.fromisoformat(params['date_to']))
+    
+    result = await session.stream(stmt.execution_options(yield_per=1000))
+    await write_csv(path, ['Код займа', 'Дата займа', 'Клиент', 'Размер займа', 'Срок (мес.)', 'Статус',
+                           'Товар', 'Дата окончания', 'Осталось дней', 'Начисленные проценты', 'К возврату'],
+                    result.partitions())
+
+# Типы отчетов: название, разбор параметров, построение файла, расширение и MIME-тип результата
+REPORT_JOB_TYPES = {
+    'aging': {
+        'title': 'Старение портфеля',
+        'params': lambda data: {},
+        'run': run_aging_job,
+        'extension': 'json',
+        'mimetype': 'application/json'
+    },
+    'quarterly_series': {
+        'title': 'Займы и продажи по кварталам',
+        'params': quarterly_series_params,
+        'run': run_quarterly_series_job,
+        'extension': 'csv',
+        'mimetype': 'text/csv'
+    },
+    'loans_export': {
+        'title': 'Выгрузка займов',
+        'params': loans_export_params,
+        'run': run_loans_export_job,
+        'extension': 'csv',
+        'mimetype': 'text/csv'
+    }
+}
+
+@event.listens_for(Session, 'after_commit')
+def signal_report_job_submitted(session):
+    """Новое задание становится видно воркерам только после коммита - тогда их и будим"""
+    if session.info.pop('report_job_submitted', False):
+        _report_job_submitted.set()
+
+@event.listens_for(Session, 'after_rollback')
+def discard_report_job_submitted(session):
+    session.info.pop('report_job_submitted', None)
+
+async def claim_report_job() -> ReportJob | None:
+    """Забирает старейшее ожидающее задание; задания, заблокированные другими воркерами, пропускаются"""
+    async with async_session_maker() as session:
+        stmt = select(ReportJob).where(ReportJob.Статус == 'Ожидает').order_by(
+            ReportJob.Создано
+        ).limit(1).with_for_update(skip_locked=True)
+        job = (await session.execute(stmt)).scalar_one_or_none()
+        if job is None:
+            return None
+        job.Статус = 'Выполняется'
+        job.Начато = datetime.now()
+        await session.commit()
+        return job
+
+async def finish_report_job(job_id: int, **values):
+    async with async_session_maker() as session:
+        await session.execute(update(ReportJob).where(ReportJob.ID_задания == job_id).values(**values))
+        await session.commit()
+
+async def run_report_job(job: ReportJob):
+    """Строит отчет с ограничением по филиалу автора задания и записывает результат в файл.
+    Файл сначала пишется под временным именем, поэтому скачать можно только полный результат"""
+    spec = REPORT_JOB_TYPES[job.Тип]
+    filename = f'{job.ID_задания}.{spec["extension"]}'
+    path = report_result_path(filename)
+    partial_path = f'{path}.part'
+    try:
+        async with async_session_maker(info={'branch_id': job.Филиал}) as session:
+            await spec['run'](session, orjson.loads(job.Параметры), partial_path)
+        os.replace(partial_path, path)
+    except asyncio.CancelledError:
+        # Остановка приложения: задание вернется в очередь и будет выполнено заново
+        await asyncio.shield(finish_report_job(job.ID_задания, Статус='Ожидает', Начато=None))
+        raise
+    except Exception as e:
+        app.logger.exception('Не удалось построить отчет %s (задание %d)', job.Тип, job.ID_задания)
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+        message = extract_db_error_message(e) if isinstance(e, DBAPIError) else 'Ошибка построения отчета'
+        now = datetime.now()
+        await finish_report_job(job.ID_задания, Статус='Ошибка', Ошибка=message, Завершено=now,
+                                Хранить_до=now + timedelta(hours=config_obj.REPORT_RESULT_TTL_HOURS))
+        return
+    now = datetime.now()
+    await finish_report_job(job.ID_задания, Статус='Готово', Файл=filename, Завершено=now,
+                            Хранить_до=now + timedelta(hours=config_obj.REPORT_RESULT_TTL_HOURS))
+
+async def report_job_worker():
+    """Выполняет задания по одному; пока очередь пуста, ждет нового задания этого процесса
+    или истечения REPORT_JOB_POLL_INTERVAL (задания, поставленные другими процессами)"""
+    while True:
+        try:
+            job = await claim_report_job()
+        except Exception:
+            app.logger.exception('Не удалось получить задание отчета из очереди')
+            job = None
+        if job is None:
+            try:
+                await asyncio.wait_for(_report_job_submitted.wait(), config_obj.REPORT_JOB_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            _report_job_submitted.clear()
+            continue
+        try:
+            await run_report_job(job)
+        except Exception:
+            app.logger.exception('Не удалось сохранить состояние задания %d', job.ID_задания)
+
+async def clean_report_results() -> int:
+    """Удаляет задания с истекшим сроком хранения вместе с файлами результатов и отмечает
+    прерванные задания. Возвращает число удаленных заданий"""
+    now = datetime.now()
+    async with async_session_maker() as session:
+        await session.execute(update(ReportJob).where(
+            ReportJob.Статус == 'Выполняется',
+            ReportJob.Начато < now - REPORT_JOB_STALE_AFTER
+        ).values(Статус='Ошибка', Ошибка='Выполнение прервано', Завершено=now,
+                 Хранить_до=now + timedelta(hours=config_obj.REPORT_RESULT_TTL_HOURS)))
+        expired = (await session.execute(
+            delete(ReportJob).where(ReportJob.Хранить_до < now).returning(ReportJob.Файл)
+        )).scalars().all()
+        await session.commit()
+    for filename in expired:
+        if filename:
+            try:
+                os.remove(report_result_path(filename))
+            except FileNotFoundError:
+                pass
+    return len(expired)
+
+async def report_results_cleaner():
+    while True:
+        try:
+            await clean_report_results()
+        except Exception:
+            app.logger.exception('Не удалось удалить устаревшие результаты отчетов')
+        await asyncio.sleep(REPORT_CLEANUP_INTERVAL)
+
+def start_report_workers():
+    """Запускает REPORT_JOB_WORKERS воркеров фоновых отчетов и очистку устаревших результатов"""
+    os.makedirs(config_obj.REPORT_RESULTS_DIR, exist_ok=True)
+    for _ in range(config_obj.REPORT_JOB_WORKERS):
+        _report_tasks.append(asyncio.create_task(report_job_worker()))
+    _report_tasks.append(asyncio.create_task(report_results_cleaner()))
+
+async def stop_report_workers():
+    for task in _report_tasks:
+        task.cancel()
+    await asyncio.gather(*_report_tasks, return_exceptions=True)
+    _report_tasks.clear()
+
+def report_job_visible(job: ReportJob | None) -> bool:
+    """Задание видит его автор и администратор"""
+    employee = current_employee()
+    return job is not None and employee is not None and (
+        job.Сотрудник == employee.ID_Сотрудника or employee.Должность == 'Администратор'
+    )
+
+def report_job_json(job: ReportJob) -> dict:
+    data = {
+        'id': job.ID_задания,
+        'type': job.Тип,
+        'title': REPORT_JOB_TYPES[job.Тип]['title'],
+        'status': job.Статус,
+        'created': job.Создано,
+        'started': job.Начато,
+        'finished': job.Завершено,
+        'expires': job.Хранить_до,
+        'error': job.Ошибка
+    }
+    if job.Статус == 'Готово':
+        data['download_url'] = url_for('download_report_job', job_id=job.ID_задания)
+    return data
+
+@app.route('/api/reports/jobs', methods=['GET', 'POST'])
+@login_required
+async def report_jobs():
+    """POST {"type": ..., параметры отчета} ставит отчет в очередь и возвращает задание (202);
+    GET - последние задания текущего сотрудника"""
+    if not has_permission('view_reports'):
+        return api_response({'error': 'Недостаточно прав'}, 403)
+    employee = current_employee()
+    
+    if request.method == 'GET':
+        jobs_stmt = select(ReportJob).where(
+            ReportJob.Сотрудник == employee.ID_Сотрудника
+        ).order_by(ReportJob.ID_задания.desc()).limit(20)
+        async with request_session() as session:
+            jobs = (await session.execute(jobs_stmt)).scalars().all()
+        return api_response({'items': [report_job_json(job) for job in jobs]})
+    
+    data = await request.get_json(silent=True) or (await request.form).to_dict()
+    spec = REPORT_JOB_TYPES.get(data.get('type'))
+    if spec is None:
+        return api_response({'error': 'Неизвестный тип отчета'}, 400)
+    try:
+        params = spec['params'](data)
+    except (ValueError, TypeError):
+        return api_response({'error': 'Некорректные параметры отчета'}, 400)
+    
+    job = ReportJob(
+        Тип=data['type'],
+        Параметры=orjson.dumps(params).decode(),
+        Статус='Ожидает',
+        Сотрудник=employee.ID_Сотрудника,
+        Филиал=current_branch_id(),
+        Создано=datetime.now()
+    )
+    async with request_session() as session:
+        session.add(job)
+        await session.flush()
+        session.info['report_job_submitted'] = True
+    return api_response(report_job_json(job), 202)
+
+@app.route('/api/reports/jobs/<int:job_id>')
+@login_required
+async def report_job_status(job_id):
+    async with request_session() as session:
+        job = await session.get(ReportJob, job_id)
+    if not report_job_visible(job):
+        return api_response({'error': 'Задание не найдено'}, 404)
+    return api_response(report_job_json(job))
+
+@app.route('/api/reports/jobs/<int:job_id>/download')
+@login_required
+async def download_report_job(job_id):
+    async with request_session() as session:
+        job = await session.get(ReportJob, job_id)
+    if not report_job_visible(job) or job.Статус != 'Готово' or not os.path.exists(report_result_path(job.Файл)):
+        return api_response({'error': 'Результат не найден или срок его хранения истек'}, 404)
+    spec = REPORT_JOB_TYPES[job.Тип]
+    return await send_file(
+        report_result_path(job.Файл),
+        mimetype=spec['mimetype'],
+        as_attachment=True,
+        attachment_filename=f'{job.Тип}_{job.ID_задания}.{spec["extension"]}'
+    )
+
+# ========== API v1 ==========
+def parse_bool(value: str) -> bool:
+    return value.lower() in ('true', '1', 'yes')
+
+# Ресурсы API: имя поля в ответе -> столбец. Первое поле - ключ постраничной выборки (keyset),
+# оно всегда включается в ответ. Фильтры: имя параметра -> (столбец, преобразование значения).
+# Соединения со справочниками (по порядку) добавляются, только если запрошены их поля
+API_RESOURCES = {
+    'loans': {
+        'permission': 'view_loans',
+        'fields': {
+            'id': Loan.Код_займа,
+            'date': Loan.Дата_займа,
+            'client_id': Loan.Клиент,
+            'amount': Loan.Размер_займа,
+            'interest_rate_id': Loan.Процент_по_займу,
+            'term_months': Loan.Срок_займа,
+            'status': Loan.Статус_займа,
+            'article': Loan.Артикул_товара,
+            'product_id': Loan.Товар,
+            'item_name': Product.Наименование,
+            'item_category': ItemCategory.Название,
+            'item_condition': Loan.Физическое_состояние,
+            'employee_id': Loan.Исполнитель,
+            'branch_id': Loan.Филиал
+        },
+        'filters': {'status': (Loan.Статус_займа, str), 'client_id': (Loan.Клиент, int), 'branch_id': (Loan.Филиал, int)},
+        'joins': [
+            (Product, Loan.Товар == Product.ID_товара),
+            (ItemCategory, Product.Категория == ItemCategory.ID_категории)
+        ]
+    },
+    'clients': {
+        'permission': 'view_clients',
+        'fields': {
+            'id': Client.ID_Клиента,
+            'full_name': Client.ФИО,
+            'phone': Client.Телефон,
+            'branch_id': Client.Филиал
+        },
+        'filters': {'phone': (Client.Телефон, str), 'branch_id': (Client.Филиал, int)}
+    },
+    'sales': {
+        'permission': 'view_sales',
+        'fields': {
+            'id': Sale.Код_продажи,
+            'date': Sale.Дата_продажи,
+            'article': Sale.Артикул_проданного_товара,
+            'seller_id': Sale.Продавец,
+            'branch_id': Sale.Филиал
+        },
+        'filters': {'seller_id': (Sale.Продавец, int), 'branch_id': (Sale.Филиал, int)}
+    },
+    'unclaimed': {
+        'permission': 'view_unclaimed',
+        'fields': {
+            'article': UnclaimedItem.Артикул,
+            'loan_id': UnclaimedItem.Займ,
+            'appraised_value': UnclaimedItem.Оценочная_стоимость,
+            'sold': UnclaimedItem.Продан,
+            'branch_id': UnclaimedItem.Филиал
+        },
+        'filters': {'sold': (UnclaimedItem.Продан, parse_bool), 'branch_id': (UnclaimedItem.Филиал, int)}
+    }
+}
+
+def orjson_default(value):
+    """Типы, которые orjson не сериализует сам (даты он переводит в ISO 8601 без помощи).
+    Денежные суммы (Decimal) возвращаются строками без потери точности, как в jsonify"""
+    if isinstance(value, Decimal):
+        return str(value)
+    raise TypeError
+
+def api_response(payload, status: int = 200) -> Response:
+    """JSON-ответ API, сериализованный orjson"""
+    return Response(orjson.dumps(payload, default=orjson_default), status=status, mimetype='application/json')
+
+@app.errorhandler(Unauthorized)
+async def api_unauthorized(error):
+    """Запросы к API без входа или с недействительным токеном получают ответ JSON, а не HTML"""
+    if request.path.startswith('/api/'):
+        return api_response({'error': 'Требуется авторизация'}, 401)
+    return error
+
+@app.route('/api/v1/token', methods=['POST'])
+async def api_token():
+    """Выдает подписанный токен для заголовка Authorization: Bearer по логину и паролю"""
+    data = await request.get_json(silent=True) or {}
+    login_name = data.get('login')
+    password = data.get('password')
+    if not login_name or not password:
+        return api_response({'error': 'Укажите login и password'}, 400)
+    
+    async with request_session() as session:
+        employee = await load_employee_for_cache(session, Логин=login_name)
+    if not employee or not employee.Пароль or not await verify_password(employee.Пароль, password):
+        return api_response({'error': 'Неверный логин или пароль'}, 401)
+    if not employee.is_active():
+        return api_response({'error': 'Аккаунт неактивен (уволен)'}, 403)
+    
+    return api_response({'token': auth.dump_token(str(employee.ID_Сотрудника))})
+
+@app.route('/api/v1/<any(loans, clients, sales, unclaimed):resource>')
+@login_required
+async def api_list(resource):
+    """Список ресурса постранично по ключу: ?after=<ключ>&limit=N&fields=a,b&<фильтр>=<значение>.
+    Выбираются только запрошенные столбцы, без загрузки ORM-объектов."""
+    spec = API_RESOURCES[resource]
+    if not has_permission(spec['permission']):
+        return api_response({'error': 'Недостаточно прав'}, 403)
+    
+    fields = spec['fields']
+    key_name = next(iter(fields))
+    requested = [name.strip() for name in request.args.get('fields', '').split(',') if name.strip()] or list(fields)
+    unknown = [name for name in requested if name not in fields]
+    if unknown:
+        return api_response({'error': f'Неизвестные поля: {", ".join(unknown)}'}, 400)
+    if key_name not in requested:
+        requested.insert(0, key_name)
+    
+    limit = request.args.get('limit', config_obj.ITEMS_PER_PAGE, type=int) or config_obj.ITEMS_PER_PAGE
+    limit = min(max(limit, 1), 500)
+    key = fields[key_name]
+    stmt = select(*(fields[name].label(name) for name in requested)).select_from(key.class_)
+    joins = spec.get('joins', [])
+    requested_tables = {fields[name].expression.table for name in requested}
+    needed_joins = max((i + 1 for i, (entity, _) in enumerate(joins) if entity.__table__ in requested_tables), default=0)
+    for entity, onclause in joins[:needed_joins]:
+        stmt = stmt.join(entity, onclause)
+    stmt = stmt.order_by(key).limit(limit + 1)
+    
+    try:
+        after = request.args.get('after')
+        if after is not None:
+            stmt = stmt.where(key > int(after))
+        for name, (column, convert) in spec['filters'].items():
+            value = request.args.get(name)
+            if value is not None:
+                stmt = stmt.where(column == convert(value))
+    except ValueError:
+        return api_response({'error': 'Некорректное значение параметра'}, 400)
+    
+    async with request_session() as session:
+        rows = (await session.execute(stmt)).all()
+    
+    items = [dict(zip(requested, row)) for row in rows[:limit]]
+    next_after = items[-1][key_name] if len(rows) > limit else None
+    return api_response({'items': items, 'next_after': next_after})
+
 if __name__ == '__main__':
     app.run(debug=True, host='localhost', port=5000)
 
@@ -0,0 +1,101 @@
+"""
+Бенчмарк: память и время на строку списка займов - ORM-объекты против LoanRow
+Использование: python benchmarks/list_rows.py [количество_займов]
+
+Сравнивает прежний способ (select(Loan) со связями lazy='selectin' и обертка в словарь)
+и выборку только отображаемых столбцов в LoanRow. Используется SQLite в памяти,
+поэтому вычисляемые в PostgreSQL поля (дата окончания, проценты) заменены константами:
+измеряется стоимость загрузки строк, а не самих вычислений. PostgreSQL не требуется.
+"""
+import sys
+import os
+import statistics
+import time
+import tracemalloc
+from datetime import date, timedelta
+from decimal import Decimal
+
+# Добавляем корневую директорию в путь
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import create_engine, select, literal, Date, Integer, Numeric
+from sqlalchemy.orm import Session
+from models import Base, Branch, Client, Employee, InterestRate, Loan, ItemCategory, Product
+from app import LoanRow
+
+REPEATS = 5
+
+def fill_database(engine, loans: int):
+    """Создает таблицы и заполняет их тестовыми займами"""
+    Base.metadata.create_all(engine)
+    with Session(engine) as session:
+        session.add(Branch(ID_филиала=1, Название='Центральный'))
+        session.add(InterestRate(Индекс_процента=1, Состояние_товара=Decimal('5'), Срок_займа=Decimal('3'), Процент=Decimal('8')))
+        session.add(Employee(ID_Сотрудника=1, ФИО_Сотрудника='Сотрудник', Должность='Оценщик',
+                             Дата_Приёма=date(2025, 5, 1), Телефон_Сотрудника='+70000000000', Филиал=1))
+        session.add(ItemCategory(ID_категории=1, Название='Ювелирные изделия'))
+        session.add_all(Product(ID_товара=i, Наименование=f'Товар {i}', Категория=1) for i in range(1, 51))
+        clients = max(loans // 5, 1)
+        session.add_all(Client(ID_Клиента=i, ФИО=f'Клиент {i}', Телефон=f'+7{i:010d}', Филиал=1) for i in range(1, clients + 1))
+        session.add_all(Loan(
+            Код_займа=i, Дата_займа=date(2025, 1, 1) + timedelta(days=i % 300), Клиент=i % clients + 1,
+            Размер_займа=Decimal('1000.5') + i, Процент_по_займу=1, Срок_займа=Decimal('3'),
+            Статус_займа='Активен', Состояние_товара=Decimal('5'), Артикул_товара=i,
+            Товар=i % 50 + 1, Физическое_состояние='Хорошее', Исполнитель=1, Филиал=1
+        ) for i in range(1, loans + 1))
+        session.commit()
+
+def load_orm(engine) -> list:
+    """Прежний способ: ORM-объекты займов со связями и словарь на каждую строку"""
+    with Session(engine) as session:
+        loans = session.execute(select(Loan)).scalars().all()
+        rows = [{
+            'loan': loan,
+            'client_name': loan.client.ФИО,
+            'end_date': loan.Дата_займа,
+            'days_left': 0,
+            'accrued_interest': Decimal('0'),
+            'total_due': loan.Размер_займа
+        } for loan in loans]
+        # Сессия закрывается, но строки удерживают объекты и их связи
+        session.expunge_all()
+    return rows
+
+def load_rows(engine) -> list:
+    """Новый способ: только отображаемые столбцы в LoanRow"""
+    stmt = select(
+        Loan.Код_займа, Loan.Дата_займа, Client.ФИО, Loan.Размер_займа, Loan.Срок_займа,
+        Loan.Статус_займа, Product.Наименование, literal(date(2025, 4, 1), Date),
+        literal(0, Integer), literal(Decimal('0'), Numeric), Loan.Размер_займа
+    ).join(Client, Loan.Клиент == Client.ID_Клиента).join(Product, Loan.Товар == Product.ID_товара)
+    with Session(engine) as session:
+        return list(map(LoanRow._make, session.execute(stmt)))
+
+def measure(load, engine, loans: int):
+    """Время (мкс) и удерживаемая память (байт) на строку"""
+    timings = []
+    for _ in range(REPEATS):
+        started = time.perf_counter()
+        load(engine)
+        timings.append((time.perf_counter() - started) / loans * 1e6)
+
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    rows = load(engine)
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert len(rows) == loans
+    return statistics.median(timings), (retained - baseline) / loans, (peak - baseline) / loans
+
+def main():
+    loans = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    engine = create_engine('sqlite://')
+    fill_database(engine, loans)
+
+    print(f"Займов: {loans}")
+    for name, load in (('ORM-объекты', load_orm), ('LoanRow', load_rows)):
+        cpu, retained, peak = measure(load, engine, loans)
+        print(f"{name:12} время {cpu:7.1f} мкс/строка, удерживается {retained:7.0f} байт/строка, пик {peak:7.0f} байт/строка")
+
+if __name__ == '__main__':
+    main()
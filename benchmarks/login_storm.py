@@ -0,0 +1,67 @@
+"""
+Бенчмарк: задержка цикла событий при одновременном входе сотрудников
+Использование: python benchmarks/login_storm.py [количество_входов]
+
+Сравнивает проверку паролей прямо в цикле событий и в пуле потоков (verify_password).
+Задержка "других маршрутов" измеряется зондом, который каждые 5 мс засыпает
+и фиксирует, насколько позже запланированного он проснулся. БД не требуется.
+"""
+import sys
+import os
+import asyncio
+import statistics
+import time
+
+# Добавляем корневую директорию в путь
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from werkzeug.security import check_password_hash, generate_password_hash
+from app import verify_password, config_obj
+
+PROBE_INTERVAL = 0.005
+
+async def probe(lags: list, stop: asyncio.Event):
+    """Имитирует другие запросы: фиксирует опоздание пробуждения цикла событий"""
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(PROBE_INTERVAL)
+        lags.append((time.perf_counter() - started - PROBE_INTERVAL) * 1000)
+
+async def blocking_login(password_hash: str):
+    """Проверка пароля как раньше - прямо в обработчике"""
+    await asyncio.sleep(0)
+    return check_password_hash(password_hash, 'password123')
+
+async def executor_login(password_hash: str):
+    """Проверка пароля в пуле потоков"""
+    return await verify_password(password_hash, 'password123')
+
+async def run_storm(login, password_hash: str, logins: int):
+    lags = []
+    stop = asyncio.Event()
+    probe_task = asyncio.create_task(probe(lags, stop))
+    await asyncio.sleep(0.05)
+    started = time.perf_counter()
+    await asyncio.gather(*(login(password_hash) for _ in range(logins)))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await probe_task
+    return elapsed, lags
+
+def report(title: str, elapsed: float, lags: list):
+    lags = sorted(lags)
+    p99 = lags[min(len(lags) - 1, int(len(lags) * 0.99))]
+    print(f"{title}:")
+    print(f"  Время всех входов: {elapsed * 1000:.0f} мс")
+    print(f"  Задержка зонда: медиана {statistics.median(lags):.1f} мс, p99 {p99:.1f} мс, максимум {lags[-1]:.1f} мс")
+
+async def main():
+    logins = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    password_hash = generate_password_hash('password123', method=config_obj.PASSWORD_HASH_METHOD)
+    print(f"Одновременных входов: {logins}, алгоритм: {config_obj.PASSWORD_HASH_METHOD}, "
+          f"потоков: {config_obj.PASSWORD_HASH_WORKERS}")
+    report('Проверка в цикле событий', *await run_storm(blocking_login, password_hash, logins))
+    report('Проверка в пуле потоков', *await run_storm(executor_login, password_hash, logins))
+
+if __name__ == '__main__':
+    asyncio.run(main())
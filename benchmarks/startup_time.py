@@ -0,0 +1,57 @@
+"""
+Бенчмарк: время холодного старта приложения
+Использование: python benchmarks/startup_time.py [количество_запусков]
+
+Измеряет время "import app" в отдельном процессе (импорт не должен подключаться к БД)
+и время шага запуска before_serving: создание движка и прогрев пула соединений.
+Для второго замера нужна доступная БД из .env; если она недоступна, выводится ошибка.
+"""
+import sys
+import os
+import asyncio
+import statistics
+import subprocess
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Добавляем корневую директорию в путь
+sys.path.insert(0, ROOT)
+
+IMPORT_SNIPPET = 'import time; started = time.perf_counter(); import app; print(time.perf_counter() - started)'
+
+def measure_import(runs: int) -> list:
+    """Время импорта модуля app в новом интерпретаторе, в миллисекундах"""
+    timings = []
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, '-c', IMPORT_SNIPPET],
+            cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout
+        timings.append(float(output.strip().splitlines()[-1]) * 1000)
+    return timings
+
+async def measure_startup() -> float:
+    """Время шага запуска (создание движка и прогрев пула), в миллисекундах"""
+    from app import startup, shutdown
+    started = time.perf_counter()
+    await startup()
+    elapsed = (time.perf_counter() - started) * 1000
+    await shutdown()
+    return elapsed
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+
+    timings = measure_import(runs)
+    print(f"import app ({runs} запусков): медиана {statistics.median(timings):.0f} мс, "
+          f"мин {min(timings):.0f} мс, макс {max(timings):.0f} мс")
+
+    try:
+        elapsed = asyncio.run(measure_startup())
+        print(f"before_serving (движок + прогрев пула): {elapsed:.0f} мс")
+    except Exception as e:
+        print(f"before_serving: БД недоступна ({type(e).__name__}: {e})")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""
+Бенчмарк: загрузка шаблонов в новом воркере без кеша и с кешем байт-кода Jinja
+Использование: python benchmarks/template_cache.py [количество_запусков]
+
+Каждый запуск - отдельный интерпретатор, как новый воркер uvicorn. Измеряется время первой
+загрузки шаблонов страницы займов (loans.html, base.html, pagination.html - работа шаблонизатора
+при первом запросе воркера) и всех шаблонов приложения: без кеша (компиляция из исходников)
+и с заполненным кешем байт-кода во временном каталоге. Отдельно измеряется повторное обращение
+к уже загруженному шаблону с проверкой изменения файла (TEMPLATES_AUTO_RELOAD) и без нее.
+БД не требуется.
+"""
+import sys
+import os
+import statistics
+import subprocess
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PAGE_TEMPLATES = ['loans.html', 'base.html', 'pagination.html']
+REPEATED_LOOKUPS = 10000
+
+LOAD_SNIPPET = f'''
+import time
+from app import app
+env = app.jinja_env
+started = time.perf_counter()
+for name in {PAGE_TEMPLATES!r}:
+    env.get_template(name)
+page = time.perf_counter() - started
+started = time.perf_counter()
+for name in env.list_templates():
+    env.get_template(name)
+print(page, time.perf_counter() - started + page)
+'''
+
+LOOKUP_SNIPPET = f'''
+import time
+from app import app
+env = app.jinja_env
+env.get_template('loans.html')
+started = time.perf_counter()
+for _ in range({REPEATED_LOOKUPS}):
+    env.get_template('loans.html')
+print((time.perf_counter() - started) / {REPEATED_LOOKUPS})
+'''
+
+def run(snippet: str, **env) -> list:
+    output = subprocess.run(
+        [sys.executable, '-c', snippet],
+        cwd=ROOT, capture_output=True, text=True, check=True, env={**os.environ, **env}
+    ).stdout
+    return [float(value) for value in output.strip().splitlines()[-1].split()]
+
+def measure_load(runs: int, cache_dir: str) -> tuple:
+    """Медианы времени загрузки шаблонов страницы и всех шаблонов, в миллисекундах"""
+    timings = [run(LOAD_SNIPPET, TEMPLATE_CACHE_DIR=cache_dir) for _ in range(runs)]
+    return (statistics.median(page for page, _ in timings) * 1000,
+            statistics.median(total for _, total in timings) * 1000)
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        # Заполнение кеша, как командой compile-templates при развертывании
+        run(LOAD_SNIPPET, TEMPLATE_CACHE_DIR=cache_dir)
+        print(f"Первая загрузка шаблонов в новом воркере ({runs} запусков, медиана):")
+        for name, directory in (('без кеша', ''), ('кеш байт-кода', cache_dir)):
+            page, total = measure_load(runs, directory)
+            print(f"  {name:14} страница займов {page:6.1f} мс, все шаблоны {total:6.1f} мс")
+
+    print(f"Повторное обращение к загруженному шаблону ({REPEATED_LOOKUPS} раз):")
+    for name, auto_reload in (('с проверкой файла', 'true'), ('без проверки', 'false')):
+        lookup = run(LOOKUP_SNIPPET, TEMPLATE_CACHE_DIR='', TEMPLATES_AUTO_RELOAD=auto_reload)[0]
+        print(f"  {name:18} {lookup * 1e6:6.2f} мкс")
+
+if __name__ == '__main__':
+    main()
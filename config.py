@@ -3,6 +3,7 @@
 Все настройки загружаются из .env файла
 """
 import os
+from decimal import Decimal
 from dotenv import load_dotenv
 from pathlib import Path
 
@@ -37,11 +38,66 @@ class Config:
     SECRET_KEY = os.getenv('SECRET_KEY', 'dev-secret-key-change-in-production')
     DATABASE_URI = get_database_uri()
     FLASK_ENV = os.getenv('FLASK_ENV', 'development')
+    # Доля оценочной стоимости, выдаваемая в займ: оценочная стоимость
+    # невостребованного товара = размер займа / UNCLAIMED_LOAN_TO_VALUE
+    UNCLAIMED_LOAN_TO_VALUE = Decimal(os.getenv('UNCLAIMED_LOAN_TO_VALUE', '0.6'))
+    # Количество строк на странице списков
+    ITEMS_PER_PAGE = int(os.getenv('ITEMS_PER_PAGE', '50'))
+    # Алгоритм и стоимость хеширования паролей в формате werkzeug,
+    # например 'scrypt:32768:8:1' или 'pbkdf2:sha256:600000'
+    PASSWORD_HASH_METHOD = os.getenv('PASSWORD_HASH_METHOD', 'scrypt:32768:8:1')
+    # Количество потоков для хеширования паролей
+    PASSWORD_HASH_WORKERS = int(os.getenv('PASSWORD_HASH_WORKERS', '4'))
+    # Пул соединений с БД и число соединений, открываемых заранее при запуске
+    DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '5'))
+    DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', '10'))
+    DB_POOL_WARMUP = int(os.getenv('DB_POOL_WARMUP', '2'))
+    # Журнал изменений: максимальный размер пакета и интервал записи в секундах
+    AUDIT_BATCH_SIZE = int(os.getenv('AUDIT_BATCH_SIZE', '200'))
+    AUDIT_FLUSH_INTERVAL = float(os.getenv('AUDIT_FLUSH_INTERVAL', '1.0'))
+    # Обновление панели управления: интервал объединения изменений в секундах и
+    # рассылка между несколькими воркерами через PostgreSQL LISTEN/NOTIFY
+    DASHBOARD_DEBOUNCE = float(os.getenv('DASHBOARD_DEBOUNCE', '0.5'))
+    DASHBOARD_PG_NOTIFY = os.getenv('DASHBOARD_PG_NOTIFY', 'false').lower() in ('true', '1', 'yes')
+    # Секционирование продаж по годам: сколько лет вперед создавать секции заранее,
+    # через сколько лет секция считается архивной и табличное пространство для архива
+    # (пустое значение - архивные секции остаются на месте)
+    SALES_PARTITION_PREMAKE_YEARS = int(os.getenv('SALES_PARTITION_PREMAKE_YEARS', '2'))
+    SALES_ARCHIVE_AFTER_YEARS = int(os.getenv('SALES_ARCHIVE_AFTER_YEARS', '3'))
+    # Через сколько лет (по дате займа) выплаченные займы переносятся в архивные таблицы
+    LOANS_ARCHIVE_AFTER_YEARS = int(os.getenv('LOANS_ARCHIVE_AFTER_YEARS', '3'))
+    ARCHIVE_TABLESPACE = os.getenv('ARCHIVE_TABLESPACE', '')
+    # Максимум одновременных запросов к БД при параллельном выполнении в рамках одного запроса
+    QUERY_FANOUT_LIMIT = int(os.getenv('QUERY_FANOUT_LIMIT', '4'))
+    # Фоновые отчеты: число воркеров в процессе, интервал опроса очереди заданий в секундах,
+    # каталог файлов результатов и срок их хранения в часах
+    REPORT_JOB_WORKERS = int(os.getenv('REPORT_JOB_WORKERS', '2'))
+    REPORT_JOB_POLL_INTERVAL = float(os.getenv('REPORT_JOB_POLL_INTERVAL', '5.0'))
+    REPORT_RESULTS_DIR = os.getenv('REPORT_RESULTS_DIR', str(Path(__file__).parent / 'report_results'))
+    REPORT_RESULT_TTL_HOURS = int(os.getenv('REPORT_RESULT_TTL_HOURS', '24'))
+    # Максимум отчетов за закрытые периоды в кеше процесса (вытесняются давно не запрошенные)
+    REPORT_CACHE_SIZE = int(os.getenv('REPORT_CACHE_SIZE', '256'))
+    # Профилирование запросов администратором (заголовок X-Profile или параметр ?_profile=1):
+    # каталог файлов профилей и интервал снятия стека в секундах
+    PROFILE_DIR = os.getenv('PROFILE_DIR', str(Path(__file__).parent / 'profiles'))
+    PROFILE_SAMPLE_INTERVAL = float(os.getenv('PROFILE_SAMPLE_INTERVAL', '0.005'))
+    # Журнал медленных запросов: порог в миллисекундах, доля запросов, для которых снимается
+    # план EXPLAIN ANALYZE, ограничение времени его выполнения и срок хранения записей в днях
+    SLOW_QUERY_MS = int(os.getenv('SLOW_QUERY_MS', '200'))
+    SLOW_QUERY_EXPLAIN_SAMPLE = float(os.getenv('SLOW_QUERY_EXPLAIN_SAMPLE', '0.1'))
+    SLOW_QUERY_EXPLAIN_TIMEOUT_MS = int(os.getenv('SLOW_QUERY_EXPLAIN_TIMEOUT_MS', '10000'))
+    SLOW_QUERY_KEEP_DAYS = int(os.getenv('SLOW_QUERY_KEEP_DAYS', '30'))
+    # Кеш байт-кода шаблонов Jinja на диске, общий для всех воркеров (пустое значение - без кеша).
+    # Заполняется при развертывании командой: quart --app app compile-templates
+    TEMPLATE_CACHE_DIR = os.getenv('TEMPLATE_CACHE_DIR', str(Path(__file__).parent / '.jinja_cache'))
+    # Проверять изменение файлов шаблонов при каждом обращении (только для разработки)
+    TEMPLATES_AUTO_RELOAD = os.getenv('TEMPLATES_AUTO_RELOAD', 'false').lower() in ('true', '1', 'yes')
 
 class DevelopmentConfig(Config):
     """Конфигурация для разработки"""
     DEBUG = True
     FLASK_ENV = 'development'
+    TEMPLATES_AUTO_RELOAD = os.getenv('TEMPLATES_AUTO_RELOAD', 'true').lower() in ('true', '1', 'yes')
 
 class ProductionConfig(Config):
     """Конфигурация для продакшена - настройки из .env"""
@@ -0,0 +1,270 @@
+"""
+Проверка планов запросов основных страниц: списки займов, продаж, невостребованных товаров,
+страница отчетов и проверка просрочки, а также отбрасывание архивных таблиц займов
+Использование: python database/check_query_plans.py [--seed N] [--budget COST]
+
+Скрипт открывает страницы через тестовый клиент приложения от имени администратора и сотрудника
+филиала, перехватывает SQL каждой страницы событием движка и выполняет EXPLAIN (FORMAT JSON) для
+каждого запроса. Проверка не проходит, если в плане есть последовательное сканирование большой
+таблицы (кроме явно разрешенных для страницы) или оценка стоимости запроса превышает бюджет.
+Завершается с кодом 1 при регрессии плана, поэтому подходит для запуска в CI.
+
+На маленьких таблицах PostgreSQL выбирает последовательное сканирование независимо от индексов,
+поэтому проверку нужно выполнять на отдельной базе (FLASK_ENV=testing) с представительным объемом
+данных: ключ --seed N добавляет N займов с клиентами, невостребованными товарами и продажами
+к базе, заполненной database/init_db.py, переносит выплаченные займы старше
+LOANS_ARCHIVE_AFTER_YEARS лет в архивные таблицы и обновляет статистику.
+"""
+import sys
+import os
+
+# Устанавливаем кодировку для Windows консоли
+if sys.platform == 'win32':
+    import io
+    sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8', errors='replace')
+    sys.stderr = io.TextIOWrapper(sys.stderr.buffer, encoding='utf-8', errors='replace')
+
+# Добавляем корневую директорию в путь
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import asyncio
+import argparse
+from datetime import date
+from urllib.parse import parse_qsl
+import orjson
+from sqlalchemy import event, select, func, text, and_
+from quart import has_request_context
+import models
+from models import Employee, Loan
+from app import app, auth, config_obj
+from database.maintain_partitions import (LOAN_HISTORY_TABLE, LOANS_TABLE, SALES_TABLE, archive_paid_loans,
+                                          create_sale_partitions, is_partitioned)
+from database.rebuild_branch_summary import rebuild_branch_summary
+
+# Таблицы, последовательное сканирование которых считается регрессией
+LARGE_TABLES = {'Клиент', 'Займ', 'Невостребованный_товар', 'Продажа', 'История_статусов_займа',
+                'Лог_изменений_займов'}
+# Оценка стоимости запроса по умолчанию, выше которой план считается регрессией
+DEFAULT_COST_BUDGET = 25000
+# Меньше займов - планы не показательны
+MIN_LOANS = 10000
+
+# Страницы: (название, адрес, таблицы с допустимым последовательным сканированием).
+# Список займов выполняет и проверку просрочки (UPDATE и INSERT ... SELECT невостребованных товаров)
+PLAN_CHECKS = [
+    ('Займы', '/loans', set()),
+    ('Займы: просроченные', '/loans?status=Просрочен', set()),
+    ('Продажи', '/sales', set()),
+    ('Невостребованные товары', '/unclaimed', set()),
+    # Список лет с данными по определению читает все займы и продажи
+    ('Отчеты', '/reports', {'Займ', 'Продажа'}),
+]
+
+# Запросы к займам: (название, условие, читает ли запрос архивные таблицы займов). Запросы по
+# невыплаченным и недавним займам не должны читать архив - планировщик отбрасывает архивные таблицы
+# по ограничению CHECK; запрос за архивные годы должен их читать
+def archive_checks(archive_start: date) -> list:
+    return [
+        ('Невыплаченные займы', Loan.Статус_займа != 'Выплачен', False),
+        ('Просроченные займы', Loan.Статус_займа == 'Просрочен', False),
+        ('Активные и просроченные займы', Loan.Статус_займа.in_(['Активен', 'Просрочен']), False),
+        ('Займы последних лет', Loan.Дата_займа >= archive_start, False),
+        ('Выплаченные займы архивных лет', and_(Loan.Статус_займа == 'Выплачен', Loan.Дата_займа < archive_start), True),
+    ]
+
+# Синтетические данные: клиенты, займы за ~4 года (большая часть выплачена, каждый десятый просрочен),
+# невостребованные товары просроченных займов и продажи половины из них
+SEED_STATEMENTS = [
+    '''INSERT INTO "Клиент" ("ID_Клиента", "ФИО", "Телефон", "Филиал")
+       SELECT :client_base + g, 'Клиент ' || (:client_base + g), '+8' || lpad((:client_base + g)::text, 10, '0'),
+              branches.ids[1 + g % cardinality(branches.ids)]
+       FROM (SELECT array_agg("ID_филиала" ORDER BY "ID_филиала") AS ids FROM "Филиал") branches,
+            generate_series(1, :clients) g''',
+    '''INSERT INTO "Займ" ("Код_займа", "Дата_займа", "Клиент", "Размер_займа", "Процент_по_займу", "Срок_займа",
+                          "Статус_займа", "Состояние_товара", "Артикул_товара", "Товар", "Физическое_состояние",
+                          "Исполнитель", "Филиал")
+       SELECT :loan_base + g, CURRENT_DATE - g % 1500, clients.ids[1 + g % cardinality(clients.ids)],
+              1000 + g % 50000, rates.ids[1 + g % cardinality(rates.ids)], 3,
+              CASE WHEN g % 10 = 0 THEN 'Просрочен' WHEN g % 1500 < 60 THEN 'Активен' ELSE 'Выплачен' END,
+              5, :loan_base + g, products.ids[1 + g % cardinality(products.ids)], 'Хорошее',
+              employees.ids[1 + g % cardinality(employees.ids)], branches.ids[1 + g % cardinality(branches.ids)]
+       FROM (SELECT array_agg("ID_Клиента") AS ids FROM "Клиент") clients,
+            (SELECT array_agg("Индекс_процента") AS ids FROM "Процент_по_займу") rates,
+            (SELECT array_agg("ID_товара") AS ids FROM "Товар") products,
+            (SELECT array_agg("ID_Сотрудника") AS ids FROM "Сотрудник" WHERE "Дата_Увольнения" IS NULL) employees,
+            (SELECT array_agg("ID_филиала" ORDER BY "ID_филиала") AS ids FROM "Филиал") branches,
+            generate_series(1, :loans) g''',
+    '''INSERT INTO "История_статусов_займа" ("Займ", "Статус", "Действует_с")
+       SELECT "Код_займа", "Статус_займа", "Дата_займа" FROM "Займ" WHERE "Код_займа" > :loan_base''',
+    '''INSERT INTO "Невостребованный_товар" ("Артикул", "Займ", "Оценочная_стоимость", "Продан", "Филиал")
+       SELECT "Код_займа", "Код_займа", round("Размер_займа" / 0.6, 4), "Код_займа" % 2 = 0, "Филиал"
+       FROM "Займ" WHERE "Статус_займа" = 'Просрочен' AND "Код_займа" > :loan_base
+       ON CONFLICT DO NOTHING''',
+    '''INSERT INTO "Продажа" ("Код_продажи", "Дата_продажи", "Артикул_проданного_товара", "Продавец", "Филиал")
+       SELECT :sale_base + row_number() OVER (ORDER BY i."Артикул"), LEAST(l."Дата_займа" + 150, CURRENT_DATE),
+              i."Артикул", l."Исполнитель", i."Филиал"
+       FROM "Невостребованный_товар" i JOIN "Займ" l ON l."Код_займа" = i."Займ"
+       WHERE i."Продан" AND i."Артикул" > :loan_base''',
+    '''SELECT setval('"Продажа_Код_продажи_seq"', (SELECT MAX("Код_продажи") FROM "Продажа"))''',
+]
+
+async def seed_dataset(engine, loans: int):
+    """Добавляет loans займов и связанные данные одним набором INSERT ... SELECT и обновляет статистику"""
+    async with engine.begin() as conn:
+        bases = (await conn.execute(text(f'''SELECT
+            (SELECT COALESCE(MAX("ID_Клиента"), 0) FROM "Клиент"),
+            (SELECT COALESCE(MAX("Код_займа"), 0) FROM "Займ"),
+            (SELECT COALESCE(MAX("Код_продажи"), 0) FROM "{SALES_TABLE}")'''))).one()
+        params = {'client_base': bases[0], 'loan_base': bases[1], 'sale_base': bases[2],
+                  'clients': max(loans // 5, 1), 'loans': loans}
+        this_year = date.today().year
+        if await is_partitioned(conn, SALES_TABLE):
+            await create_sale_partitions(conn, this_year - 5, this_year)
+        for statement in SEED_STATEMENTS:
+            await conn.execute(text(statement), params)
+        await archive_paid_loans(conn, this_year - config_obj.LOANS_ARCHIVE_AFTER_YEARS)
+        await rebuild_branch_summary(conn)
+    async with engine.connect() as conn:
+        await conn.execution_options(isolation_level='AUTOCOMMIT')
+        await conn.exec_driver_sql('VACUUM ANALYZE')
+
+def plan_nodes(node: dict):
+    yield node
+    for child in node.get('Plans', ()):
+        yield from plan_nodes(child)
+
+def base_table(relation: str) -> str:
+    """Секции продаж (Продажа_2024, Продажа_default) и архивные таблицы займов (Займ_архив_2021,
+    История_статусов_займа_архив_2021) относятся к основной таблице"""
+    if relation.startswith(f'{SALES_TABLE}_'):
+        return SALES_TABLE
+    for table in (LOANS_TABLE, LOAN_HISTORY_TABLE):
+        if relation.startswith(f'{table}_архив_'):
+            return table
+    return relation
+
+def is_loan_archive(relation: str) -> bool:
+    return relation.startswith(f'{LOANS_TABLE}_архив_')
+
+async def explain(engine, statement: str, parameters) -> dict:
+    """План запроса без выполнения (для UPDATE и INSERT данные не изменяются)"""
+    async with engine.connect() as conn:
+        await conn.execution_options(slow_query_log=False)
+        result = await conn.exec_driver_sql(f'EXPLAIN (FORMAT JSON) {statement}', parameters or None)
+        plan = result.scalar()
+    return (orjson.loads(plan) if isinstance(plan, str) else plan)[0]['Plan']
+
+def plan_problems(plan: dict, allowed_seq_scans: set, budget: float) -> list:
+    problems = []
+    for node in plan_nodes(plan):
+        if node['Node Type'] == 'Seq Scan':
+            table = base_table(node['Relation Name'])
+            if table in LARGE_TABLES and table not in allowed_seq_scans:
+                problems.append(f'последовательное сканирование {node["Relation Name"]}')
+    if plan['Total Cost'] > budget:
+        problems.append(f'стоимость {plan["Total Cost"]:.0f} больше {budget:.0f}')
+    return problems
+
+async def archive_problems(engine, condition, reads_archive: bool) -> list:
+    """План запроса займов с условием: значения передаются параметрами, как в приложении"""
+    compiled = select(Loan.Код_займа).where(condition).compile(
+        engine.sync_engine, compile_kwargs={'render_postcompile': True}
+    )
+    plan = await explain(engine, compiled.string, tuple(compiled.params[name] for name in compiled.positiontup))
+    archives = sorted({node['Relation Name'] for node in plan_nodes(plan) if is_loan_archive(node.get('Relation Name', ''))})
+    if reads_archive and not archives:
+        return ['архивные таблицы займов не читаются (архива нет - запустите с --seed)']
+    if not reads_archive and archives:
+        return [f'читает архивные таблицы {", ".join(archives)}']
+    return []
+
+async def capture_statements(client, engine, url: str, token: str) -> list:
+    """SQL, выполненный при обработке страницы (фоновые задачи приложения не учитываются)"""
+    captured = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if has_request_context() and not executemany:
+            captured.append((statement, parameters))
+
+    event.listen(engine.sync_engine, 'before_cursor_execute', capture)
+    try:
+        # Тестовый клиент принимает в адресе только ASCII - параметры передаются отдельно
+        path, _, query = url.partition('?')
+        response = await client.get(path, query_string=dict(parse_qsl(query)),
+                                    headers={'Authorization': f'Bearer {token}'})
+    finally:
+        event.remove(engine.sync_engine, 'before_cursor_execute', capture)
+    if response.status_code != 200:
+        raise RuntimeError(f'{url}: ответ {response.status_code}')
+    return captured
+
+async def main():
+    """Основная функция"""
+    parser = argparse.ArgumentParser(description='Проверка планов запросов основных страниц')
+    parser.add_argument('--seed', type=int, default=0, help='добавить N займов перед проверкой')
+    parser.add_argument('--budget', type=float, default=DEFAULT_COST_BUDGET, help='максимальная стоимость запроса')
+    args = parser.parse_args()
+
+    failures = 0
+    try:
+        async with app.test_app() as test_app:
+            engine = models.engine
+            if args.seed > 0:
+                await seed_dataset(engine, args.seed)
+                print(f"[OK] Добавлено займов: {args.seed}")
+
+            async with models.async_session_maker() as session:
+                loans = (await session.execute(select(func.count(Loan.Код_займа)))).scalar()
+                admin_id = (await session.execute(select(func.min(Employee.ID_Сотрудника)).where(
+                    Employee.Должность == 'Администратор'
+                ))).scalar()
+                manager_id = (await session.execute(select(func.min(Employee.ID_Сотрудника)).where(
+                    Employee.Должность == 'Менеджер-товаровед', Employee.Дата_Увольнения == None
+                ))).scalar()
+            if loans < MIN_LOANS:
+                print(f"[ERROR] В базе {loans} займов - планы не показательны, запустите с --seed {MIN_LOANS * 10}")
+                return 1
+
+            client = test_app.test_client()
+            users = [('администратор', admin_id), ('сотрудник филиала', manager_id)]
+            for user_name, employee_id in users:
+                if employee_id is None:
+                    print(f"[ERROR] Нет сотрудника для проверки ({user_name})")
+                    return 1
+                token = auth.dump_token(str(employee_id), app=app)
+                for name, url, allowed_seq_scans in PLAN_CHECKS:
+                    page_failures = failures
+                    for statement, parameters in await capture_statements(client, engine, url, token):
+                        if not statement.lstrip().upper().startswith(('SELECT', 'WITH', 'UPDATE', 'INSERT', 'DELETE')):
+                            continue
+                        plan = await explain(engine, statement, parameters)
+                        problems = plan_problems(plan, allowed_seq_scans, args.budget)
+                        if problems:
+                            failures += 1
+                            print(f"[ERROR] {name} ({user_name}): {'; '.join(problems)}")
+                            print(f"  {' '.join(statement.split())[:300]}")
+                    if failures == page_failures:
+                        print(f"[OK] {name} ({user_name})")
+
+            archive_start = date(date.today().year - config_obj.LOANS_ARCHIVE_AFTER_YEARS, 1, 1)
+            for name, condition, reads_archive in archive_checks(archive_start):
+                problems = await archive_problems(engine, condition, reads_archive)
+                if problems:
+                    failures += 1
+                    print(f"[ERROR] Архив займов: {name}: {'; '.join(problems)}")
+                else:
+                    print(f"[OK] Архив займов: {name}")
+    except Exception as e:
+        print(f"\n[ERROR] Произошла ошибка: {e}")
+        import traceback
+        traceback.print_exc()
+        return 1
+
+    if failures:
+        print(f"\n[ERROR] Регрессий планов: {failures}")
+        return 1
+    print("\n[OK] Планы запросов используют индексы")
+    return 0
+
+if __name__ == '__main__':
+    exit(asyncio.run(main()))
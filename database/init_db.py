@@ -21,9 +21,15 @@ sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 import asyncio
 from werkzeug.security import generate_password_hash
 from config import config
-from models import Base, Client, Loan, UnclaimedItem, Sale, InterestRate, Employee, async_session_maker, engine
+from models import (Base, Branch, Client, Loan, LoanStatusHistory, UnclaimedItem, Sale, InterestRate, Employee, ItemCategory, Product,
+                    async_session_maker, init_engine)
 from sqlalchemy import select, func, create_engine, text
 from sqlalchemy.orm import sessionmaker
+from database.maintain_partitions import create_sale_partitions
+from database.rebuild_branch_summary import rebuild_branch_summary
+
+config_obj = config[os.getenv('FLASK_ENV', 'development')]()
+engine = init_engine(config_obj.DATABASE_URI)
 
 # Списки для генерации данных (разделены по полу)
 MALE_FIRST_NAMES = [
@@ -137,6 +143,12 @@ PHYSICAL_CONDITIONS = ['Отличное', 'Хорошее', 'Удовлетво
 
 POSITIONS = ['Оценщик-товаровед', 'Менеджер-товаровед', 'Менеджер по продажам']
 
+BRANCHES = [
+    ('Центральный', 'ул. Ленина, 12'),
+    ('Северный', 'пр. Мира, 48'),
+    ('Южный', 'ул. Садовая, 7')
+]
+
 LOAN_STATUSES = ['Активен', 'Выплачен', 'Просрочен']
 
 async def create_tables():
@@ -145,7 +157,7 @@ async def create_tables():
     
     # Удаление таблиц если они существуют (с CASCADE для удаления зависимых объектов)
     async with engine.begin() as conn:
-        # Сначала удаляем таблицу логов, если она существует (она создается триггером)
+        # Сначала удаляем таблицу журнала изменений (в старых базах она создавалась триггером)
         try:
             await conn.execute(text('DROP TABLE IF EXISTS "Лог_изменений_займов" CASCADE'))
         except Exception:
@@ -169,6 +181,9 @@ async def create_tables():
         
         # Создаем таблицы заново
         await conn.run_sync(Base.metadata.create_all)
+        
+        # Годовые секции продаж: с первого года тестовых продаж и на несколько лет вперед
+        await create_sale_partitions(conn, 2020, date.today().year + config_obj.SALES_PARTITION_PREMAKE_YEARS)
     
     print("[OK] Таблицы созданы")
 
@@ -201,12 +216,26 @@ async def generate_interest_rates():
         await session.commit()
     print(f"[OK] Создано {len(rates)} записей в таблице Процент_по_займу")
 
+async def generate_branches():
+    """Генерация филиалов"""
+    print("Генерация филиалов...")
+    
+    async with async_session_maker() as session:
+        session.add_all(Branch(Название=name, Адрес=address) for name, address in BRANCHES)
+        await session.commit()
+    print(f"[OK] Создано {len(BRANCHES)} филиалов")
+
+async def load_branch_ids() -> list:
+    async with async_session_maker() as session:
+        return (await session.execute(select(Branch.ID_филиала).order_by(Branch.ID_филиала))).scalars().all()
+
 async def generate_clients(count=50):
     """Генерация клиентов"""
     print(f"Генерация {count} клиентов...")
     
     clients = []
     used_phones = set()
+    branch_ids = await load_branch_ids()
     
     for i in range(1, count + 1):
         # Генерация уникального телефона
@@ -233,7 +262,8 @@ async def generate_clients(count=50):
         client = Client(
             ID_Клиента=i,
             ФИО=fio,
-            Телефон=phone
+            Телефон=phone,
+            Филиал=random.choice(branch_ids)
         )
         clients.append(client)
     
@@ -248,6 +278,7 @@ async def generate_employees(count=45):
     
     employees = []
     used_phones = set()
+    branch_ids = await load_branch_ids()
     
     for i in range(1, count + 1):
         # Генерация уникального телефона
@@ -347,7 +378,7 @@ async def generate_employees(count=45):
         # Генерация пароля (по умолчанию: "password123" для всех, но можно изменить)
         # Для удобства тестирования используем простой пароль
         default_password = "password123"
-        hashed_password = generate_password_hash(default_password)
+        hashed_password = generate_password_hash(default_password, method=config_obj.PASSWORD_HASH_METHOD)
         
         employee = Employee(
             ID_Сотрудника=i,
@@ -357,7 +388,8 @@ async def generate_employees(count=45):
             Дата_Увольнения=dismiss_date,
             Телефон_Сотрудника=phone,
             Логин=login,
-            Пароль=hashed_password
+            Пароль=hashed_password,
+            Филиал=random.choice(branch_ids)
         )
         employees.append(employee)
     
@@ -386,7 +418,7 @@ async def create_admin_account():
         
         # Создаем администратора
         admin_password = "admin123"  # Пароль по умолчанию для админа
-        hashed_password = generate_password_hash(admin_password)
+        hashed_password = generate_password_hash(admin_password, method=config_obj.PASSWORD_HASH_METHOD)
         
         admin = Employee(
             ID_Сотрудника=next_id,
@@ -396,7 +428,8 @@ async def create_admin_account():
             Дата_Увольнения=None,
             Телефон_Сотрудника="79999999999",
             Логин="admin",
-            Пароль=hashed_password
+            Пароль=hashed_password,
+            Филиал=(await load_branch_ids())[0]
         )
         
         session.add(admin)
@@ -405,11 +438,34 @@ async def create_admin_account():
         print(f"     Логин: admin")
         print(f"     Пароль: admin123")
 
+async def generate_item_catalog():
+    """Заполнение справочников категорий и товаров из GOODS_DATA"""
+    print("Заполнение справочника товаров...")
+    
+    async with async_session_maker() as session:
+        products_count = 0
+        for category_name, goods in GOODS_DATA.items():
+            category = ItemCategory(Название=category_name)
+            session.add(category)
+            await session.flush()  # Получаем ID категории
+            session.add_all(Product(Наименование=goods_name, Категория=category.ID_категории) for goods_name, _, _ in goods)
+            products_count += len(goods)
+        await session.commit()
+    print(f"[OK] Создано {len(GOODS_DATA)} категорий и {products_count} товаров")
+
 async def generate_loans(count=250):
     """Генерация займов"""
     print(f"Генерация {count} займов...")
     
     async with async_session_maker() as session:
+        # Ключи товаров справочника по (категория, наименование)
+        products_result = await session.execute(
+            select(ItemCategory.Название, Product.Наименование, Product.ID_товара).join(
+                ItemCategory, Product.Категория == ItemCategory.ID_категории
+            )
+        )
+        product_ids = {(category, name): product_id for category, name, product_id in products_result}
+        
         clients_result = await session.execute(select(Client))
         clients = clients_result.scalars().all()
         
@@ -423,6 +479,11 @@ async def generate_loans(count=250):
             print("[ERROR] Недостаточно данных для создания займов")
             return
         
+        # Займ оформляет сотрудник филиала клиента (если в филиале нет сотрудников - любой)
+        employees_by_branch = {}
+        for employee in employees:
+            employees_by_branch.setdefault(employee.Филиал, []).append(employee)
+        
         today = date.today()
         # Создаем займы с датами от 2 лет назад до текущей даты
         # Это обеспечит наличие активных, просроченных и выплаченных займов
@@ -434,6 +495,7 @@ async def generate_loans(count=250):
         status_counts = {'Активен': 0, 'Просрочен': 0, 'Выплачен': 0}
         
         loans = []
+        status_history = []
         for i in range(1, count + 1):
             loan_date = start_date + timedelta(days=random.randint(0, date_range))
             # Убеждаемся, что дата займа не превышает текущую дату
@@ -441,7 +503,7 @@ async def generate_loans(count=250):
                 loan_date = today
             
             client = random.choice(clients)
-            employee = random.choice(employees)
+            employee = random.choice(employees_by_branch.get(client.Филиал, employees))
             
             # Выбираем случайный процент по займу
             interest_rate = random.choice(interest_rates)
@@ -500,14 +562,24 @@ async def generate_loans(count=250):
                 Статус_займа=status,
                 Состояние_товара=interest_rate.Состояние_товара,  # Процент из InterestRate
                 Артикул_товара=i,
-                Наименование_товара=goods_name,
-                Категория_товара=category,
+                Товар=product_ids[(category, goods_name)],
                 Физическое_состояние=physical_condition,
-                Исполнитель=employee.ID_Сотрудника
+                Исполнитель=employee.ID_Сотрудника,
+                Филиал=client.Филиал
             )
             loans.append(loan)
+            
+            # История статусов: выдача, затем просрочка (со дня после окончания) или выплата
+            status_history.append(LoanStatusHistory(Займ=i, Статус='Активен', Действует_с=loan_date))
+            if status == 'Просрочен':
+                status_history.append(LoanStatusHistory(Займ=i, Статус=status, Действует_с=end_date_loan + timedelta(days=1)))
+            elif status == 'Выплачен':
+                paid_days = (min(end_date_loan, today) - loan_date).days
+                paid_date = loan_date + timedelta(days=random.randint(0, max(paid_days, 0)))
+                status_history.append(LoanStatusHistory(Займ=i, Статус=status, Действует_с=paid_date))
         
         session.add_all(loans)
+        session.add_all(status_history)
         await session.commit()
     print(f"[OK] Создано {len(loans)} займов")
     print(f"  Статистика по статусам:")
@@ -534,10 +606,6 @@ async def generate_unclaimed_items():
         existing_loan_ids = {item[0] for item in existing_result.all()}
         
         items = []
-        # Находим максимальный артикул
-        max_article_result = await session.execute(select(func.max(UnclaimedItem.Артикул)))
-        max_article = max_article_result.scalar() or 0
-        article = max_article + 1
     
     # ВСЕ просроченные займы, для которых еще нет невостребованных товаров, должны их получить
     for loan in overdue_loans:
@@ -557,13 +625,14 @@ async def generate_unclaimed_items():
         if estimated_value > max_value:
             estimated_value = max_value
         
+        # Артикул равен коду займа, как и при автоматическом создании товаров в приложении
         item = UnclaimedItem(
-            Артикул=article,
+            Артикул=loan.Код_займа,
             Займ=loan.Код_займа,
-            Оценочная_стоимость=estimated_value
+            Оценочная_стоимость=estimated_value,
+            Филиал=loan.Филиал
         )
         items.append(item)
-        article += 1
     
         if items:
             session.add_all(items)
@@ -597,6 +666,11 @@ async def generate_sales(count=200):
             print("  Нет менеджеров по продажам")
             return
         
+        # Продает менеджер филиала, где находится товар (если в филиале нет менеджеров - любой)
+        sellers_by_branch = {}
+        for employee in sales_employees:
+            sellers_by_branch.setdefault(employee.Филиал, []).append(employee)
+        
         sales = []
         today = date.today()
         start_date = date(2020, 1, 1)
@@ -609,11 +683,8 @@ async def generate_sales(count=200):
         items_to_sell_count = int(len(unclaimed_items) * sell_percentage)
         items_to_sell = random.sample(unclaimed_items, items_to_sell_count)
         
-        # Находим максимальный код продажи
-        max_code_result = await session.execute(select(func.max(Sale.Код_продажи)))
-        max_code = max_code_result.scalar() or 0
-        
-        for i, item in enumerate(items_to_sell, 1):
+        # Коды продаж выдает последовательность при вставке
+        for item in items_to_sell:
             # Дата продажи после даты займа
             loan = await session.get(Loan, item.Займ)
             if loan:
@@ -635,15 +706,16 @@ async def generate_sales(count=200):
             else:
                 sale_date = start_date + timedelta(days=random.randint(0, date_range))
             
-            seller = random.choice(sales_employees)
+            seller = random.choice(sellers_by_branch.get(item.Филиал, sales_employees))
             
             sale = Sale(
-                Код_продажи=max_code + i,
                 Дата_продажи=sale_date,
                 Артикул_проданного_товара=item.Артикул,
-                Продавец=seller.ID_Сотрудника
+                Продавец=seller.ID_Сотрудника,
+                Филиал=item.Филиал
             )
             sales.append(sale)
+            item.Продан = True
         
         if sales:
             session.add_all(sales)
@@ -673,15 +745,21 @@ async def main():
         
         # Условно-постоянные данные (40-50 записей)
         await generate_interest_rates()  # 25 записей
+        await generate_branches()  # 3 филиала
         await generate_clients(50)  # 50 клиентов
         await generate_employees(45)  # 45 сотрудников
         await create_admin_account()  # Создание единственного администратора
+        await generate_item_catalog()  # Справочники категорий и товаров
         
         # Оперативно обновляющиеся данные (200-250 записей)
         await generate_loans(250)  # 250 займов
         unclaimed_count = await generate_unclaimed_items()  # ~60% от просроченных
         await generate_sales(200)  # 200 продаж
         
+        # Сводка по филиалам по созданным займам и продажам
+        async with engine.begin() as conn:
+            await rebuild_branch_summary(conn)
+        
         print("\n" + "=" * 60)
         print("[OK] База данных успешно инициализирована!")
         print("=" * 60)
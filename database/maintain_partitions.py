@@ -0,0 +1,242 @@
+"""
+Обслуживание секций таблицы продаж (секционирование по годам по Дата_продажи) и архива займов
+Использование: python database/maintain_partitions.py [--archive]
+
+Создает секции на текущий год и SALES_PARTITION_PREMAKE_YEARS лет вперед, чтобы новые
+продажи не попадали в секцию по умолчанию. С ключом --archive переносит секции старше
+SALES_ARCHIVE_AFTER_YEARS лет в табличное пространство ARCHIVE_TABLESPACE и переносит
+выплаченные займы старше LOANS_ARCHIVE_AFTER_YEARS лет в архивные таблицы по годам.
+
+Займ нельзя секционировать декларативно: на Код_займа ссылаются внешние ключи, а уникальное
+ограничение секционированной таблицы обязано включать ключ секционирования. Поэтому архивные
+таблицы займов (Займ_архив_<год>) - наследники таблицы Займ с ограничением CHECK по статусу
+и году займа. Запросы к Займ читают и наследников, а планировщик отбрасывает архивные таблицы
+по ограничению (constraint_exclusion = partition, значение по умолчанию) - запросы по
+невыплаченным займам и за недавние периоды их не читают. Отбрасывание выполняется только при
+планировании с известными значениями параметров, поэтому соединения приложения используют
+plan_cache_mode = force_custom_plan (см. models.init_engine). Вместе с займом переносится его
+история статусов (История_статусов_займа_архив_<год>). Внешние ключи основных таблиц
+повторяются на архивных; история архивного займа ссылается на архивную таблицу займов.
+Займы с невостребованными товарами не переносятся. Выплаченный займ не меняет статус, поэтому
+новые записи на архивный займ не ссылаются: внешние ключи на Займ видят только основную таблицу.
+Скрипт идемпотентен - его можно запускать по расписанию (например, раз в месяц из cron).
+"""
+import sys
+import os
+
+# Устанавливаем кодировку для Windows консоли
+if sys.platform == 'win32':
+    import io
+    sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8', errors='replace')
+    sys.stderr = io.TextIOWrapper(sys.stderr.buffer, encoding='utf-8', errors='replace')
+
+# Добавляем корневую директорию в путь
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import asyncio
+from datetime import date
+from config import config
+from models import init_engine
+from sqlalchemy import text
+
+SALES_TABLE = 'Продажа'
+SALES_COLUMNS = '"Код_продажи", "Дата_продажи", "Артикул_проданного_товара", "Продавец", "Филиал"'
+LOANS_TABLE = 'Займ'
+LOAN_HISTORY_TABLE = 'История_статусов_займа'
+# Займы, которые переносятся в архив
+ARCHIVABLE_LOANS = f'''"Статус_займа" = 'Выплачен' AND "Дата_займа" >= :start AND "Дата_займа" < :end
+    AND NOT EXISTS (SELECT 1 FROM "Невостребованный_товар" i WHERE i."Займ" = "{LOANS_TABLE}"."Код_займа")'''
+
+def sale_partition_name(year: int) -> str:
+    return f'{SALES_TABLE}_{year}'
+
+async def is_partitioned(conn, table: str) -> bool:
+    result = await conn.execute(text(
+        'SELECT 1 FROM pg_partitioned_table p JOIN pg_class c ON c.oid = p.partrelid WHERE c.relname = :table'
+    ), {'table': table})
+    return result.scalar() is not None
+
+async def existing_sale_partitions(conn) -> dict:
+    """Годовые секции продаж: {год: табличное пространство или None}"""
+    result = await conn.execute(text('''
+        SELECT c.relname, t.spcname
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        JOIN pg_class p ON p.oid = i.inhparent
+        LEFT JOIN pg_tablespace t ON t.oid = c.reltablespace
+        WHERE p.relname = :table
+    '''), {'table': SALES_TABLE})
+    prefix = f'{SALES_TABLE}_'
+    return {
+        int(name[len(prefix):]): tablespace
+        for name, tablespace in result
+        if name[len(prefix):].isdigit()
+    }
+
+async def create_sale_partitions(conn, first_year: int, last_year: int) -> list:
+    """Создание секции по умолчанию и годовых секций за [first_year, last_year].
+    Если строки нового года уже попали в секцию по умолчанию, она временно отсоединяется
+    и строки переносятся в созданную секцию. Возвращает список созданных годов."""
+    await conn.execute(text(f'CREATE TABLE IF NOT EXISTS "{SALES_TABLE}_default" PARTITION OF "{SALES_TABLE}" DEFAULT'))
+    existing = await existing_sale_partitions(conn)
+    created = []
+    for year in range(first_year, last_year + 1):
+        if year in existing:
+            continue
+        bounds = {'start': date(year, 1, 1), 'end': date(year + 1, 1, 1)}
+        stray = await conn.execute(text(
+            f'SELECT 1 FROM "{SALES_TABLE}_default" WHERE "Дата_продажи" >= :start AND "Дата_продажи" < :end LIMIT 1'
+        ), bounds)
+        partition_sql = (f'CREATE TABLE "{sale_partition_name(year)}" PARTITION OF "{SALES_TABLE}" '
+                         f"FOR VALUES FROM ('{bounds['start']}') TO ('{bounds['end']}')")
+        if stray.scalar() is None:
+            await conn.execute(text(partition_sql))
+        else:
+            await conn.execute(text(f'ALTER TABLE "{SALES_TABLE}" DETACH PARTITION "{SALES_TABLE}_default"'))
+            await conn.execute(text(partition_sql))
+            await conn.execute(text(
+                f'INSERT INTO "{SALES_TABLE}" ({SALES_COLUMNS}) SELECT {SALES_COLUMNS} FROM "{SALES_TABLE}_default" '
+                f'WHERE "Дата_продажи" >= :start AND "Дата_продажи" < :end'
+            ), bounds)
+            await conn.execute(text(
+                f'DELETE FROM "{SALES_TABLE}_default" WHERE "Дата_продажи" >= :start AND "Дата_продажи" < :end'
+            ), bounds)
+            await conn.execute(text(f'ALTER TABLE "{SALES_TABLE}" ATTACH PARTITION "{SALES_TABLE}_default" DEFAULT'))
+        created.append(year)
+    return created
+
+async def archive_sale_partitions(conn, before_year: int, tablespace: str) -> list:
+    """Перенос годовых секций ранее before_year в архивное табличное пространство.
+    Возвращает список перенесенных годов."""
+    moved = []
+    for year, current in sorted((await existing_sale_partitions(conn)).items()):
+        if year < before_year and current != tablespace:
+            await conn.execute(text(f'ALTER TABLE "{sale_partition_name(year)}" SET TABLESPACE "{tablespace}"'))
+            moved.append(year)
+    return moved
+
+def loan_archive_name(table: str, year: int) -> str:
+    return f'{table}_архив_{year}'
+
+async def table_exists(conn, table: str) -> bool:
+    result = await conn.execute(text('SELECT to_regclass(:name)'), {'name': f'"{table}"'})
+    return result.scalar() is not None
+
+async def table_columns(conn, table: str) -> list:
+    """Столбцы таблицы в порядке объявления (без удаленных)"""
+    result = await conn.execute(text(
+        'SELECT attname FROM pg_attribute WHERE attrelid = to_regclass(:name) AND attnum > 0 '
+        'AND NOT attisdropped ORDER BY attnum'
+    ), {'name': f'"{table}"'})
+    return [f'"{name}"' for name in result.scalars()]
+
+async def copy_foreign_keys(conn, source: str, target: str, references: dict = None):
+    """Повторяет внешние ключи source на target (LIKE их не копирует).
+    references - замена таблиц, на которые ссылаются ключи: {прежняя: новая}"""
+    result = await conn.execute(text(
+        "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint WHERE conrelid = to_regclass(:name) AND contype = 'f'"
+    ), {'name': f'"{source}"'})
+    for name, definition in result.all():
+        for old, new in (references or {}).items():
+            definition = definition.replace(f'REFERENCES "{old}"(', f'REFERENCES "{new}"(')
+        await conn.exec_driver_sql(f'ALTER TABLE "{target}" ADD CONSTRAINT "{name}" {definition}')
+
+async def create_loan_archive(conn, year: int, tablespace: str = '') -> bool:
+    """Архивные таблицы займов и истории статусов за год - наследники основных таблиц
+    с теми же столбцами, индексами и внешними ключами. Возвращает True, если таблицы созданы."""
+    loans_archive = loan_archive_name(LOANS_TABLE, year)
+    if await table_exists(conn, loans_archive):
+        return False
+    tablespace_sql = f' TABLESPACE "{tablespace}"' if tablespace else ''
+    like = 'INCLUDING DEFAULTS INCLUDING CONSTRAINTS INCLUDING INDEXES'
+    await conn.execute(text(
+        f'CREATE TABLE "{loans_archive}" (LIKE "{LOANS_TABLE}" {like}, '
+        f'CONSTRAINT "{loans_archive}_check" CHECK ("Статус_займа" = \'Выплачен\' '
+        f"AND \"Дата_займа\" >= '{date(year, 1, 1)}' AND \"Дата_займа\" < '{date(year + 1, 1, 1)}')){tablespace_sql}"
+    ))
+    await conn.execute(text(f'ALTER TABLE "{loans_archive}" INHERIT "{LOANS_TABLE}"'))
+    await copy_foreign_keys(conn, LOANS_TABLE, loans_archive)
+    history_archive = loan_archive_name(LOAN_HISTORY_TABLE, year)
+    await conn.execute(text(f'CREATE TABLE "{history_archive}" (LIKE "{LOAN_HISTORY_TABLE}" {like}){tablespace_sql}'))
+    await conn.execute(text(f'ALTER TABLE "{history_archive}" INHERIT "{LOAN_HISTORY_TABLE}"'))
+    await copy_foreign_keys(conn, LOAN_HISTORY_TABLE, history_archive, {LOANS_TABLE: loans_archive})
+    return True
+
+async def archive_paid_loans(conn, before_year: int, tablespace: str = '') -> dict:
+    """Перенос выплаченных займов с датой займа ранее before_year и их истории статусов в архивные
+    таблицы по годам. Займы и история переносятся одной командой на год (DELETE ... RETURNING
+    и INSERT в WITH): внешние ключи проверяются в конце команды, когда история в основной таблице
+    уже не ссылается на перенесенные займы, а архивная история ссылается на архивные займы.
+    Столбцы перечисляются явно по основным таблицам. Возвращает {год: число перенесенных займов}."""
+    years = (await conn.execute(text(
+        f'SELECT DISTINCT EXTRACT(YEAR FROM "Дата_займа")::int FROM ONLY "{LOANS_TABLE}" '
+        f'WHERE "Статус_займа" = \'Выплачен\' AND "Дата_займа" < :before ORDER BY 1'
+    ), {'before': date(before_year, 1, 1)})).scalars().all()
+    moved = {}
+    for year in years:
+        await create_loan_archive(conn, year, tablespace)
+        bounds = {'start': date(year, 1, 1), 'end': date(year + 1, 1, 1)}
+        loan_columns = ', '.join(await table_columns(conn, LOANS_TABLE))
+        history_columns = await table_columns(conn, LOAN_HISTORY_TABLE)
+        history_returning = ', '.join(f'h.{column}' for column in history_columns)
+        history_columns = ', '.join(history_columns)
+        count = (await conn.execute(text(
+            f'WITH loans AS (DELETE FROM ONLY "{LOANS_TABLE}" WHERE {ARCHIVABLE_LOANS} RETURNING {loan_columns}), '
+            f'archived AS (INSERT INTO "{loan_archive_name(LOANS_TABLE, year)}" ({loan_columns}) '
+            f'SELECT {loan_columns} FROM loans RETURNING 1), '
+            f'history AS (DELETE FROM ONLY "{LOAN_HISTORY_TABLE}" h USING loans '
+            f'WHERE h."Займ" = loans."Код_займа" RETURNING {history_returning}), '
+            f'archived_history AS (INSERT INTO "{loan_archive_name(LOAN_HISTORY_TABLE, year)}" ({history_columns}) '
+            f'SELECT {history_columns} FROM history) '
+            f'SELECT count(*) FROM archived'
+        ), bounds)).scalar()
+        if count:
+            moved[year] = count
+    return moved
+
+async def main():
+    """Основная функция"""
+    config_obj = config[os.getenv('FLASK_ENV', 'development')]()
+    engine = init_engine(config_obj.DATABASE_URI)
+    archive = '--archive' in sys.argv[1:]
+    this_year = date.today().year
+
+    try:
+        async with engine.begin() as conn:
+            if not await is_partitioned(conn, SALES_TABLE):
+                print(f"[ERROR] Таблица {SALES_TABLE} не секционирована - сначала выполните database/upgrade_db.py")
+                return 1
+            created = await create_sale_partitions(conn, this_year, this_year + config_obj.SALES_PARTITION_PREMAKE_YEARS)
+        print(f"[OK] Секции продаж созданы: {', '.join(map(str, created))}" if created else "[OK] Секции продаж уже созданы")
+
+        if archive:
+            async with engine.begin() as conn:
+                moved_loans = await archive_paid_loans(
+                    conn, this_year - config_obj.LOANS_ARCHIVE_AFTER_YEARS, config_obj.ARCHIVE_TABLESPACE
+                )
+            if moved_loans:
+                print(f"[OK] В архив перенесены выплаченные займы: "
+                      f"{', '.join(f'{year} - {count}' for year, count in moved_loans.items())}")
+            else:
+                print("[OK] Новых выплаченных займов для архива нет")
+
+            if not config_obj.ARCHIVE_TABLESPACE:
+                print("[OK] ARCHIVE_TABLESPACE не задан - архивные секции остаются на месте")
+            else:
+                async with engine.begin() as conn:
+                    moved = await archive_sale_partitions(
+                        conn, this_year - config_obj.SALES_ARCHIVE_AFTER_YEARS, config_obj.ARCHIVE_TABLESPACE
+                    )
+                print(f"[OK] В архив перенесены секции: {', '.join(map(str, moved))}" if moved else "[OK] Новых архивных секций нет")
+    except Exception as e:
+        print(f"\n[ERROR] Произошла ошибка: {e}")
+        import traceback
+        traceback.print_exc()
+        return 1
+    finally:
+        await engine.dispose()
+
+    return 0
+
+if __name__ == '__main__':
+    exit(asyncio.run(main()))
@@ -0,0 +1,65 @@
+"""
+Полный пересчет сводки по филиалам (Сводка_по_филиалам) по займам и продажам
+Использование: python database/rebuild_branch_summary.py
+
+Приложение обновляет сводку приращениями при каждом новом займе и продаже; пересчет
+нужен после заполнения или обновления базы скриптами и для сверки.
+"""
+import sys
+import os
+
+# Устанавливаем кодировку для Windows консоли
+if sys.platform == 'win32':
+    import io
+    sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8', errors='replace')
+    sys.stderr = io.TextIOWrapper(sys.stderr.buffer, encoding='utf-8', errors='replace')
+
+# Добавляем корневую директорию в путь
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import asyncio
+from config import config
+from models import init_engine
+from sqlalchemy import text
+
+REBUILD_STATEMENTS = [
+    'DELETE FROM "Сводка_по_филиалам"',
+    '''INSERT INTO "Сводка_по_филиалам" ("Филиал", "Дата", "Выдано_займов", "Сумма_займов", "Продано_товаров")
+       SELECT "Филиал", "Дата", SUM(loans), SUM(amount), SUM(sales)
+       FROM (
+           SELECT "Филиал", "Дата_займа" AS "Дата", COUNT(*) AS loans, SUM("Размер_займа") AS amount, 0 AS sales
+           FROM "Займ" GROUP BY "Филиал", "Дата_займа"
+           UNION ALL
+           SELECT "Филиал", "Дата_продажи", 0, 0, COUNT(*)
+           FROM "Продажа" GROUP BY "Филиал", "Дата_продажи"
+       ) daily
+       GROUP BY "Филиал", "Дата"''',
+]
+
+async def rebuild_branch_summary(conn) -> int:
+    """Пересчитывает сводку в транзакции соединения conn; возвращает число строк сводки"""
+    result = None
+    for statement in REBUILD_STATEMENTS:
+        result = await conn.execute(text(statement))
+    return result.rowcount
+
+async def main():
+    """Основная функция"""
+    config_obj = config[os.getenv('FLASK_ENV', 'development')]()
+    engine = init_engine(config_obj.DATABASE_URI)
+    try:
+        async with engine.begin() as conn:
+            rows = await rebuild_branch_summary(conn)
+        print(f"[OK] Сводка по филиалам пересчитана ({rows} строк)")
+    except Exception as e:
+        print(f"\n[ERROR] Произошла ошибка: {e}")
+        import traceback
+        traceback.print_exc()
+        return 1
+    finally:
+        await engine.dispose()
+
+    return 0
+
+if __name__ == '__main__':
+    exit(asyncio.run(main()))
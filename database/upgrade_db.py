@@ -0,0 +1,236 @@
+"""
+Скрипт для обновления структуры существующей базы данных PostgreSQL без потери данных
+Использование: python database/upgrade_db.py
+
+Все шаги идемпотентны - скрипт можно запускать повторно.
+"""
+import sys
+import os
+
+# Устанавливаем кодировку для Windows консоли
+if sys.platform == 'win32':
+    import io
+    sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8', errors='replace')
+    sys.stderr = io.TextIOWrapper(sys.stderr.buffer, encoding='utf-8', errors='replace')
+
+# Добавляем корневую директорию в путь
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import asyncio
+from config import config
+from models import Base, Sale, init_engine
+from sqlalchemy import text
+from datetime import date
+from database.maintain_partitions import SALES_TABLE, SALES_COLUMNS, is_partitioned, create_sale_partitions
+from database.rebuild_branch_summary import rebuild_branch_summary
+
+config_obj = config[os.getenv('FLASK_ENV', 'development')]()
+engine = init_engine(config_obj.DATABASE_URI)
+
+# Таблицы с данными филиала; существующие записи относятся к филиалу 1
+BRANCH_TABLES = ['Клиент', 'Сотрудник', 'Займ', 'Невостребованный_товар', 'Продажа']
+
+# Шаги обновления: (описание, список SQL-команд)
+UPGRADE_STEPS = [
+    ('Индексы для автоматического создания невостребованных товаров', [
+        'CREATE INDEX IF NOT EXISTS "ix_Займ_Статус_займа" ON "Займ" ("Статус_займа")',
+        'CREATE INDEX IF NOT EXISTS "ix_Невостребованный_товар_Займ" ON "Невостребованный_товар" ("Займ")',
+    ]),
+    ('Признак продажи невостребованного товара', [
+        'ALTER TABLE "Невостребованный_товар" ADD COLUMN IF NOT EXISTS "Продан" BOOLEAN NOT NULL DEFAULT false',
+        '''UPDATE "Невостребованный_товар" u SET "Продан" = true
+           WHERE NOT u."Продан"
+             AND EXISTS (SELECT 1 FROM "Продажа" s WHERE s."Артикул_проданного_товара" = u."Артикул")''',
+        '''CREATE INDEX IF NOT EXISTS "ix_Невостребованный_товар_непроданные"
+           ON "Невостребованный_товар" ("Артикул") WHERE NOT "Продан"''',
+    ]),
+    ('Индекс истории займов клиента', [
+        'CREATE INDEX IF NOT EXISTS "ix_Займ_Клиент_Дата_займа" ON "Займ" ("Клиент", "Дата_займа")',
+    ]),
+    ('Индексы по датам займов и продаж для отчетов за период', [
+        'CREATE INDEX IF NOT EXISTS "ix_Займ_Дата_займа" ON "Займ" ("Дата_займа")',
+        'CREATE INDEX IF NOT EXISTS "ix_Продажа_Дата_продажи" ON "Продажа" ("Дата_продажи")',
+    ]),
+    ('Частичный индекс по невыплаченным займам', [
+        """CREATE INDEX IF NOT EXISTS "ix_Займ_невыплаченные"
+           ON "Займ" ("Статус_займа", "Дата_займа") WHERE "Статус_займа" <> 'Выплачен'""",
+    ]),
+    ('Филиалы: филиал по умолчанию и привязка данных', [
+        '''INSERT INTO "Филиал" ("ID_филиала", "Название") VALUES (1, 'Основной филиал') ON CONFLICT DO NOTHING''',
+        '''SELECT setval(pg_get_serial_sequence('"Филиал"', 'ID_филиала'), (SELECT MAX("ID_филиала") FROM "Филиал"))''',
+        *(f'''ALTER TABLE "{table}" ADD COLUMN IF NOT EXISTS "Филиал" INTEGER NOT NULL DEFAULT 1
+              REFERENCES "Филиал" ("ID_филиала")''' for table in BRANCH_TABLES),
+        *(f'ALTER TABLE "{table}" ALTER COLUMN "Филиал" DROP DEFAULT' for table in BRANCH_TABLES),
+    ]),
+    ('История статусов займов для существующих займов', [
+        # Выдача - с даты займа; просрочка - со дня после даты окончания; выплата - с даты из журнала
+        # изменений, а если ее там нет - с даты окончания займа (не позже сегодняшнего дня)
+        '''INSERT INTO "История_статусов_займа" ("Займ", "Статус", "Действует_с")
+           SELECT z."Код_займа", s."Статус", s."Действует_с"
+           FROM "Займ" z
+           CROSS JOIN LATERAL (
+               SELECT CAST(z."Дата_займа" + make_interval(0, CAST(trunc(z."Срок_займа") AS INTEGER)) AS DATE) AS end_date
+           ) e
+           CROSS JOIN LATERAL (VALUES
+               ('Активен', z."Дата_займа"),
+               (CASE WHEN z."Статус_займа" <> 'Активен' THEN z."Статус_займа" END,
+                CASE z."Статус_займа"
+                    WHEN 'Просрочен' THEN e.end_date + 1
+                    WHEN 'Выплачен' THEN COALESCE(
+                        (SELECT MIN(l."Дата_изменения")::date FROM "Лог_изменений_займов" l
+                         WHERE l."Таблица" = 'Займ' AND l."Код_записи" = z."Код_займа" AND l."Действие" = 'Выплата'),
+                        LEAST(e.end_date, CURRENT_DATE))
+                END)
+           ) AS s("Статус", "Действует_с")
+           WHERE s."Статус" IS NOT NULL
+             AND NOT EXISTS (SELECT 1 FROM "История_статусов_займа" h WHERE h."Займ" = z."Код_займа")''',
+    ]),
+    ('Индексы по филиалам', [
+        'CREATE INDEX IF NOT EXISTS "ix_Клиент_Филиал" ON "Клиент" ("Филиал", "ID_Клиента")',
+        'CREATE INDEX IF NOT EXISTS "ix_Сотрудник_Филиал" ON "Сотрудник" ("Филиал", "ID_Сотрудника")',
+        'CREATE INDEX IF NOT EXISTS "ix_Займ_Филиал_Статус_займа" ON "Займ" ("Филиал", "Статус_займа")',
+        'CREATE INDEX IF NOT EXISTS "ix_Займ_Филиал_Дата_займа" ON "Займ" ("Филиал", "Дата_займа")',
+        'CREATE INDEX IF NOT EXISTS "ix_Невостребованный_товар_Филиал" ON "Невостребованный_товар" ("Филиал", "Артикул")',
+        'CREATE INDEX IF NOT EXISTS "ix_Продажа_Филиал_Дата_продажи" ON "Продажа" ("Филиал", "Дата_продажи")',
+    ]),
+    ('Индекс продаж по артикулу товара', [
+        'CREATE INDEX IF NOT EXISTS "ix_Продажа_Артикул_проданного_товара" ON "Продажа" ("Артикул_проданного_товара")',
+    ]),
+    # create_all не создает последовательность для уже существующей таблицы продаж. В базе, созданной
+    # до секционирования, она принадлежит столбцу SERIAL и удалялась бы вместе с прежней таблицей
+    # при секционировании, поэтому отвязывается от столбца
+    ('Последовательность кодов продаж', [
+        'CREATE SEQUENCE IF NOT EXISTS "Продажа_Код_продажи_seq"',
+        'ALTER SEQUENCE "Продажа_Код_продажи_seq" OWNED BY NONE',
+        '''SELECT setval('"Продажа_Код_продажи_seq"', GREATEST(
+               (SELECT COALESCE(MAX("Код_продажи"), 0) FROM "Продажа"),
+               (SELECT last_value FROM "Продажа_Код_продажи_seq")))''',
+    ]),
+]
+
+# Размер пакета займов при переносе наименований и категорий товаров в справочники
+CATALOG_BATCH_SIZE = 5000
+
+async def create_missing_tables():
+    """Создание новых таблиц (существующие не изменяются)"""
+    print("Создание недостающих таблиц...")
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    print("[OK] Таблицы проверены")
+
+async def apply_upgrade_steps():
+    """Применение шагов обновления, каждый шаг - в отдельной транзакции"""
+    for description, statements in UPGRADE_STEPS:
+        print(f"{description}...")
+        async with engine.begin() as conn:
+            for statement in statements:
+                await conn.execute(text(statement))
+        print(f"[OK] {description}")
+
+async def column_exists(conn, table: str, column: str) -> bool:
+    result = await conn.execute(text(
+        'SELECT 1 FROM information_schema.columns WHERE table_name = :table AND column_name = :column'
+    ), {'table': table, 'column': column})
+    return result.scalar() is not None
+
+async def migrate_item_catalog():
+    """Перенос наименований и категорий товаров займов в справочники Товар и Категория_товара.
+    Займы обновляются пакетами по CATALOG_BATCH_SIZE, каждый пакет - в отдельной транзакции,
+    чтобы не блокировать таблицу займов надолго. После переноса строковые столбцы удаляются."""
+    print("Перенос товаров займов в справочники...")
+    async with engine.begin() as conn:
+        if not await column_exists(conn, 'Займ', 'Наименование_товара'):
+            print("[OK] Справочник товаров уже используется")
+            return
+        await conn.execute(text('ALTER TABLE "Займ" ADD COLUMN IF NOT EXISTS "Товар" INTEGER REFERENCES "Товар" ("ID_товара")'))
+        await conn.execute(text('''INSERT INTO "Категория_товара" ("Название")
+           SELECT DISTINCT "Категория_товара" FROM "Займ" ON CONFLICT DO NOTHING'''))
+        await conn.execute(text('''INSERT INTO "Товар" ("Наименование", "Категория")
+           SELECT DISTINCT z."Наименование_товара", c."ID_категории"
+           FROM "Займ" z JOIN "Категория_товара" c ON c."Название" = z."Категория_товара"
+           ON CONFLICT DO NOTHING'''))
+    
+    # Пакеты - диапазоны первичного ключа: каждый пакет читает только свои строки по индексу,
+    # а не ищет оставшиеся займы без товара по всей таблице
+    migrated = 0
+    last_code = 0
+    while True:
+        async with engine.begin() as conn:
+            batch_end = (await conn.execute(text('''SELECT MAX("Код_займа") FROM (
+                   SELECT "Код_займа" FROM "Займ" WHERE "Код_займа" > :last ORDER BY "Код_займа" LIMIT :batch) batch'''),
+                {'last': last_code, 'batch': CATALOG_BATCH_SIZE})).scalar()
+            if batch_end is None:
+                break
+            result = await conn.execute(text('''UPDATE "Займ" z SET "Товар" = t."ID_товара"
+               FROM "Товар" t JOIN "Категория_товара" c ON c."ID_категории" = t."Категория"
+               WHERE z."Код_займа" > :last AND z."Код_займа" <= :batch_end AND z."Товар" IS NULL
+                 AND t."Наименование" = z."Наименование_товара"
+                 AND c."Название" = z."Категория_товара"'''), {'last': last_code, 'batch_end': batch_end})
+        last_code = batch_end
+        migrated += result.rowcount
+        print(f"  перенесено займов: {migrated}")
+    
+    async with engine.begin() as conn:
+        for statement in [
+            'ALTER TABLE "Займ" ALTER COLUMN "Товар" SET NOT NULL',
+            'CREATE INDEX IF NOT EXISTS "ix_Займ_Товар" ON "Займ" ("Товар")',
+            'ALTER TABLE "Займ" DROP COLUMN "Наименование_товара"',
+            'ALTER TABLE "Займ" DROP COLUMN "Категория_товара"',
+        ]:
+            await conn.execute(text(statement))
+    print(f"[OK] Товары займов перенесены в справочники ({migrated} займов)")
+
+async def partition_sales():
+    """Перевод таблицы продаж в секционированную по годам по Дата_продажи.
+    Выполняется в одной транзакции: прежняя таблица переименовывается, создается секционированная
+    с секциями за все годы продаж, строки копируются, прежняя таблица удаляется."""
+    print("Секционирование таблицы продаж...")
+    async with engine.begin() as conn:
+        if await is_partitioned(conn, SALES_TABLE):
+            print("[OK] Таблица продаж уже секционирована")
+            return
+        await conn.execute(text(f'ALTER TABLE "{SALES_TABLE}" RENAME TO "{SALES_TABLE}_old"'))
+        await conn.execute(text(f'ALTER TABLE "{SALES_TABLE}_old" RENAME CONSTRAINT "{SALES_TABLE}_pkey" TO "{SALES_TABLE}_old_pkey"'))
+        for index in Sale.__table__.indexes:
+            await conn.execute(text(f'DROP INDEX IF EXISTS "{index.name}"'))
+        # Последовательность кодов продаж уже существует
+        await conn.run_sync(Sale.__table__.create, checkfirst=True)
+        
+        first_year = (await conn.execute(text(
+            f'SELECT EXTRACT(YEAR FROM MIN("Дата_продажи"))::int FROM "{SALES_TABLE}_old"'
+        ))).scalar() or date.today().year
+        await create_sale_partitions(conn, first_year, date.today().year + config_obj.SALES_PARTITION_PREMAKE_YEARS)
+        result = await conn.execute(text(
+            f'INSERT INTO "{SALES_TABLE}" ({SALES_COLUMNS}) SELECT {SALES_COLUMNS} FROM "{SALES_TABLE}_old"'
+        ))
+        await conn.execute(text(f'DROP TABLE "{SALES_TABLE}_old"'))
+    print(f"[OK] Таблица продаж секционирована ({result.rowcount} продаж)")
+
+async def main():
+    """Основная функция"""
+    print("=" * 60)
+    print("Обновление базы данных CRM-системы ломбарда")
+    print("=" * 60)
+
+    try:
+        await create_missing_tables()
+        await apply_upgrade_steps()
+        await migrate_item_catalog()
+        await partition_sales()
+        async with engine.begin() as conn:
+            rows = await rebuild_branch_summary(conn)
+        print(f"[OK] Сводка по филиалам пересчитана ({rows} строк)")
+
+        print("\n" + "=" * 60)
+        print("[OK] База данных успешно обновлена!")
+        print("=" * 60)
+    except Exception as e:
+        print(f"\n[ERROR] Произошла ошибка: {e}")
+        import traceback
+        traceback.print_exc()
+        return 1
+
+    return 0
+
+if __name__ == '__main__':
+    exit(asyncio.run(main()))
@@ -1,48 +1,91 @@
-from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine, async_sessionmaker
+from sqlalchemy.ext.asyncio import AsyncSession, AsyncEngine, create_async_engine, async_sessionmaker
 from sqlalchemy.orm import DeclarativeBase, relationship, Mapped, mapped_column
-from sqlalchemy import Integer, String, Date, Numeric, ForeignKey
-from datetime import date
+from sqlalchemy import Integer, BigInteger, String, Text, Date, DateTime, Numeric, Boolean, ForeignKey, Index, Sequence, UniqueConstraint, false, text
+from datetime import date, datetime
 from decimal import Decimal
-import os
-from config import config
+import asyncio
 
 # Базовый класс для моделей
 class Base(DeclarativeBase):
     pass
 
-# Создание асинхронного движка
-config_name = os.getenv('FLASK_ENV', 'development')
-config_obj = config[config_name]()
-engine = create_async_engine(
-    config_obj.DATABASE_URI,
-    echo=False,
-    pool_pre_ping=True,  # Проверка соединения перед использованием
-    pool_size=5,  # Размер пула соединений
-    max_overflow=10,  # Максимальное количество дополнительных соединений
-    pool_recycle=3600  # Переподключение каждые 3600 секунд
-)
-
-# Создание фабрики сессий
-async_session_maker = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+# Асинхронный движок создается не при импорте, а явно при запуске приложения (init_engine)
+engine: AsyncEngine | None = None
+
+# Фабрика сессий; привязывается к движку в init_engine
+async_session_maker = async_sessionmaker(class_=AsyncSession, expire_on_commit=False)
+
+def init_engine(database_uri: str, pool_size: int = 5, max_overflow: int = 10) -> AsyncEngine:
+    """Создает асинхронный движок (однократно) и привязывает к нему фабрику сессий"""
+    global engine
+    if engine is None:
+        engine = create_async_engine(
+            database_uri,
+            echo=False,
+            pool_pre_ping=True,  # Проверка соединения перед использованием
+            pool_size=pool_size,  # Размер пула соединений
+            max_overflow=max_overflow,  # Максимальное количество дополнительных соединений
+            pool_recycle=3600,  # Переподключение каждые 3600 секунд
+            # asyncpg подготавливает запросы, и PostgreSQL может перейти на общий план без значений
+            # параметров - в нем архивные таблицы займов не отбрасываются по ограничению CHECK
+            connect_args={'server_settings': {'plan_cache_mode': 'force_custom_plan'}}
+        )
+        async_session_maker.configure(bind=engine)
+    return engine
+
+async def warm_up_pool(connections: int):
+    """Заранее открывает указанное число соединений, чтобы первые запросы не ждали подключения"""
+    if engine is None or connections <= 0:
+        return
+    opened = await asyncio.gather(*(engine.connect() for _ in range(connections)))
+    for connection in opened:
+        await connection.close()
+
+async def dispose_engine():
+    """Закрывает все соединения пула при остановке приложения"""
+    global engine
+    if engine is not None:
+        await engine.dispose()
+        engine = None
 
 # Функция для получения сессии
 async def get_session():
     async with async_session_maker() as session:
         yield session
 
-class Client(Base):
+class Branch(Base):
+    __tablename__ = 'Филиал'
+    
+    ID_филиала: Mapped[int] = mapped_column(Integer, primary_key=True, nullable=False)
+    Название: Mapped[str] = mapped_column(String(100), nullable=False, unique=True)
+    Адрес: Mapped[str | None] = mapped_column(String(200), nullable=True)
+    
+    def __repr__(self):
+        return f'<Branch {self.Название}>'
+
+class BranchScoped:
+    """Примесь для данных филиала. Выборки через сессию сотрудника ограничиваются его филиалом
+    (см. scope_to_branch в app.py); ключи записей остаются сквозными для всех филиалов, а индексы
+    по этим таблицам начинаются с Филиал"""
+    Филиал: Mapped[int] = mapped_column(Integer, ForeignKey('Филиал.ID_филиала'), nullable=False)
+
+class Client(BranchScoped, Base):
     __tablename__ = 'Клиент'
     
     ID_Клиента: Mapped[int] = mapped_column(Integer, primary_key=True, nullable=False)
     ФИО: Mapped[str] = mapped_column(String(100), nullable=False)
     Телефон: Mapped[str] = mapped_column(String(16), nullable=False, unique=True)
     
+    __table_args__ = (
+        Index('ix_Клиент_Филиал', 'Филиал', 'ID_Клиента'),
+    )
+    
     loans: Mapped[list['Loan']] = relationship('Loan', back_populates='client', lazy='selectin')
     
     def __repr__(self):
         return f'<Client {self.ФИО}>'
 
-class Employee(Base):
+class Employee(BranchScoped, Base):
     __tablename__ = 'Сотрудник'
     
     ID_Сотрудника: Mapped[int] = mapped_column(Integer, primary_key=True, nullable=False)
@@ -54,6 +97,10 @@ class Employee(Base):
     Логин: Mapped[str | None] = mapped_column(String(50), nullable=True, unique=True)
     Пароль: Mapped[str | None] = mapped_column(String(255), nullable=True)
     
+    __table_args__ = (
+        Index('ix_Сотрудник_Филиал', 'Филиал', 'ID_Сотрудника'),
+    )
+    
     loans: Mapped[list['Loan']] = relationship('Loan', back_populates='employee', foreign_keys='Loan.Исполнитель', lazy='selectin')
     sales: Mapped[list['Sale']] = relationship('Sale', back_populates='seller', lazy='selectin')
     
@@ -81,37 +128,82 @@ class InterestRate(Base):
     def __repr__(self):
         return f'<InterestRate {self.Индекс_процента}>'
 
-class Loan(Base):
+class ItemCategory(Base):
+    __tablename__ = 'Категория_товара'
+    
+    ID_категории: Mapped[int] = mapped_column(Integer, primary_key=True, nullable=False)
+    Название: Mapped[str] = mapped_column(String(100), nullable=False, unique=True)
+    
+    def __repr__(self):
+        return f'<ItemCategory {self.Название}>'
+
+class Product(Base):
+    __tablename__ = 'Товар'
+    
+    ID_товара: Mapped[int] = mapped_column(Integer, primary_key=True, nullable=False)
+    Наименование: Mapped[str] = mapped_column(String(200), nullable=False)
+    Категория: Mapped[int] = mapped_column(Integer, ForeignKey('Категория_товара.ID_категории'), nullable=False, index=True)
+    
+    __table_args__ = (
+        # Одно наименование в категории - одна запись справочника
+        UniqueConstraint('Наименование', 'Категория', name='uq_Товар_Наименование_Категория'),
+    )
+    
+    category: Mapped['ItemCategory'] = relationship('ItemCategory', lazy='selectin')
+    
+    def __repr__(self):
+        return f'<Product {self.Наименование}>'
+
+class Loan(BranchScoped, Base):
     __tablename__ = 'Займ'
     
     Код_займа: Mapped[int] = mapped_column(Integer, primary_key=True, nullable=False)
-    Дата_займа: Mapped[date] = mapped_column(Date, nullable=False)
+    Дата_займа: Mapped[date] = mapped_column(Date, nullable=False, index=True)
     Клиент: Mapped[int] = mapped_column(Integer, ForeignKey('Клиент.ID_Клиента'), nullable=False)
     Размер_займа: Mapped[Decimal] = mapped_column(Numeric(10, 4), nullable=False)
     Процент_по_займу: Mapped[int] = mapped_column(Integer, ForeignKey('Процент_по_займу.Индекс_процента'), nullable=False)
     Срок_займа: Mapped[Decimal] = mapped_column(Numeric(4, 2), nullable=False)
-    Статус_займа: Mapped[str] = mapped_column(String(20), nullable=False)  # Переименовано из Состояние_товара
+    Статус_займа: Mapped[str] = mapped_column(String(20), nullable=False, index=True)  # Переименовано из Состояние_товара
     Состояние_товара: Mapped[Decimal] = mapped_column(Numeric(4, 2), nullable=False)  # Процент из InterestRate
     Артикул_товара: Mapped[int] = mapped_column(Integer, nullable=False)
-    Наименование_товара: Mapped[str] = mapped_column(String(200), nullable=False)
-    Категория_товара: Mapped[str] = mapped_column(String(100), nullable=False)
+    # Наименование и категория товара - в справочниках Товар и Категория_товара
+    Товар: Mapped[int] = mapped_column(Integer, ForeignKey('Товар.ID_товара'), nullable=False, index=True)
     Физическое_состояние: Mapped[str] = mapped_column(String(50), nullable=False)
     Исполнитель: Mapped[int] = mapped_column(Integer, ForeignKey('Сотрудник.ID_Сотрудника'), nullable=False)
     
+    __table_args__ = (
+        # История займов клиента: сводка и постраничный вывод по дате
+        Index('ix_Займ_Клиент_Дата_займа', 'Клиент', 'Дата_займа'),
+        # Частичный индекс по невыплаченным займам - выборки по статусу не читают историю выплаченных
+        Index('ix_Займ_невыплаченные', 'Статус_займа', 'Дата_займа', postgresql_where=text('"Статус_займа" <> \'Выплачен\'')),
+        # Списки и отчеты филиала
+        Index('ix_Займ_Филиал_Статус_займа', 'Филиал', 'Статус_займа'),
+        Index('ix_Займ_Филиал_Дата_займа', 'Филиал', 'Дата_займа'),
+    )
+    
     client: Mapped['Client'] = relationship('Client', back_populates='loans', lazy='selectin')
     employee: Mapped['Employee'] = relationship('Employee', back_populates='loans', foreign_keys=[Исполнитель], lazy='selectin')
     interest_rate: Mapped['InterestRate'] = relationship('InterestRate', back_populates='loans', lazy='selectin')
+    product: Mapped['Product'] = relationship('Product', lazy='selectin')
     unclaimed_items: Mapped[list['UnclaimedItem']] = relationship('UnclaimedItem', back_populates='loan', foreign_keys='UnclaimedItem.Займ', lazy='selectin')
     
     def __repr__(self):
         return f'<Loan {self.Код_займа}>'
 
-class UnclaimedItem(Base):
+class UnclaimedItem(BranchScoped, Base):
     __tablename__ = 'Невостребованный_товар'
     
     Артикул: Mapped[int] = mapped_column(Integer, primary_key=True, nullable=False)
-    Займ: Mapped[int] = mapped_column(Integer, ForeignKey('Займ.Код_займа'), nullable=False)
+    Займ: Mapped[int] = mapped_column(Integer, ForeignKey('Займ.Код_займа'), nullable=False, index=True)
     Оценочная_стоимость: Mapped[Decimal] = mapped_column(Numeric(10, 4), nullable=False)
+    # Признак продажи, выставляется в той же транзакции, что и запись о продаже
+    Продан: Mapped[bool] = mapped_column(Boolean, nullable=False, default=False, server_default=false())
+    
+    __table_args__ = (
+        # Частичный индекс по непроданным товарам - выборка "доступно к продаже" пропорциональна их числу
+        Index('ix_Невостребованный_товар_непроданные', 'Артикул', postgresql_where=text('NOT "Продан"')),
+        Index('ix_Невостребованный_товар_Филиал', 'Филиал', 'Артикул'),
+    )
     
     loan: Mapped['Loan'] = relationship('Loan', back_populates='unclaimed_items', foreign_keys=[Займ], lazy='selectin')
     sales: Mapped[list['Sale']] = relationship('Sale', back_populates='item', foreign_keys='Sale.Артикул_проданного_товара', lazy='selectin')
@@ -119,16 +211,127 @@ class UnclaimedItem(Base):
     def __repr__(self):
         return f'<UnclaimedItem {self.Артикул}>'
 
-class Sale(Base):
+# Коды продаж выдает последовательность: таблица секционирована, и ограничение уникальности
+# только по Код_продажи (без ключа секционирования) в PostgreSQL невозможно
+SALE_CODE_SEQUENCE = Sequence('Продажа_Код_продажи_seq')
+
+class Sale(BranchScoped, Base):
     __tablename__ = 'Продажа'
     
-    Код_продажи: Mapped[int] = mapped_column(Integer, primary_key=True, nullable=False)
-    Дата_продажи: Mapped[date] = mapped_column(Date, nullable=False, default=date.today)
-    Артикул_проданного_товара: Mapped[int] = mapped_column(Integer, ForeignKey('Невостребованный_товар.Артикул'), nullable=False)
+    # Таблица секционирована по годам по Дата_продажи (database/maintain_partitions.py), поэтому
+    # ключ секционирования входит в первичный ключ таблицы; для ORM ключом остается Код_продажи
+    Код_продажи: Mapped[int] = mapped_column(Integer, SALE_CODE_SEQUENCE, primary_key=True, nullable=False)
+    Дата_продажи: Mapped[date] = mapped_column(Date, primary_key=True, nullable=False, default=date.today, index=True)
+    # Индекс - для номеров продаж товара в списке невостребованных товаров
+    Артикул_проданного_товара: Mapped[int] = mapped_column(Integer, ForeignKey('Невостребованный_товар.Артикул'), nullable=False, index=True)
     Продавец: Mapped[int] = mapped_column(Integer, ForeignKey('Сотрудник.ID_Сотрудника'), nullable=False)
     
     item: Mapped['UnclaimedItem'] = relationship('UnclaimedItem', back_populates='sales', foreign_keys=[Артикул_проданного_товара], lazy='selectin')
     seller: Mapped['Employee'] = relationship('Employee', back_populates='sales', foreign_keys=[Продавец], lazy='selectin')
     
+    __table_args__ = (
+        Index('ix_Продажа_Филиал_Дата_продажи', 'Филиал', 'Дата_продажи'),
+        {'postgresql_partition_by': 'RANGE ("Дата_продажи")'},
+    )
+    __mapper_args__ = {'primary_key': [Код_продажи]}
+    
     def __repr__(self):
         return f'<Sale {self.Код_продажи}>'
+
+class BranchSummary(Base):
+    """Сводка по филиалам за день. Обновляется приращениями в транзакции, создающей займ
+    или продажу, поэтому сводный отчет по всем филиалам не сканирует займы и продажи"""
+    __tablename__ = 'Сводка_по_филиалам'
+    
+    Филиал: Mapped[int] = mapped_column(Integer, ForeignKey('Филиал.ID_филиала'), primary_key=True, nullable=False)
+    Дата: Mapped[date] = mapped_column(Date, primary_key=True, nullable=False)
+    Выдано_займов: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    Сумма_займов: Mapped[Decimal] = mapped_column(Numeric(14, 4), nullable=False, default=0)
+    Продано_товаров: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    
+    def __repr__(self):
+        return f'<BranchSummary {self.Филиал} {self.Дата}>'
+
+class LoanStatusHistory(Base):
+    """История статусов займа: запись добавляется при каждой смене статуса и не изменяется.
+    Статус займа на дату - последняя запись с Действует_с не позже этой даты."""
+    __tablename__ = 'История_статусов_займа'
+    
+    ID_записи: Mapped[int] = mapped_column(BigInteger, primary_key=True, autoincrement=True)
+    Займ: Mapped[int] = mapped_column(Integer, ForeignKey('Займ.Код_займа'), nullable=False)
+    Статус: Mapped[str] = mapped_column(String(20), nullable=False)
+    Действует_с: Mapped[date] = mapped_column(Date, nullable=False)
+    
+    __table_args__ = (
+        # Статус займа на дату: поиск последней записи займа до даты
+        Index('ix_История_статусов_займа_Займ_Действует_с', 'Займ', 'Действует_с'),
+    )
+    
+    def __repr__(self):
+        return f'<LoanStatusHistory {self.Займ} {self.Статус}>'
+
+class ReportJob(Base):
+    """Задание на построение отчета в фоне. Воркеры забирают задания со статусом 'Ожидает'
+    через SELECT ... FOR UPDATE SKIP LOCKED, результат сохраняется в файл до Хранить_до."""
+    __tablename__ = 'Задание_отчета'
+    
+    ID_задания: Mapped[int] = mapped_column(BigInteger, primary_key=True, autoincrement=True)
+    Тип: Mapped[str] = mapped_column(String(30), nullable=False)
+    # Параметры отчета в JSON
+    Параметры: Mapped[str] = mapped_column(String(500), nullable=False, default='{}')
+    Статус: Mapped[str] = mapped_column(String(20), nullable=False, default='Ожидает')
+    # Без внешнего ключа, как в журнале изменений
+    Сотрудник: Mapped[int | None] = mapped_column(Integer, nullable=True)
+    # Филиал, которым ограничены данные отчета; NULL - все филиалы
+    Филиал: Mapped[int | None] = mapped_column(Integer, nullable=True)
+    Создано: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+    Начато: Mapped[datetime | None] = mapped_column(DateTime, nullable=True)
+    Завершено: Mapped[datetime | None] = mapped_column(DateTime, nullable=True)
+    Файл: Mapped[str | None] = mapped_column(String(255), nullable=True)
+    Ошибка: Mapped[str | None] = mapped_column(String(255), nullable=True)
+    Хранить_до: Mapped[datetime | None] = mapped_column(DateTime, nullable=True)
+    
+    __table_args__ = (
+        # Очередь: воркеры выбирают старейшее ожидающее задание
+        Index('ix_Задание_отчета_ожидает', 'Создано', postgresql_where=text('"Статус" = \'Ожидает\'')),
+    )
+    
+    def __repr__(self):
+        return f'<ReportJob {self.ID_задания} {self.Тип}>'
+
+class AuditLog(Base):
+    __tablename__ = 'Лог_изменений_займов'
+    
+    ID_записи: Mapped[int] = mapped_column(BigInteger, primary_key=True, autoincrement=True)
+    Дата_изменения: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+    # Без внешнего ключа: журнал не должен мешать удалению сотрудников и записей
+    Сотрудник: Mapped[int | None] = mapped_column(Integer, nullable=True)
+    Действие: Mapped[str] = mapped_column(String(30), nullable=False)
+    Таблица: Mapped[str] = mapped_column(String(50), nullable=False)
+    Код_записи: Mapped[int] = mapped_column(Integer, nullable=False)
+    Старое_значение: Mapped[str | None] = mapped_column(String(255), nullable=True)
+    Новое_значение: Mapped[str | None] = mapped_column(String(255), nullable=True)
+    
+    __table_args__ = (
+        # История изменений конкретной записи
+        Index('ix_Лог_изменений_займов_Таблица_Код_записи', 'Таблица', 'Код_записи'),
+    )
+    
+    def __repr__(self):
+        return f'<AuditLog {self.ID_записи}>'
+
+class SlowQuery(Base):
+    """Журнал медленных запросов: запросы дольше SLOW_QUERY_MS с маршрутом, параметрами
+    и, для части из них, планом EXPLAIN (ANALYZE, BUFFERS)"""
+    __tablename__ = 'Медленный_запрос'
+    
+    ID_записи: Mapped[int] = mapped_column(BigInteger, primary_key=True, autoincrement=True)
+    Время: Mapped[datetime] = mapped_column(DateTime, nullable=False, index=True)
+    Длительность_мс: Mapped[int] = mapped_column(Integer, nullable=False)
+    Маршрут: Mapped[str | None] = mapped_column(String(200), nullable=True)
+    Запрос: Mapped[str] = mapped_column(Text, nullable=False)
+    Параметры: Mapped[str | None] = mapped_column(String(1000), nullable=True)
+    План: Mapped[str | None] = mapped_column(Text, nullable=True)
+    
+    def __repr__(self):
+        return f'<SlowQuery {self.ID_записи} {self.Длительность_мс} мс>'
@@ -0,0 +1,129 @@
+"""
+Статические файлы с отпечатком содержимого в имени
+Сборка (при развертывании): quart --app app build-static
+
+Сторонние библиотеки (Bootstrap, Popper, Bootstrap Icons, Chart.js) хранятся в репозитории
+в static/vendor, поэтому сборка работает без доступа к сети; отсутствующий файл сборка скачивает
+по адресу из VENDOR_ASSETS. Сборка копирует файлы static/ в static/dist под именами с хешем
+содержимого, переписывает ссылки url() в CSS на новые имена, создает сжатые варианты .gz и .br
+(brotli - если установлен пакет Brotli) и записывает манифест: исходный путь -> путь с хешем.
+Имя файла меняется вместе с содержимым, поэтому браузер может кешировать его бессрочно.
+"""
+import gzip
+import hashlib
+import json
+import os
+import posixpath
+import re
+import shutil
+import urllib.request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+DIST_DIR = os.path.join(STATIC_DIR, 'dist')
+MANIFEST_PATH = os.path.join(DIST_DIR, 'manifest.json')
+
+# Сторонние файлы: путь в static/ -> исходный адрес той же версии. Если сборка не выполнена,
+# шаблоны ссылаются на эти адреса. Popper и bootstrap.min.js вместе - то же, что bootstrap.bundle.min.js
+VENDOR_ASSETS = {
+    'vendor/bootstrap.min.css': 'https://cdn.jsdelivr.net/npm/bootstrap@5.3.0/dist/css/bootstrap.min.css',
+    'vendor/popper.min.js': 'https://cdn.jsdelivr.net/npm/@popperjs/core@2.11.8/dist/umd/popper.min.js',
+    'vendor/bootstrap.min.js': 'https://cdn.jsdelivr.net/npm/bootstrap@5.3.0/dist/js/bootstrap.min.js',
+    'vendor/bootstrap-icons.min.css': 'https://cdn.jsdelivr.net/npm/bootstrap-icons@1.11.3/font/bootstrap-icons.min.css',
+    'vendor/fonts/bootstrap-icons.woff2': 'https://cdn.jsdelivr.net/npm/bootstrap-icons@1.11.3/font/fonts/bootstrap-icons.woff2',
+    'vendor/fonts/bootstrap-icons.woff': 'https://cdn.jsdelivr.net/npm/bootstrap-icons@1.11.3/font/fonts/bootstrap-icons.woff',
+    'vendor/chart.umd.js': 'https://cdn.jsdelivr.net/npm/chart.js@4.4.0/dist/chart.umd.js',
+}
+
+# Текстовые форматы, для которых создаются сжатые варианты (woff2 и изображения уже сжаты)
+COMPRESSIBLE_EXTENSIONS = {'.css', '.js', '.json', '.svg', '.txt', '.map', '.woff'}
+CSS_URL = re.compile(r'''url\(\s*(['"]?)([^'")]+)\1\s*\)''')
+
+def download_vendor_assets() -> list:
+    """Скачивает сторонние файлы, которых еще нет в static/vendor; возвращает скачанные пути"""
+    downloaded = []
+    for name, url in VENDOR_ASSETS.items():
+        path = os.path.join(STATIC_DIR, name)
+        if os.path.exists(path):
+            continue
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with urllib.request.urlopen(url, timeout=30) as response, open(path, 'wb') as file:
+            shutil.copyfileobj(response, file)
+        downloaded.append(name)
+    return downloaded
+
+def source_files() -> list:
+    """Пути исходных файлов относительно static/ (кроме результатов сборки)"""
+    names = []
+    for directory, subdirectories, files in os.walk(STATIC_DIR):
+        if os.path.abspath(directory) == DIST_DIR:
+            subdirectories.clear()
+            continue
+        subdirectories[:] = [name for name in subdirectories if os.path.join(directory, name) != DIST_DIR]
+        for filename in files:
+            names.append(os.path.relpath(os.path.join(directory, filename), STATIC_DIR).replace(os.sep, '/'))
+    return sorted(names)
+
+def fingerprinted_name(name: str, data: bytes) -> str:
+    stem, extension = posixpath.splitext(name)
+    return f'{stem}.{hashlib.sha256(data).hexdigest()[:12]}{extension}'
+
+def rewrite_css_urls(name: str, css: str, manifest: dict) -> str:
+    """Заменяет относительные ссылки url() на файлы с хешем; внешние ссылки и data: не меняются"""
+    base = posixpath.dirname(name)
+
+    def replace(match):
+        quote, reference = match.groups()
+        if reference.startswith(('data:', 'http:', 'https:', '//', '#')):
+            return match.group(0)
+        # Параметры (?v=...) и фрагменты больше не нужны - версию задает имя файла
+        target = posixpath.normpath(posixpath.join(base, re.split(r'[?#]', reference)[0]))
+        if target not in manifest:
+            return match.group(0)
+        return f'url({quote}{posixpath.relpath(manifest[target], base)}{quote})'
+
+    return CSS_URL.sub(replace, css)
+
+def write_compressed(path: str, data: bytes):
+    """Сжатые варианты файла для отдачи без сжатия на лету"""
+    with open(f'{path}.gz', 'wb') as file:
+        # mtime=0 - одинаковый результат при повторной сборке
+        file.write(gzip.compress(data, compresslevel=9, mtime=0))
+    if brotli is not None:
+        with open(f'{path}.br', 'wb') as file:
+            file.write(brotli.compress(data, quality=11))
+
+def build_assets() -> dict:
+    """Собирает static/dist и манифест; CSS обрабатываются последними, чтобы ссылки на шрифты
+    и изображения указывали на уже переименованные файлы"""
+    if os.path.exists(DIST_DIR):
+        shutil.rmtree(DIST_DIR)
+    manifest = {}
+    names = source_files()
+    for name in sorted(names, key=lambda name: name.endswith('.css')):
+        with open(os.path.join(STATIC_DIR, name), 'rb') as file:
+            data = file.read()
+        if name.endswith('.css'):
+            data = rewrite_css_urls(name, data.decode('utf-8'), manifest).encode('utf-8')
+        manifest[name] = fingerprinted_name(name, data)
+        path = os.path.join(DIST_DIR, manifest[name])
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as file:
+            file.write(data)
+        if posixpath.splitext(name)[1] in COMPRESSIBLE_EXTENSIONS:
+            write_compressed(path, data)
+    with open(MANIFEST_PATH, 'w', encoding='utf-8') as file:
+        json.dump(manifest, file, ensure_ascii=False, indent=2)
+    return manifest
+
+def load_manifest() -> dict:
+    """Манифест последней сборки; до сборки - пустой"""
+    try:
+        with open(MANIFEST_PATH, encoding='utf-8') as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}